@@ -75,6 +75,13 @@ class ThermologAdmin(admin.ModelAdmin):
 
 admin.site.register(models.Thermolog, ThermologAdmin)
 
+class ThermoSummaryAdmin(admin.ModelAdmin):
+  list_display = ('sensor', 'period', 'time', 'min_temp', 'avg_temp',
+      'max_temp', 'num_readings')
+  list_filter = ('sensor', 'period', 'time')
+
+admin.site.register(models.ThermoSummary, ThermoSummaryAdmin)
+
 class SystemEventAdmin(admin.ModelAdmin):
   list_display = ('id', 'kind', 'time', 'user', 'drink', 'keg', 'session')
   list_filter = ('kind', 'time')
@@ -20,24 +20,54 @@
 
 from __future__ import absolute_import
 
-import datetime
+import functools
+import inspect
 import logging
+import uuid
 
 from django.conf import settings
+from django.db import transaction
+from django.db.utils import IntegrityError
 from django.utils import timezone
+from . import deferred
+from . import ingest
 from . import kb_common
 from . import models
+from . import tap_cache
 from . import time_series
 
-if settings.HAVE_CELERY:
-  from pykeg.web import tasks
-
 class BackendError(Exception):
   """Base backend error exception."""
 
 class NoTokenError(BackendError):
   """Token given is unknown."""
 
+def _Ingested(batch=None):
+  """Runs the decorated method on the ingest writer thread, if enabled.
+
+  When settings.KEGBOT_INGEST_WRITER is set, calls from any other thread are
+  queued for the writer, and wait for its result.  If `batch` names a method,
+  consecutive calls on the same site may be passed to it together, as a list
+  of keyword argument dictionaries.
+  """
+  def decorator(method):
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+      if not settings.KEGBOT_INGEST_WRITER or ingest.InWriter():
+        return method(self, *args, **kwargs)
+      callargs = inspect.getcallargs(method, self, *args, **kwargs)
+      del callargs['self']
+      batch_func = batch_key = None
+      if batch:
+        batch_func = getattr(self, batch)
+        batch_key = (batch, self._site.id)
+      future = ingest.GetWriter().Submit(functools.partial(method, self),
+          callargs, batch_func, batch_key)
+      return future.Result()
+    return wrapper
+  return decorator
+
+
 class KegbotBackend:
   """Django Backend."""
 
@@ -49,10 +79,8 @@ class KegbotBackend:
       self._site = models.KegbotSite.objects.get(name=sitename)
 
   def _GetTapFromName(self, tap_name):
-    try:
-      return models.KegTap.objects.get(site=self._site, meter_name=tap_name)
-    except models.KegTap.DoesNotExist:
-      return None
+    """Returns the tap, from tap_cache; it must not be modified."""
+    return tap_cache.GetTap(self._site, tap_name)
 
   def _GetKegForTapName(self, tap_name):
     tap = self._GetTapFromName(tap_name)
@@ -98,10 +126,161 @@ class KegbotBackend:
   def GetAllTaps(self):
     return list(models.KegTap.objects.all())
 
+  @_Ingested(batch='_RecordDrinkBatch')
   def RecordDrink(self, tap_name, ticks, volume_ml=None, username=None,
       pour_time=None, duration=0, shout='', tick_time_series='',
-      do_postprocess=True):
+      do_postprocess=True, defer_postprocess=None, pour_key=None):
+    """Records a new drink.
+
+    Unless `do_postprocess` is False, the drink is also assigned to a session
+    and added to stats and events.  If `defer_postprocess` is True, or is None
+    and settings.KEGBOT_DEFER_POSTPROCESS is set, that work is queued for a
+    background worker instead (see deferred), and the returned drink has no
+    session yet.
+
+    `pour_key` is an optional client-supplied identifier for the pour, unique
+    within the site.  If a drink was already recorded with the same key, eg
+    by an earlier attempt which timed out, that drink is returned instead and
+    nothing else is done.
+    """
+    if defer_postprocess is None:
+      defer_postprocess = settings.KEGBOT_DEFER_POSTPROCESS
+
+    if pour_key:
+      existing = self._GetDrinkForPourKey(pour_key)
+      if existing:
+        return existing
+
+    d = self._MakeDrink(tap_name, ticks, volume_ml, username, pour_time,
+        duration, shout, tick_time_series, pour_key)
+
+    if do_postprocess and not defer_postprocess:
+      with deferred.InOrder(self._site):
+        d, created = self._SaveDrink(d, enqueue=False)
+        if created:
+          with transaction.commit_on_success():
+            deferred.ProcessDrink(d)
+      if created:
+        deferred.NotifyEvents(d)
+      return d
+
+    d, created = self._SaveDrink(d, enqueue=do_postprocess)
+    if created and do_postprocess:
+      deferred.Notify(self._site)
+    return d
+
+  def _SaveDrink(self, d, enqueue):
+    """Stores a new drink, queued for post-processing if `enqueue` is set.
 
+    Returns (drink, created).  If another attempt at the same pour stored its
+    drink first, that drink is returned instead.
+    """
+    try:
+      if enqueue:
+        deferred.Enqueue(d)
+      else:
+        # The drink is first stored with its session, so that concurrent
+        # stats builds never see it without one.
+        with transaction.commit_on_success():
+          models.DrinkingSession.AssignSessionForDrink(d)
+    except IntegrityError:
+      # Lost a race with another attempt at the same pour.
+      existing = d.pour_key and self._GetDrinkForPourKey(d.pour_key)
+      if not existing:
+        raise
+      return existing, False
+    return d, True
+
+  @_Ingested()
+  def RecordDrinks(self, pours, defer_postprocess=None):
+    """Records several drinks, in the order given, in one transaction.
+
+    Each of `pours` is a dictionary of RecordDrink() keyword arguments.
+    Sessions are assigned, and stats and events updated, in a single pass
+    over all of the new drinks, unless post-processing is deferred as for
+    RecordDrink().  If any pour names an unknown tap, BackendError is raised
+    and nothing is recorded.
+
+    Returns a drink for each pour.  As with RecordDrink(), a pour whose
+    `pour_key` was already recorded, here or earlier in `pours`, gets the
+    existing drink.
+    """
+    if defer_postprocess is None:
+      defer_postprocess = settings.KEGBOT_DEFER_POSTPROCESS
+
+    if defer_postprocess:
+      drinks, new_drinks = self._RecordDrinks(pours, defer_postprocess)
+      deferred.Notify(self._site)
+      return drinks
+
+    with deferred.InOrder(self._site):
+      drinks, new_drinks = self._RecordDrinks(pours, defer_postprocess)
+    for d in new_drinks:
+      deferred.NotifyEvents(d)
+    return drinks
+
+  def _RecordDrinks(self, pours, defer_postprocess):
+    """Stores drinks for RecordDrinks(); returns (drinks, new drinks)."""
+    keys = [pour['pour_key'] for pour in pours if pour.get('pour_key')]
+    with transaction.commit_on_success():
+      by_key = {}
+      if keys:
+        for d in self._site.drinks.filter(pour_key__in=keys):
+          by_key[d.pour_key] = d
+      drinks = []
+      new_drinks = []
+      for pour in pours:
+        pour_key = pour.get('pour_key')
+        if pour_key and pour_key in by_key:
+          drinks.append(by_key[pour_key])
+          continue
+        d = self._MakeDrink(**pour)
+        if pour_key:
+          by_key[pour_key] = d
+        drinks.append(d)
+        new_drinks.append(d)
+
+      if defer_postprocess:
+        for d in new_drinks:
+          deferred.Enqueue(d)
+      else:
+        models.DrinkingSession.AssignSessionsForDrinks(new_drinks)
+        for d in new_drinks:
+          d.save()
+        models.Drink.PostProcessAll(new_drinks)
+    return drinks, new_drinks
+
+  def _RecordDrinkBatch(self, calls):
+    """Records RecordDrink() calls from the ingest writer together.
+
+    Pours without a pour key are given one, in `calls` itself, so that if the
+    writer retries the calls one by one, pours already committed are not
+    recorded twice.
+    """
+    options = set((c['do_postprocess'], c['defer_postprocess']) for c in calls)
+    do_postprocess, defer_postprocess = options.pop()
+    if options or not do_postprocess:
+      raise ValueError('Calls cannot be batched.')
+    pours = []
+    for c in calls:
+      if not c.get('pour_key'):
+        c['pour_key'] = 'ingest-%s' % uuid.uuid4().hex
+      pour = dict(c)
+      del pour['do_postprocess']
+      del pour['defer_postprocess']
+      pours.append(pour)
+    return self.RecordDrinks(pours, defer_postprocess=defer_postprocess)
+
+  def _GetDrinkForPourKey(self, pour_key):
+    try:
+      return self._site.drinks.get(pour_key=pour_key)
+    except models.Drink.DoesNotExist:
+      return None
+
+  def _MakeDrink(self, tap_name, ticks, volume_ml=None, username=None,
+      pour_time=None, duration=0, shout='', tick_time_series='',
+      pour_key=None):
+    """Returns a new, unsaved drink."""
     tap = self._GetTapFromName(tap_name)
     if not tap:
       raise BackendError("Tap unknown")
@@ -109,11 +288,10 @@ class KegbotBackend:
     if volume_ml is None:
       volume_ml = float(ticks) * tap.ml_per_tick
 
-    user = None
     if username:
-      user = self._GetUserObjFromUsername(username)
-    elif self._site.settings.default_user:
-      user = self._site.settings.default_user
+      owner = {'user': self._GetUserObjFromUsername(username)}
+    else:
+      owner = {'user_id': tap_cache.GetDefaultUserId(self._site)}
 
     if not pour_time:
       pour_time = timezone.now()
@@ -124,35 +302,27 @@ class KegbotBackend:
 
     if tick_time_series:
       try:
-        # Validate the time series by parsing it; canonicalize it by generating
-        # it again.  If malformed, just junk it; it's non-essential information.
-        tick_time_series = time_series.to_string(time_series.from_string(tick_time_series))
+        # Validate the time series by parsing it; store it in compact form.
+        # If malformed, just junk it; it's non-essential information.
+        tick_time_series = time_series.to_compact_string(
+            time_series.from_string(tick_time_series))
       except ValueError, e:
         self._logger.warning('Time series invalid, ignoring. Error was: %s' % e)
         tick_time_series = ''
 
-    d = models.Drink(ticks=ticks, site=self._site, keg=keg, user=user,
-        volume_ml=volume_ml, time=pour_time, duration=duration,
-        shout=shout, tick_time_series=tick_time_series)
-    models.DrinkingSession.AssignSessionForDrink(d)
-    d.save()
-
-    if do_postprocess:
-      d.PostProcess()
-      event_list = [e for e in models.SystemEvent.objects.filter(drink=d).order_by('id')]
-      if settings.HAVE_CELERY:
-        tasks.handle_new_events.delay(self._site, event_list)
-
-    return d
+    return models.Drink(ticks=ticks, site=self._site, keg=keg, tap=tap,
+        volume_ml=volume_ml, time=pour_time, duration=duration, shout=shout,
+        tick_time_series=tick_time_series, pour_key=pour_key or None, **owner)
 
+  @_Ingested()
   def CancelDrink(self, drink_id, spilled=False):
+    # Stats must include the drink before it can be retracted.
+    deferred.Flush(self._site)
     try:
       d = self._site.drinks.get(id=drink_id)
     except models.Drink.DoesNotExist:
       return
 
-    keg = d.keg
-    user = d.user
     session = d.session
 
     # Transfer volume to spillage if requested.
@@ -163,37 +333,33 @@ class KegbotBackend:
     d.status = 'deleted'
     d.save()
 
-    # Invalidate all statistics.
-    models.SystemStats.objects.filter(site=self._site).delete()
-    models.KegStats.objects.filter(site=self._site, keg=d.keg).delete()
-    models.UserStats.objects.filter(site=self._site, user=d.user).delete()
-    models.SessionStats.objects.filter(site=self._site, session=d.session).delete()
+    # Retract the drink from all statistics, and from its session.
+    d.RemoveFromStats()
+    if session:
+      session.RebuildForDrink(d)
 
     # Delete any SystemEvents for this drink.
     models.SystemEvent.objects.filter(site=self._site, drink=d).delete()
 
-    # Regenerate new statistics, based on the most recent drink
-    # post-cancellation.
-    last_qs = self._site.drinks.valid().order_by('-id')
-    if last_qs:
-      last_drink = last_qs[0]
-      last_drink._UpdateSystemStats()
-
-    if keg:
-      keg.RecomputeStats()
-    if user and user.get_profile():
-      user.get_profile().RecomputeStats()
-    if session:
-      session.Rebuild()
-      session.RecomputeStats()
+    return d
 
-    # TODO(mikey): recompute session.
+  @_Ingested()
+  def SetDrinkVolume(self, drink_id, volume_ml):
+    """Changes the recorded volume of a drink, eg after recalibration."""
+    deferred.Flush(self._site)
+    try:
+      d = self._site.drinks.get(id=drink_id)
+    except models.Drink.DoesNotExist:
+      return
+    if d.volume_ml == volume_ml:
+      return d
+    d.SetVolume(volume_ml)
     return d
 
+  @_Ingested(batch='_LogSensorReadingBatch')
   def LogSensorReading(self, sensor_name, temperature, when=None):
-    now = timezone.now()
     if not when:
-      when = now
+      when = timezone.now()
 
     # The maximum resolution of ThermoSensor records is 1 minute.  Round the
     # time down to the nearest minute; if a record already exists for this time,
@@ -214,13 +380,69 @@ class KegbotBackend:
         sensor=sensor, time=when, defaults=defaults)
     record.temp = temperature
     record.save()
+    return record
 
-    # Delete old entries.
-    keep_time = now - datetime.timedelta(hours=24)
-    old_entries = models.Thermolog.objects.filter(site=self._site, time__lt=keep_time)
-    old_entries.delete()
+  @_Ingested()
+  def LogSensorReadings(self, readings):
+    """Logs several sensor readings at once.
 
-    return record
+    `readings` is a list of LogSensorReading() keyword argument dictionaries.
+    Readings are rounded to the minute, as by LogSensorReading(), and a later
+    reading replaces an earlier one for the same sensor and minute.  Returns
+    the Thermolog record for each reading, in order.
+    """
+    now = timezone.now()
+    min_val, max_val = kb_common.THERMO_SENSOR_RANGE
+    keys = []
+    for reading in readings:
+      temperature = reading['temperature']
+      if temperature < min_val or temperature > max_val:
+        raise ValueError('Temperature out of bounds')
+      when = reading.get('when') or now
+      keys.append((reading['sensor_name'],
+          when.replace(second=0, microsecond=0)))
+    if not keys:
+      return []
+
+    names = set(name for name, when in keys)
+    sensors = dict((s.raw_name, s) for s in models.ThermoSensor.objects.filter(
+        site=self._site, raw_name__in=names))
+    for name in names.difference(sensors):
+      sensors[name] = self._GetSensorFromName(name)
+
+    def existing():
+      ret = {}
+      for record in models.Thermolog.objects.filter(site=self._site,
+          sensor__in=sensors.values(), time__in=set(w for n, w in keys)):
+        ret.setdefault((record.sensor_id, record.time), record)
+      return ret
+
+    records = existing()
+    changed = {}
+    for (name, when), reading in zip(keys, readings):
+      key = (sensors[name].id, when)
+      record = records.get(key)
+      if not record:
+        record = records[key] = models.Thermolog(site=self._site,
+            sensor=sensors[name], time=when)
+      record.temp = reading['temperature']
+      changed[key] = record
+
+    new = []
+    for record in changed.itervalues():
+      if record.id:
+        record.save()
+      else:
+        new.append(record)
+    if new:
+      models.Thermolog.objects.bulk_create(new)
+      # bulk_create() does not set primary keys on all databases.
+      records = existing()
+    return [records[(sensors[name].id, when)] for name, when in keys]
+
+  def _LogSensorReadingBatch(self, calls):
+    """Logs LogSensorReading() calls from the ingest writer together."""
+    return self.LogSensorReadings(calls)
 
   def GetAuthToken(self, auth_device, token_value):
     if token_value and auth_device in kb_common.AUTH_MODULE_NAMES_HEX_VALUES:
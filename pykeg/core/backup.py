@@ -18,11 +18,11 @@
 
 """Dump/restore utility methods for Kegbot."""
 
-import sys
 
 from kegbot.util import kbjson
 
 from pykeg.core import models
+from pykeg.core import stats
 from pykeg.proto import protolib
 
 def _no_log(msg):
@@ -277,15 +277,9 @@ def _RegenSessions(kbsite):
     d.session.AddDrink(d)
 
 def _RegenStats(kbsite):
-  models.SystemStats.objects.filter(site=kbsite).delete()
-  models.UserStats.objects.filter(site=kbsite).delete()
-  models.KegStats.objects.filter(site=kbsite).delete()
-  models.SessionStats.objects.filter(site=kbsite).delete()
-  for d in kbsite.drinks.valid().order_by('starttime'):
-    d._UpdateSystemStats()
-    d._UpdateUserStats()
-    d._UpdateKegStats()
-    d._UpdateSessionStats()
+  stats.RebuildAllStats(kbsite)
+  models.VolumeRollup.RebuildAll(kbsite)
+  models.LeaderboardEntry.RebuildAll(kbsite)
 
 def _RegenEvents(kbsite):
   kbsite.events.all().delete()
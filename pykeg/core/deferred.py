@@ -0,0 +1,190 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Deferred post-processing of recorded drinks.
+
+When post-processing is deferred, KegbotBackend.RecordDrink() stores the
+drink along with a PendingDrink row, and returns.  Session assignment, stats
+and events are then handled by a background worker, one per site and process,
+which takes pending drinks strictly in id order so that stats are built just
+as they would have been synchronously.  Pending rows are deleted in the same
+transaction that processes them, so drinks left pending by a restart are
+picked up when the worker next runs.
+
+The worker is only started when settings.KEGBOT_DEFER_POSTPROCESS is set:
+by StartWorkers() as the web or ingest server starts, and again whenever a
+drink is queued.  Otherwise, drinks explicitly deferred wait for Flush(), which
+processes everything pending for a site in the calling thread, or for the
+kb_postprocess command.  Call Flush() whenever up-to-date stats are needed.
+
+Drinks post-processed synchronously are handled within InOrder(), which
+flushes pending drinks first, so that stats still take drinks in id order.
+"""
+
+import contextlib
+import logging
+import threading
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import transaction
+
+from pykeg.core import models
+
+if settings.HAVE_CELERY:
+  from pykeg.web import tasks
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for pending drinks when the worker is not notified,
+# eg for drinks queued by another process.
+POLL_INTERVAL_SECS = 5.0
+
+# Serializes processing of each site's drinks within this process.
+_SITE_LOCKS = {}
+_WORKERS = {}
+_LOCK = threading.Lock()
+
+
+def _SiteLock(site_id):
+  with _LOCK:
+    return _SITE_LOCKS.setdefault(site_id, threading.RLock())
+
+
+def ProcessDrink(drink):
+  """Assigns the drink to a session and updates its stats and events.
+
+  The caller should commit, then call NotifyEvents().
+  """
+  models.DrinkingSession.AssignSessionForDrink(drink)
+  drink.PostProcess()
+
+
+def NotifyEvents(drink):
+  """Hands the drink's committed events to Celery for delivery, if enabled."""
+  if not settings.HAVE_CELERY:
+    return
+  event_list = list(models.SystemEvent.objects.filter(
+      drink=drink).order_by('id'))
+  tasks.handle_new_events.delay(drink.site, event_list)
+
+
+def Enqueue(drink):
+  """Stores a new drink, with its PendingDrink, and commits both."""
+  with transaction.commit_on_success():
+    drink.save()
+    models.PendingDrink.objects.create(site_id=drink.site_id, drink=drink)
+
+
+def _ProcessNext(site_id):
+  """Processes the site's oldest pending drink; returns False if none."""
+  with transaction.commit_on_success():
+    pending = models.PendingDrink.objects.select_for_update().filter(
+        site=site_id).select_related('drink').order_by('id')[:1]
+    if not pending:
+      return False
+    pending = pending[0]
+    # Deleted first, so that the deletion commits along with the drink's
+    # post-processing.
+    pending.delete()
+    drink = pending.drink
+    if drink.status != 'valid':
+      return True
+    ProcessDrink(drink)
+  NotifyEvents(drink)
+  return True
+
+
+def Flush(site):
+  """Post-processes all of the site's pending drinks, in order.
+
+  Returns the number of drinks processed.
+  """
+  count = 0
+  with _SiteLock(site.id):
+    while _ProcessNext(site.id):
+      count += 1
+  return count
+
+
+@contextlib.contextmanager
+def InOrder(site):
+  """Context for recording and post-processing drinks synchronously.
+
+  The site's pending drinks are processed first, and no others are processed
+  by this process until the context exits.
+  """
+  with _SiteLock(site.id):
+    Flush(site)
+    yield
+
+
+def Pending(site):
+  """Returns the number of drinks awaiting post-processing."""
+  return models.PendingDrink.objects.filter(site=site).count()
+
+
+class Worker(threading.Thread):
+  """Background thread which flushes a site's pending drinks."""
+  def __init__(self, site):
+    threading.Thread.__init__(self, name='postprocess-%s' % site.name)
+    self.daemon = True
+    self.site = site
+    self._wakeup = threading.Event()
+    self._quit = False
+
+  def Notify(self):
+    self._wakeup.set()
+
+  def Quit(self):
+    self._quit = True
+    self._wakeup.set()
+
+  def run(self):
+    while not self._quit:
+      try:
+        Flush(self.site)
+      except Exception, e:
+        logger.exception('Error post-processing drinks: %s' % e)
+      self._wakeup.wait(POLL_INTERVAL_SECS)
+      self._wakeup.clear()
+
+
+def Notify(site):
+  """Wakes up the site's worker, starting it if needed and enabled."""
+  if not settings.KEGBOT_DEFER_POSTPROCESS:
+    return
+  with _LOCK:
+    worker = _WORKERS.get(site.id)
+    if not worker or not worker.is_alive():
+      worker = _WORKERS[site.id] = Worker(site)
+      worker.start()
+  worker.Notify()
+
+
+def StartWorkers():
+  """Starts a worker for each site, if enabled, for drinks left pending."""
+  if not settings.KEGBOT_DEFER_POSTPROCESS:
+    return
+  try:
+    sites = list(models.KegbotSite.objects.all())
+  except DatabaseError, e:
+    logger.warning('Not starting post-processing workers: %s' % e)
+    return
+  for site in sites:
+    Notify(site)
@@ -0,0 +1,254 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Flow analytics of drinks, computed from their tick time series.
+
+Series times are in milliseconds.  For each drink, AnalyzeSeries() finds:
+
+  first_tick_ms: the time of the first sample with any ticks;
+  duration_ms: the time from then to the last sample;
+  peak_ml_per_sec: the fastest rate over any interval after the first tick;
+  mean_ml_per_sec: the overall rate after the first tick;
+  stall_count: the intervals after the first tick longer than STALL_GAP_MS,
+    that is, pauses in the flow;
+  foaming: whether the peak rate exceeds FOAM_PEAK_RATIO times the mean, as
+    when foam spins the meter in bursts.
+
+UpdateDrinks() computes these once for each drink, and stores them as
+DrinkFlowStats; when NumPy is installed, all drinks are analysed together
+by flow_stats_numpy.  New drinks are analysed as they are post-processed,
+and older ones by the kb_flow_stats command.  Changing a drink's volume
+computes its record again, since the rates depend on it.  GetKegSummary() aggregates a keg's drinks, including
+the drift in their flow rate over the life of the keg.
+"""
+
+from django.conf import settings
+from django.db import transaction
+from django.db.utils import IntegrityError
+
+from pykeg.core import models
+from pykeg.core import time_series
+
+# Longest interval between samples which is not a stall.
+STALL_GAP_MS = 1000
+
+# Ratio of peak to mean flow rate above which a drink is deemed foamy.
+FOAM_PEAK_RATIO = 3.0
+
+FIELDS = ('first_tick_ms', 'duration_ms', 'peak_ml_per_sec', 'mean_ml_per_sec',
+    'stall_count', 'foaming')
+
+
+def AnalyzeSeries(pairs, ml_per_tick):
+  """Returns the flow stats of a series of (time, ticks) pairs, as a dict.
+
+  `first_tick_ms` is None if the series has no ticks.
+  """
+  ret = {
+    'first_tick_ms': None,
+    'duration_ms': 0,
+    'peak_ml_per_sec': 0.0,
+    'mean_ml_per_sec': 0.0,
+    'stall_count': 0,
+    'foaming': False,
+  }
+  for first, (time, amount) in enumerate(pairs):
+    if amount > 0:
+      break
+  else:
+    return ret
+
+  start = prev = pairs[first][0]
+  ticks = 0
+  for time, amount in pairs[first + 1:]:
+    interval = time - prev
+    if interval > STALL_GAP_MS:
+      ret['stall_count'] += 1
+    if interval > 0:
+      ret['peak_ml_per_sec'] = max(ret['peak_ml_per_sec'],
+          amount * ml_per_tick * 1000.0 / interval)
+    ticks += amount
+    prev = time
+
+  ret['first_tick_ms'] = start
+  ret['duration_ms'] = max(prev - start, 0)
+  if ret['duration_ms']:
+    ret['mean_ml_per_sec'] = ticks * ml_per_tick * 1000.0 / ret['duration_ms']
+  ret['foaming'] = IsFoaming(ret['peak_ml_per_sec'], ret['mean_ml_per_sec'])
+  return ret
+
+
+def IsFoaming(peak, mean):
+  """Returns whether a drink's peak and mean flow rates suggest foam."""
+  return mean > 0 and peak > FOAM_PEAK_RATIO * mean
+
+
+def AnalyzeAll(items):
+  """Analyses several series, given as (tick_time_series, ml_per_tick) pairs.
+
+  Malformed series are treated as empty.  Returns a list of flow stats.
+  """
+  ret = []
+  for s, ml_per_tick in items:
+    try:
+      pairs = time_series.from_string(s or '')
+    except ValueError:
+      pairs = []
+    ret.append(AnalyzeSeries(pairs, ml_per_tick))
+  return ret
+
+
+def _Analyze(drinks, use_numpy=None):
+  """Returns unsaved DrinkFlowStats for those of `drinks` without them."""
+  if use_numpy is None:
+    use_numpy = settings.HAVE_NUMPY
+  if use_numpy:
+    from pykeg.core import flow_stats_numpy
+    analyze = flow_stats_numpy.AnalyzeAll
+  else:
+    analyze = AnalyzeAll
+
+  rows = list(drinks.filter(flow_stats__isnull=True).values_list('id',
+      'site_id', 'tick_time_series', 'volume_ml', 'ticks'))
+  if not rows:
+    return []
+  # Use each drink's own calibration, which reflects any reported volume.
+  results = analyze([(row[2], float(row[3]) / row[4] if row[4] else 0.0)
+      for row in rows])
+  return [models.DrinkFlowStats(drink_id=row[0], site_id=row[1], **result)
+      for row, result in zip(rows, results)]
+
+
+def UpdateDrinks(drinks, use_numpy=None):
+  """Computes and stores flow stats for those of `drinks` without them.
+
+  Args
+    drinks: a Drink queryset
+    use_numpy: whether to analyse with flow_stats_numpy; by default, it is
+      used whenever NumPy is installed
+
+  Returns the number of drinks analysed.  Records stored meanwhile by another
+  writer, eg kb_flow_stats during post-processing, are left as they are.
+  """
+  records = _Analyze(drinks, use_numpy)
+  if not records:
+    return 0
+  sid = transaction.savepoint()
+  try:
+    models.DrinkFlowStats.objects.bulk_create(records)
+    transaction.savepoint_commit(sid)
+    return len(records)
+  except IntegrityError:
+    transaction.savepoint_rollback(sid)
+
+  count = 0
+  for record in records:
+    sid = transaction.savepoint()
+    try:
+      record.save()
+      transaction.savepoint_commit(sid)
+      count += 1
+    except IntegrityError:
+      # Stored first by the other writer.
+      transaction.savepoint_rollback(sid)
+  return count
+
+
+def ToDict(record):
+  """Returns a DrinkFlowStats record as a dict."""
+  ret = dict((field, getattr(record, field)) for field in FIELDS)
+  ret['drink_id'] = record.drink_id
+  return ret
+
+
+def GetDrinksStats(drinks):
+  """Returns the DrinkFlowStats of each of `drinks`, a queryset, by drink id.
+
+  Stats not yet stored by UpdateDrinks(), eg for drinks not post-processed
+  since the kb_flow_stats backfill, are computed but not saved, so that reads
+  never write.
+  """
+  ret = dict((record.drink_id, record)
+      for record in models.DrinkFlowStats.objects.filter(drink__in=drinks))
+  for record in _Analyze(drinks):
+    ret[record.drink_id] = record
+  return ret
+
+
+def GetDrinkStats(drink):
+  """Returns the drink's DrinkFlowStats, computed if not yet stored."""
+  return GetDrinksStats(models.Drink.objects.filter(id=drink.id))[drink.id]
+
+
+def GetKegSummary(keg, records=None):
+  """Returns flow stats for the keg's valid drinks, as a dict.
+
+  `records` are the drinks' flow stats, as returned by GetDrinksStats(), if
+  already at hand.  `drift_percent` is the change in mean flow rate over the
+  keg's life, from a least-squares fit of each drink's rate against the
+  volume served before it, or None if there are too few drinks to tell.
+  """
+  drinks = keg.drinks.valid()
+  if records is None:
+    records = GetDrinksStats(drinks)
+  rows = []
+  for drink_id, volume_ml in drinks.order_by('time', 'id').values_list('id',
+      'volume_ml'):
+    record = records.get(drink_id)
+    if record and record.first_tick_ms is not None:
+      rows.append((volume_ml, record.peak_ml_per_sec, record.mean_ml_per_sec,
+          record.stall_count, record.foaming))
+
+  ret = {
+    'keg_id': keg.id,
+    'num_drinks': len(rows),
+    'mean_peak_ml_per_sec': 0.0,
+    'mean_ml_per_sec': 0.0,
+    'stall_count': sum(row[3] for row in rows),
+    'foaming_drinks': sum(1 for row in rows if row[4]),
+    'drift_percent': None,
+  }
+  if not rows:
+    return ret
+  ret['mean_peak_ml_per_sec'] = sum(row[1] for row in rows) / len(rows)
+  ret['mean_ml_per_sec'] = sum(row[2] for row in rows) / len(rows)
+
+  served = []
+  total = 0.0
+  for row in rows:
+    served.append(total)
+    total += row[0]
+  ret['drift_percent'] = _Drift(served, [row[2] for row in rows])
+  return ret
+
+
+def _Drift(xs, ys):
+  """Returns the percent change in y across xs, by least squares, or None."""
+  n = len(xs)
+  if n < 2:
+    return None
+  mean_x = sum(xs) / n
+  mean_y = sum(ys) / n
+  var_x = sum((x - mean_x) ** 2 for x in xs)
+  if not var_x:
+    return None
+  slope = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+  start = mean_y + slope * (xs[0] - mean_x)
+  if start <= 0:
+    return None
+  return slope * (xs[-1] - xs[0]) / start * 100.0
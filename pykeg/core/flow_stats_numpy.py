@@ -0,0 +1,107 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Vectorized flow analytics with NumPy.
+
+AnalyzeAll() computes the same flow stats as flow_stats.AnalyzeAll(), but
+over all samples of all series at once.  It requires NumPy; check
+settings.HAVE_NUMPY before importing it.
+"""
+
+import numpy
+
+from pykeg.core import flow_stats
+from pykeg.core import time_series_numpy
+
+
+def _Parse(s):
+  try:
+    return time_series_numpy.from_string(s or '')
+  except ValueError:
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    return empty, empty
+
+
+def AnalyzeAll(items):
+  """Analyses several series, given as (tick_time_series, ml_per_tick) pairs.
+
+  Malformed series are treated as empty.  Returns a list of flow stats.
+  """
+  count = len(items)
+  if not count:
+    return []
+  parsed = [_Parse(s) for s, ml_per_tick in items]
+  lengths = numpy.array([len(times) for times, amounts in parsed],
+      dtype=numpy.int64)
+  empty = [numpy.zeros(0, dtype=numpy.int64)]
+  times = numpy.concatenate([p[0] for p in parsed] + empty)
+  amounts = numpy.concatenate([p[1] for p in parsed] + empty)
+  ml_per_tick = numpy.array([m for s, m in items], dtype=numpy.float64)
+
+  # Index of each sample's series, and of each series' first sample.
+  series = numpy.repeat(numpy.arange(count), lengths)
+  starts = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1]))
+
+  # Number of samples with ticks before each sample, in its own series.
+  positive = amounts > 0
+  before = numpy.cumsum(positive) - positive
+  before -= numpy.repeat(numpy.append(before, 0)[starts], lengths)
+  first = positive & (before == 0)
+  after = before > 0
+
+  has_ticks = numpy.zeros(count, dtype=bool)
+  has_ticks[series[first]] = True
+  first_tick = numpy.zeros(count, dtype=numpy.int64)
+  first_tick[series[first]] = times[first]
+  last = numpy.zeros(count, dtype=numpy.int64)
+  nonempty = lengths > 0
+  last[nonempty] = times[(starts + lengths - 1)[nonempty]]
+
+  # Every sample after the first tick has a previous sample in its series.
+  intervals = numpy.zeros(len(times), dtype=numpy.int64)
+  intervals[1:] = times[1:] - times[:-1]
+  stalled = after & (intervals > flow_stats.STALL_GAP_MS)
+  stall_count = numpy.bincount(series[stalled], minlength=count)
+
+  rated = after & (intervals > 0)
+  rates = (amounts[rated] * ml_per_tick[series[rated]] * 1000.0 /
+      intervals[rated])
+  peak = numpy.zeros(count, dtype=numpy.float64)
+  numpy.maximum.at(peak, series[rated], rates)
+
+  ticks = numpy.bincount(series[after], weights=amounts[after],
+      minlength=count)
+  duration = numpy.maximum(last - first_tick, 0)
+
+  ret = []
+  for i in xrange(count):
+    if not has_ticks[i]:
+      ret.append(flow_stats.AnalyzeSeries([], 0.0))
+      continue
+    mean = 0.0
+    if duration[i]:
+      mean = ticks[i] * ml_per_tick[i] * 1000.0 / duration[i]
+    ret.append({
+      'first_tick_ms': int(first_tick[i]),
+      'duration_ms': int(duration[i]),
+      'peak_ml_per_sec': float(peak[i]),
+      'mean_ml_per_sec': float(mean),
+      'stall_count': int(stall_count[i]),
+      'foaming': flow_stats.IsFoaming(peak[i], mean),
+    })
+  return ret
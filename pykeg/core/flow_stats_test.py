@@ -0,0 +1,146 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import unittest
+
+from django.conf import settings
+from django.test import TransactionTestCase
+
+from . import backend
+from . import flow_stats
+from . import models
+from . import time_series
+
+class FlowStatsTestCase(TransactionTestCase):
+  def setUp(self):
+    self.site = models.KegbotSite.objects.create(name='default')
+    self.backend = backend.KegbotBackend(site=self.site)
+    self.tap = self.backend.CreateTap('tap1', 'kegboard.flow0',
+        ml_per_tick=0.5)
+
+  def testAnalyzeSeries(self):
+    pairs = [(0, 0), (100, 10), (200, 20), (300, 20), (1800, 0), (1900, 10),
+        (2000, 100)]
+    ret = flow_stats.AnalyzeSeries(pairs, 0.5)
+    self.assertEquals(100, ret['first_tick_ms'])
+    self.assertEquals(1900, ret['duration_ms'])
+    self.assertEquals(500.0, ret['peak_ml_per_sec'])
+    self.assertAlmostEquals(150 * 0.5 / 1.9, ret['mean_ml_per_sec'])
+    self.assertEquals(1, ret['stall_count'])
+    self.assertTrue(ret['foaming'])
+
+    ret = flow_stats.AnalyzeSeries([(0, 0), (100, 0)], 0.5)
+    self.assertEquals(None, ret['first_tick_ms'])
+    self.assertEquals(flow_stats.AnalyzeSeries([], 0.5), ret)
+
+  @unittest.skipUnless(settings.HAVE_NUMPY, 'NumPy is not installed.')
+  def testNumpyAnalyzeAll(self):
+    from . import flow_stats_numpy
+    rand = random.Random(42)
+    items = [('', 0.5), ('garbage', 0.5), ('0:0 10:0', 0.5), ('5:3', 0.5),
+        ('10:4 5:4 5:0 2000:1', 0.25)]
+    for i in range(50):
+      pairs = []
+      t = 0
+      for j in range(rand.randint(0, 30)):
+        t += rand.choice((0, 10, 50, 100, 1500))
+        pairs.append((t, rand.randint(0, 20)))
+      convert = rand.choice((time_series.to_string,
+          time_series.to_compact_string))
+      items.append((convert(pairs), rand.random()))
+
+    expected = flow_stats.AnalyzeAll(items)
+    actual = flow_stats_numpy.AnalyzeAll(items)
+    self.assertEquals(len(expected), len(actual))
+    for e, a in zip(expected, actual):
+      self.assertEquals(sorted(e.keys()), sorted(a.keys()))
+      for key in e:
+        self.assertAlmostEquals(e[key], a[key])
+    self.assertEquals([], flow_stats_numpy.AnalyzeAll([]))
+
+  def testKegSummary(self):
+    brewer = models.Brewer.objects.create(name='Test Brewer')
+    style = models.BeerStyle.objects.create(name='Test Style')
+    beer_type = models.BeerType.objects.create(name='Test Beer',
+        brewer=brewer, style=style)
+    size = models.KegSize.objects.create(name='Test Size', volume_ml=10000)
+    keg = models.Keg.objects.create(site=self.site, type=beer_type,
+        size=size, status='online')
+    self.tap.current_keg = keg
+    self.tap.save()
+
+    # Each drink pours more slowly than the last.
+    drinks = []
+    for interval in (100, 200, 400):
+      series = ' '.join('%i:10' % (i * interval) for i in range(11))
+      drinks.append(self.backend.RecordDrink('kegboard.flow0', ticks=110,
+          tick_time_series=series, do_postprocess=False))
+    self.backend.RecordDrink('kegboard.flow0', ticks=10,
+        do_postprocess=False)
+
+    with self.assertNumQueries(0):
+      self.assertEquals(0, flow_stats.UpdateDrinks(
+          models.Drink.objects.filter(id__in=[])))
+    # Reads compute missing stats without storing them.
+    summary = flow_stats.GetKegSummary(keg)
+    self.assertFalse(models.DrinkFlowStats.objects.exists())
+    self.assertEquals(summary, flow_stats.GetKegSummary(keg))
+    self.assertEquals(4, flow_stats.UpdateDrinks(keg.drinks.all()))
+    self.assertEquals(summary, flow_stats.GetKegSummary(keg))
+    self.assertEquals(3, summary['num_drinks'])
+    self.assertAlmostEquals(50.0, flow_stats.GetDrinkStats(
+        drinks[0]).mean_ml_per_sec)
+    self.assertAlmostEquals((50.0 + 25.0 + 12.5) / 3,
+        summary['mean_ml_per_sec'])
+    self.assertTrue(summary['drift_percent'] < 0)
+    self.assertEquals(0, summary['foaming_drinks'])
+
+    # Stored stats are not recomputed.
+    with self.assertNumQueries(1):
+      self.assertEquals(0, flow_stats.UpdateDrinks(keg.drinks.all()))
+
+    # A new volume, eg after recalibration, changes the rates.
+    self.backend.SetDrinkVolume(drinks[0].id, drinks[0].volume_ml * 2)
+    self.assertAlmostEquals(100.0, models.DrinkFlowStats.objects.get(
+        drink=drinks[0]).mean_ml_per_sec)
+
+    # Post-processed drinks are analysed as they are recorded.
+    drink = self.backend.RecordDrink('kegboard.flow0', ticks=110,
+        tick_time_series=series)
+    self.assertAlmostEquals(12.5, models.DrinkFlowStats.objects.get(
+        drink=drink).mean_ml_per_sec)
+
+  def testConcurrentUpdate(self):
+    drinks = [self.backend.RecordDrink('kegboard.flow0', ticks=10,
+        tick_time_series='0:5 100:5', do_postprocess=False) for i in range(2)]
+    queryset = models.Drink.objects.filter(id__in=[d.id for d in drinks])
+
+    # Another writer stores one of the records after they were analysed.
+    analyze = flow_stats._Analyze
+    def _Analyze(drinks, use_numpy=None):
+      ret = analyze(drinks, use_numpy)
+      models.DrinkFlowStats.objects.bulk_create(
+          analyze(models.Drink.objects.filter(id=drinks[0].id)))
+      return ret
+    flow_stats._Analyze = _Analyze
+    try:
+      self.assertEquals(1, flow_stats.UpdateDrinks(queryset))
+    finally:
+      flow_stats._Analyze = analyze
+    self.assertEquals(2, models.DrinkFlowStats.objects.count())
@@ -0,0 +1,273 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""In-memory table of pours in progress.
+
+Tap controllers report new meter ticks as a pour goes on.  Each tap's active
+flow is kept only in memory, in its site's FlowTable, so that live volume can
+be shown without touching the database.  A flow ends when it is finished
+explicitly, or after it has been idle for the time given by
+kb_common.AUTH_DEVICE_MAX_IDLE_SECS for the auth device which started it; it
+is then recorded as a drink with journal.RecordDrink(), so that the pour is
+journaled rather than lost if the database is unavailable.
+
+Flows are held by the process which received their updates, so all of a
+site's updates, and any subscribers, must go to a single process: the socket
+ingest server, or a single-process web server.
+"""
+
+import collections
+import datetime
+import logging
+import threading
+import time
+import uuid
+
+from django.utils import timezone
+
+from pykeg.core import backend
+from pykeg.core import journal
+from pykeg.core import kb_common
+from pykeg.core import tap_cache
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for idle flows.
+REAP_INTERVAL_SECS = 1.0
+
+# Number of completed flows kept for subscribers.
+MAX_COMPLETED_FLOWS = 32
+
+_TABLES = {}
+_REAPER = None
+_LOCK = threading.Lock()
+
+
+class Flow(object):
+  """A pour in progress on one tap."""
+  def __init__(self, flow_id, meter_name, ml_per_tick, now, username=None,
+      auth_device=None):
+    self.flow_id = flow_id
+    self.meter_name = meter_name
+    self.ml_per_tick = ml_per_tick
+    self.username = username
+    self.auth_device = auth_device
+    self.ticks = 0
+    self.start = now
+    self.last_activity = now
+    self.pour_key = 'flow-%s' % uuid.uuid4().hex
+    self.state = 'active'
+
+  def MaxIdleSecs(self):
+    idle = kb_common.AUTH_DEVICE_MAX_IDLE_SECS
+    return idle.get(self.auth_device, idle['default'])
+
+  def IsIdle(self, now):
+    return now - self.last_activity > self.MaxIdleSecs()
+
+  def VolumeMl(self):
+    return self.ticks * self.ml_per_tick
+
+  def ToDict(self):
+    return {
+      'id': self.flow_id,
+      'meter_name': self.meter_name,
+      'ticks': self.ticks,
+      'volume_ml': self.VolumeMl(),
+      'username': self.username,
+      'state': self.state,
+      'duration': int(self.last_activity - self.start),
+    }
+
+
+class FlowTable(object):
+  """Active flows for a site, by meter name.
+
+  Every change increments `version`; Wait() blocks until the version passes
+  one a subscriber has already seen.  `on_finish` is called, outside the
+  table's lock, with each flow that ends.
+
+  `tap_lookup` returns the mL per tick of a meter's tap, or None if there is
+  no such tap.  It is called only the first time a meter is seen; live volumes
+  use that calibration, but drinks are recorded from ticks, with the tap's
+  current one.
+  """
+  def __init__(self, tap_lookup, on_finish=None, clock=time.time):
+    self.tap_lookup = tap_lookup
+    self.on_finish = on_finish
+    self.clock = clock
+    self.version = 0
+    self._flows = {}
+    self._completed = collections.deque(maxlen=MAX_COMPLETED_FLOWS)
+    self._ml_per_tick = {}
+    self._next_id = 1
+    self._changed = threading.Condition()
+
+  def _Changed(self):
+    self.version += 1
+    self._changed.notify_all()
+
+  def Update(self, meter_name, ticks, username=None, auth_device=None):
+    """Adds `ticks` new meter ticks to the meter's flow, starting one if needed.
+
+    Returns the flow's state.  Raises ValueError if the meter is unknown, or
+    the number of ticks is implausible.
+    """
+    if ticks < 0 or ticks > kb_common.MAX_METER_READING_DELTA:
+      raise ValueError('Tick delta out of range: %s' % ticks)
+    now = self.clock()
+    finished = None
+    with self._changed:
+      ml_per_tick = self._ml_per_tick.get(meter_name)
+      if ml_per_tick is None:
+        ml_per_tick = self.tap_lookup(meter_name)
+        if ml_per_tick is None:
+          raise ValueError('Unknown meter: %s' % meter_name)
+        self._ml_per_tick[meter_name] = ml_per_tick
+      flow = self._flows.get(meter_name)
+      if flow and username and flow.username and flow.username != username:
+        # A different drinker has taken over the tap.
+        finished = self._Remove(meter_name)
+        flow = None
+      if not flow:
+        flow = Flow(self._next_id, meter_name, ml_per_tick, now, username,
+            auth_device)
+        self._next_id += 1
+        self._flows[meter_name] = flow
+      elif username and not flow.username:
+        flow.username = username
+        flow.auth_device = auth_device
+      flow.ticks += ticks
+      if ticks:
+        flow.last_activity = now
+      self._Changed()
+      ret = flow.ToDict()
+    if finished:
+      self._Finished(finished)
+    return ret
+
+  def Finish(self, meter_name):
+    """Ends the meter's flow; returns its final state, or None if none."""
+    with self._changed:
+      flow = self._Remove(meter_name)
+    if flow:
+      self._Finished(flow)
+      return flow.ToDict()
+    return None
+
+  def Reap(self):
+    """Ends all idle flows; returns their final states."""
+    now = self.clock()
+    with self._changed:
+      idle = [self._Remove(meter_name)
+          for meter_name, flow in self._flows.items() if flow.IsIdle(now)]
+    for flow in idle:
+      self._Finished(flow)
+    return [flow.ToDict() for flow in idle]
+
+  def _Remove(self, meter_name):
+    flow = self._flows.pop(meter_name, None)
+    if flow:
+      flow.state = 'completed'
+      self._Changed()
+      self._completed.append((self.version, flow.ToDict()))
+    return flow
+
+  def _Finished(self, flow):
+    if self.on_finish:
+      try:
+        self.on_finish(flow)
+      except Exception, e:
+        logger.exception('Error finishing flow %s: %s' % (flow.flow_id, e))
+
+  def Flows(self):
+    """Returns the current version and the state of each active flow."""
+    with self._changed:
+      return self.version, [f.ToDict() for f in self._flows.itervalues()]
+
+  def Wait(self, version, timeout):
+    """Waits up to `timeout` seconds for a change after `version`.
+
+    Returns the current version, the state of each active flow, and the final
+    state of each flow completed since `version`.
+    """
+    with self._changed:
+      if self.version <= version:
+        self._changed.wait(timeout)
+      active = [f.ToDict() for f in self._flows.itervalues()]
+      completed = [d for v, d in self._completed if v > version]
+      return self.version, active, completed
+
+
+def RecordFlow(site, flow):
+  """Records a finished flow as a drink; returns the drink, or None if the
+  flow had no ticks or was journaled."""
+  if not flow.ticks:
+    return None
+  b = backend.KegbotBackend(site=site)
+  pour_time = datetime.datetime.fromtimestamp(flow.last_activity,
+      timezone.utc)
+  return journal.RecordDrink(b, tap_name=flow.meter_name, ticks=flow.ticks,
+      username=flow.username, pour_time=pour_time,
+      duration=int(flow.last_activity - flow.start), pour_key=flow.pour_key)
+
+
+def _TapLookup(site):
+  def lookup(meter_name):
+    tap = tap_cache.GetTap(site, meter_name)
+    if tap:
+      return tap.ml_per_tick
+    return None
+  return lookup
+
+
+def NewFlowTable(site):
+  """Returns a new flow table which records the site's flows as drinks."""
+  return FlowTable(_TapLookup(site),
+      on_finish=lambda flow: RecordFlow(site, flow))
+
+
+def GetFlowTable(site):
+  """Returns the site's flow table, starting the reaper thread if needed."""
+  global _REAPER
+  with _LOCK:
+    table = _TABLES.get(site.id)
+    if not table:
+      table = _TABLES[site.id] = NewFlowTable(site)
+    if not _REAPER or not _REAPER.is_alive():
+      _REAPER = Reaper()
+      _REAPER.start()
+    return table
+
+
+class Reaper(threading.Thread):
+  """Background thread which ends idle flows."""
+  def __init__(self):
+    threading.Thread.__init__(self, name='flow-reaper')
+    self.daemon = True
+
+  def run(self):
+    while True:
+      time.sleep(REAP_INTERVAL_SECS)
+      with _LOCK:
+        tables = _TABLES.values()
+      for table in tables:
+        try:
+          table.Reap()
+        except Exception, e:
+          logger.exception('Error reaping flows: %s' % e)
@@ -0,0 +1,103 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from . import flows
+from . import kb_common
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+class FlowTableTestCase(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+    self.finished = []
+    self.lookups = []
+    self.table = flows.FlowTable(self._lookup,
+        on_finish=self.finished.append, clock=self.clock)
+
+  def _lookup(self, meter_name):
+    self.lookups.append(meter_name)
+    if meter_name == 'kegboard.flow0':
+      return 0.5
+    return None
+
+  def testFlows(self):
+    flow = self.table.Update('kegboard.flow0', 100)
+    self.assertEquals(100, flow['ticks'])
+    self.assertEquals(50.0, flow['volume_ml'])
+    self.assertEquals('active', flow['state'])
+
+    self.clock.now += 3
+    flow = self.table.Update('kegboard.flow0', 20, username='user1')
+    self.assertEquals(120, flow['ticks'])
+    self.assertEquals('user1', flow['username'])
+    self.assertEquals(3, flow['duration'])
+    self.assertEquals(['kegboard.flow0'], self.lookups)
+
+    self.assertRaises(ValueError, self.table.Update, 'kegboard.flow1', 10)
+    self.assertRaises(ValueError, self.table.Update, 'kegboard.flow0',
+        kb_common.MAX_METER_READING_DELTA + 1)
+
+    # A different drinker ends the flow and starts another.
+    flow = self.table.Update('kegboard.flow0', 10, username='user2')
+    self.assertEquals(10, flow['ticks'])
+    self.assertEquals(1, len(self.finished))
+    self.assertEquals(120, self.finished[0].ticks)
+    self.assertEquals('user1', self.finished[0].username)
+
+    self.assertEquals(10, self.table.Finish('kegboard.flow0')['ticks'])
+    self.assertEquals(None, self.table.Finish('kegboard.flow0'))
+    self.assertEquals(2, len(self.finished))
+
+  def testIdleTimeout(self):
+    idle = kb_common.AUTH_DEVICE_MAX_IDLE_SECS
+    self.table.Update('kegboard.flow0', 100,
+        auth_device=kb_common.AUTH_MODULE_CORE_ONEWIRE)
+    self.clock.now += idle['default'] + 1
+    self.assertEquals([], self.table.Reap())
+    self.clock.now += idle[kb_common.AUTH_MODULE_CORE_ONEWIRE]
+    reaped = self.table.Reap()
+    self.assertEquals(1, len(reaped))
+    self.assertEquals('completed', reaped[0]['state'])
+    self.assertEquals(1, len(self.finished))
+
+  def testWait(self):
+    version, active, completed = self.table.Wait(-1, 0)
+    self.assertEquals((0, [], []), (version, active, completed))
+    version, active, completed = self.table.Wait(version, 0.01)
+    self.assertEquals((0, [], []), (version, active, completed))
+
+    self.table.Update('kegboard.flow0', 100)
+    version, active, completed = self.table.Wait(version, 0)
+    self.assertEquals(1, version)
+    self.assertEquals([100], [f['ticks'] for f in active])
+
+    self.table.Finish('kegboard.flow0')
+    version, active, completed = self.table.Wait(version, 0)
+    self.assertEquals([], active)
+    self.assertEquals([100], [f['ticks'] for f in completed])
+    self.assertEquals([], self.table.Wait(version, 0)[2])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,202 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Single writer thread for database writes.
+
+SQLite allows one writer at a time, so concurrent pours and sensor readings
+each waiting for their own commit contend for the lock, and may fail with
+"database is locked".  When settings.KEGBOT_INGEST_WRITER is set, KegbotBackend
+hands its writes to the one Writer thread instead, and waits on a Future for
+the result.
+
+The writer takes whatever has queued up since its last batch, and runs
+consecutive operations which share a batch key together, in one transaction:
+several pours become a single KegbotBackend.RecordDrinks() call, for example.
+If a group fails, its operations are retried one by one, so that each caller
+gets its own result or exception.  Part of the group may already have been
+committed by then, eg if it failed while sending notifications, so retries
+must be harmless.
+"""
+
+import logging
+import Queue
+import sys
+import threading
+
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Most operations run in one batch.
+MAX_BATCH = 100
+
+_WRITER = None
+_LOCK = threading.Lock()
+
+
+class TimeoutError(Exception):
+  """The operation did not complete in time."""
+
+
+class Future(object):
+  """The eventual result of an operation run by the writer."""
+  def __init__(self):
+    self._done = threading.Event()
+    self._result = None
+    self._exc_info = None
+    self._callbacks = []
+    self._lock = threading.Lock()
+
+  def SetResult(self, result):
+    self._result = result
+    self._Finish()
+
+  def SetException(self, exc_info):
+    """Sets the exception raised by the operation, as from sys.exc_info()."""
+    self._exc_info = exc_info
+    self._Finish()
+
+  def _Finish(self):
+    with self._lock:
+      self._done.set()
+      callbacks, self._callbacks = self._callbacks, []
+    for callback in callbacks:
+      self._Call(callback)
+
+  def _Call(self, callback):
+    try:
+      callback(self)
+    except Exception, e:
+      logger.exception('Error in future callback: %s' % e)
+
+  def AddDoneCallback(self, callback):
+    """Calls `callback(future)` once the operation completes.
+
+    The callback runs in the writer thread, or at once if already complete.
+    """
+    with self._lock:
+      if not self._done.is_set():
+        self._callbacks.append(callback)
+        return
+    self._Call(callback)
+
+  def Done(self):
+    return self._done.is_set()
+
+  def Result(self, timeout=None):
+    """Waits for the operation, then returns its result or raises its error."""
+    if not self._done.wait(timeout):
+      raise TimeoutError('Operation did not complete in %s seconds' % timeout)
+    if self._exc_info:
+      raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+    return self._result
+
+
+class _Op(object):
+  def __init__(self, func, kwargs, batch_func, batch_key):
+    self.func = func
+    self.kwargs = kwargs
+    self.batch_func = batch_func
+    self.batch_key = batch_key
+    self.future = Future()
+
+
+class Writer(threading.Thread):
+  """Thread which runs all submitted operations, in order."""
+  def __init__(self, max_batch=MAX_BATCH):
+    threading.Thread.__init__(self, name='ingest-writer')
+    self.daemon = True
+    self.max_batch = max_batch
+    self._queue = Queue.Queue()
+
+  def Submit(self, func, kwargs=None, batch_func=None, batch_key=None):
+    """Queues `func(**kwargs)`, returning a Future for its result.
+
+    Consecutive operations with the same non-None `batch_key` may instead be
+    run together, as `batch_func(list_of_kwargs)`, which must return a list
+    of their results.  Changes `batch_func` makes to the dictionaries are
+    kept if the operations are retried one by one.
+    """
+    op = _Op(func, kwargs or {}, batch_func, batch_key)
+    self._queue.put(op)
+    return op.future
+
+  def Quit(self):
+    self._queue.put(None)
+
+  def run(self):
+    while True:
+      op = self._queue.get()
+      if op is None:
+        break
+      batch = [op]
+      while len(batch) < self.max_batch:
+        try:
+          op = self._queue.get_nowait()
+        except Queue.Empty:
+          break
+        if op is None:
+          self._queue.put(None)
+          break
+        batch.append(op)
+      self._RunBatch(batch)
+
+  def _RunBatch(self, batch):
+    group = []
+    for op in batch:
+      if group and (op.batch_key is None or op.batch_key != group[0].batch_key):
+        self._RunGroup(group)
+        group = []
+      group.append(op)
+    self._RunGroup(group)
+
+  def _RunGroup(self, group):
+    if len(group) > 1:
+      try:
+        with transaction.commit_on_success():
+          results = group[0].batch_func([op.kwargs for op in group])
+      except Exception, e:
+        logger.info('Batch of %i failed, retrying singly: %s' % (len(group), e))
+      else:
+        for op, result in zip(group, results):
+          op.future.SetResult(result)
+        return
+
+    for op in group:
+      try:
+        with transaction.commit_on_success():
+          result = op.func(**op.kwargs)
+      except Exception:
+        op.future.SetException(sys.exc_info())
+      else:
+        op.future.SetResult(result)
+
+
+def GetWriter():
+  """Returns the writer, starting it if needed."""
+  global _WRITER
+  with _LOCK:
+    if not _WRITER or not _WRITER.is_alive():
+      _WRITER = Writer()
+      _WRITER.start()
+    return _WRITER
+
+
+def InWriter():
+  """Returns True if called from the writer thread."""
+  return isinstance(threading.current_thread(), Writer)
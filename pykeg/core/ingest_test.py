@@ -0,0 +1,90 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+import unittest
+
+from . import ingest
+
+class IngestTestCase(unittest.TestCase):
+  def setUp(self):
+    self.calls = []
+
+  def _op(self, value):
+    self.calls.append(('op', value))
+    if value < 0:
+      raise ValueError('Negative')
+    return value * 2
+
+  def _batch(self, calls):
+    self.calls.append(('batch', [c['value'] for c in calls]))
+    return [self._op(**c) for c in calls]
+
+  def testWriter(self):
+    writer = ingest.Writer()
+    futures = []
+    # Queued before the writer starts, so that all run as one batch.
+    for value, key in ((1, 'a'), (2, 'a'), (3, None), (4, 'a'), (-5, 'a'),
+        (6, 'a')):
+      futures.append(writer.Submit(self._op, {'value': value}, self._batch,
+          key))
+    writer.start()
+    try:
+      self.assertEquals([2, 4, 6, 8], [f.Result(5) for f in futures[:4]])
+      self.assertRaises(ValueError, futures[4].Result, 5)
+      self.assertEquals(12, futures[5].Result(5))
+    finally:
+      writer.Quit()
+      writer.join(5)
+
+    self.assertEquals([
+      ('batch', [1, 2]), ('op', 1), ('op', 2),
+      ('op', 3),
+      ('batch', [4, -5, 6]), ('op', 4), ('op', -5),
+      ('op', 4), ('op', -5), ('op', 6),
+    ], self.calls)
+
+  def testRetryKeepsBatchChanges(self):
+    def batch(calls):
+      for c in calls:
+        c['value'] += 10
+      raise ValueError('Failed')
+    writer = ingest.Writer()
+    futures = [writer.Submit(self._op, {'value': value}, batch, 'a')
+        for value in (1, 2)]
+    writer.start()
+    try:
+      self.assertEquals([22, 24], [f.Result(5) for f in futures])
+    finally:
+      writer.Quit()
+      writer.join(5)
+
+  def testFuture(self):
+    future = ingest.Future()
+    self.assertFalse(future.Done())
+    self.assertRaises(ingest.TimeoutError, future.Result, 0.01)
+    done = []
+    future.AddDoneCallback(done.append)
+    self.assertEquals([], done)
+    future.SetResult('done')
+    self.assertTrue(future.Done())
+    self.assertEquals('done', future.Result())
+    future.AddDoneCallback(done.append)
+    self.assertEquals([future, future], done)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,367 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Local journal of pours and sensor readings the database could not take.
+
+When settings.KEGBOT_JOURNAL_PATH is set, RecordDrink() and LogSensorReading()
+append to a local, append-only file instead of failing whenever the database
+raises an error, eg because it is locked by a migration or backup.  While
+journaled records are waiting, new ones are journaled too, so they are applied
+in the order they arrived, and without waiting on the database.
+
+A replay thread drains the journal once the database is back; the
+kb_replay_journal command does the same.  Records are applied one at a time and
+the read position is saved after each, so an interrupted replay repeats at most
+one record.  That is harmless: every journaled pour has a pour key, so a
+repeated pour returns the drink already recorded, and a repeated sensor reading
+replaces itself.
+
+Each record is its JSON encoding, preceded by its length and CRC-32.  Appends
+are fsynced in groups: a writer whose record was already synced by another
+writer's fsync does not sync again.  A partial record left by a writer which
+crashed is dropped by the next append, in any process.
+"""
+
+import fcntl
+import logging
+import os
+import struct
+import threading
+import time
+import uuid
+import zlib
+
+from django.conf import settings
+from django.db import transaction
+from django.db.utils import DatabaseError
+from django.utils import timezone
+from kegbot.util import kbjson
+
+from pykeg.core import backend
+from pykeg.core import kb_common
+
+logger = logging.getLogger(__name__)
+
+# Record header: payload length and CRC-32, big-endian.
+_HEADER = struct.Struct('>II')
+
+# Seconds between replay attempts while the database is unavailable.
+RETRY_INTERVAL_SECS = 5.0
+
+_JOURNALS = {}
+_REPLAYER = None
+_LOCK = threading.Lock()
+
+
+class Journal(object):
+  """An append-only file of records, with a saved replay position."""
+  def __init__(self, path):
+    self.path = path
+    self.offset_path = path + '.offset'
+    self.lock_path = path + '.lock'
+    self._file = None
+    self._end = None
+    self._lock = threading.Lock()
+    self._sync_lock = threading.Lock()
+    self._written = 0
+    self._synced = 0
+
+  def _Open(self):
+    if self._file is None:
+      self._file = open(self.path, 'ab')
+      self._end = None
+    return self._file
+
+  def _DropPartialRecord(self, f):
+    """Truncates a partial record left at the end of the file, eg by a writer
+    which crashed.  Must be called with the file locked.
+
+    Only when something else changed the file since this journal's last
+    append are the records waiting to be replayed read again.
+    """
+    size = os.fstat(f.fileno()).st_size
+    if size == self._end:
+      return
+    end = self._ValidEnd()
+    if end < size:
+      logger.warning('Dropping partial record at end of %s' % self.path)
+      f.truncate(end)
+
+  def _ValidEnd(self):
+    offset = self.ReadOffset()
+    with open(self.path, 'rb') as f:
+      f.seek(offset)
+      while True:
+        record, size = _ReadRecord(f)
+        if record is None:
+          return offset
+        offset += size
+
+  def Append(self, record):
+    """Appends a record, returning once it is on disk."""
+    data = kbjson.dumps(record, indent=None)
+    with self._lock:
+      f = self._Open()
+      fcntl.flock(f, fcntl.LOCK_EX)
+      try:
+        self._DropPartialRecord(f)
+        f.write(_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff) + data)
+        f.flush()
+        self._end = os.fstat(f.fileno()).st_size
+      finally:
+        fcntl.flock(f, fcntl.LOCK_UN)
+      self._written += 1
+      seq = self._written
+    self._Sync(seq)
+
+  def _Sync(self, seq):
+    with self._sync_lock:
+      if self._synced >= seq:
+        return
+      with self._lock:
+        target = self._written
+      os.fsync(self._file.fileno())
+      self._synced = target
+
+  def ReadOffset(self):
+    try:
+      with open(self.offset_path) as f:
+        return int(f.read() or 0)
+    except IOError:
+      return 0
+
+  def _WriteOffset(self, offset):
+    tmp_path = self.offset_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+      f.write(str(offset))
+    os.rename(tmp_path, self.offset_path)
+
+  def Pending(self):
+    """Returns True if any records are waiting to be replayed."""
+    try:
+      size = os.path.getsize(self.path)
+    except OSError:
+      return False
+    return size > self.ReadOffset()
+
+  def Replay(self, handler):
+    """Passes each waiting record, in order, to `handler`.
+
+    The replay position is saved after each record is handled; if `handler`
+    raises, replay stops and the record is tried again next time.  Once every
+    record has been replayed, the file is emptied.  Returns the number of
+    records handled, or None if another replay is already running.
+    """
+    with open(self.lock_path, 'a') as lock:
+      try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except IOError:
+        return None
+      if not os.path.exists(self.path):
+        return 0
+      count = 0
+      offset = self.ReadOffset()
+      with open(self.path, 'r+b') as f:
+        f.seek(offset)
+        while True:
+          record, size = _ReadRecord(f)
+          if record is None:
+            break
+          handler(record)
+          offset += size
+          self._WriteOffset(offset)
+          count += 1
+        # Empty the file, unless a record was appended meanwhile.  The offset
+        # is reset first: if interrupted in between, records are replayed
+        # again rather than appended past a stale offset.
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+          if os.fstat(f.fileno()).st_size == offset:
+            self._WriteOffset(0)
+            f.truncate(0)
+        finally:
+          fcntl.flock(f, fcntl.LOCK_UN)
+      return count
+
+
+def _ReadRecord(f):
+  """Reads the record at the current position of `f`.
+
+  Returns the record and its size, or (None, 0) at the end of the file or at a
+  record that is incomplete or corrupt.
+  """
+  header = f.read(_HEADER.size)
+  if len(header) < _HEADER.size:
+    return None, 0
+  length, crc = _HEADER.unpack(header)
+  data = f.read(length)
+  if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+    return None, 0
+  return kbjson.loads(data), _HEADER.size + length
+
+
+def GetJournal():
+  """Returns the configured journal, or None if journaling is disabled."""
+  path = settings.KEGBOT_JOURNAL_PATH
+  if not path:
+    return None
+  with _LOCK:
+    if path not in _JOURNALS:
+      _JOURNALS[path] = Journal(path)
+    return _JOURNALS[path]
+
+
+def RecordDrink(b, **pour):
+  """Records a drink with KegbotBackend `b`, or journals the pour.
+
+  Returns the drink, or None if the pour was journaled.
+  """
+  journal = GetJournal()
+  if not journal:
+    return b.RecordDrink(**pour)
+  if not journal.Pending():
+    try:
+      return b.RecordDrink(**pour)
+    except DatabaseError, e:
+      logger.warning('Journaling pour, database unavailable: %s' % e)
+      transaction.rollback_unless_managed()
+
+  # Fix the time now, and key the pour so a repeated replay is harmless.
+  if not pour.get('pour_time'):
+    pour['pour_time'] = timezone.now()
+  if not pour.get('pour_key'):
+    pour['pour_key'] = 'journal-%s' % uuid.uuid4().hex
+  journal.Append({'kind': 'drink', 'site': b._site.name, 'pour': pour})
+  StartReplayer()
+  return None
+
+
+def LogSensorReading(b, sensor_name, temperature, when=None):
+  """Logs a reading with KegbotBackend `b`, or journals it.
+
+  Returns the Thermolog record, or None if the reading was journaled.
+  """
+  journal = GetJournal()
+  if not journal:
+    return b.LogSensorReading(sensor_name, temperature, when)
+  if not journal.Pending():
+    try:
+      return b.LogSensorReading(sensor_name, temperature, when)
+    except DatabaseError, e:
+      logger.warning('Journaling reading, database unavailable: %s' % e)
+      transaction.rollback_unless_managed()
+
+  min_val, max_val = kb_common.THERMO_SENSOR_RANGE
+  if temperature < min_val or temperature > max_val:
+    raise ValueError('Temperature out of bounds')
+  journal.Append({'kind': 'thermo', 'site': b._site.name,
+    'sensor_name': sensor_name, 'temperature': temperature,
+    'reading_time': when or timezone.now()})
+  StartReplayer()
+  return None
+
+
+def LogSensorReadings(b, readings):
+  """Logs several readings with KegbotBackend `b`, or journals them.
+
+  `readings` are as for KegbotBackend.LogSensorReadings().  Returns the
+  Thermolog records, or None if the readings were journaled.
+  """
+  journal = GetJournal()
+  if not journal:
+    return b.LogSensorReadings(readings)
+  if not journal.Pending():
+    try:
+      return b.LogSensorReadings(readings)
+    except DatabaseError, e:
+      logger.warning('Journaling readings, database unavailable: %s' % e)
+      transaction.rollback_unless_managed()
+
+  min_val, max_val = kb_common.THERMO_SENSOR_RANGE
+  for reading in readings:
+    if reading['temperature'] < min_val or reading['temperature'] > max_val:
+      raise ValueError('Temperature out of bounds')
+  now = timezone.now()
+  for reading in readings:
+    journal.Append({'kind': 'thermo', 'site': b._site.name,
+      'sensor_name': reading['sensor_name'],
+      'temperature': reading['temperature'],
+      'reading_time': reading.get('when') or now})
+  StartReplayer()
+  return None
+
+
+def _ApplyRecord(record):
+  """Applies a journaled record; raises DatabaseError to retry it later."""
+  try:
+    b = backend.KegbotBackend(sitename=record['site'])
+    if record['kind'] == 'drink':
+      pour = dict((str(k), v) for k, v in record['pour'].iteritems())
+      b.RecordDrink(**pour)
+    elif record['kind'] == 'thermo':
+      b.LogSensorReading(record['sensor_name'], record['temperature'],
+          record['reading_time'])
+    else:
+      logger.error('Dropping journaled record of unknown kind: %s' % record)
+  except DatabaseError:
+    transaction.rollback_unless_managed()
+    raise
+  except Exception, e:
+    # Retrying could never succeed, and would hold up every later record.
+    logger.exception('Dropping journaled record %s: %s' % (record, e))
+
+
+def Drain():
+  """Applies all journaled records, in order.
+
+  Returns the number applied, or None if journaling is disabled or another
+  replay is running.  Raises DatabaseError if the database is still
+  unavailable.
+  """
+  journal = GetJournal()
+  if not journal:
+    return None
+  return journal.Replay(_ApplyRecord)
+
+
+class Replayer(threading.Thread):
+  """Background thread which drains the journal, then exits."""
+  def __init__(self):
+    threading.Thread.__init__(self, name='journal-replay')
+    self.daemon = True
+
+  def run(self):
+    journal = GetJournal()
+    while journal and journal.Pending():
+      try:
+        Drain()
+      except DatabaseError, e:
+        logger.info('Database still unavailable: %s' % e)
+      except Exception, e:
+        logger.exception('Error replaying journal: %s' % e)
+      if journal.Pending():
+        time.sleep(RETRY_INTERVAL_SECS)
+
+
+def StartReplayer():
+  """Starts the replay thread, unless it is already running."""
+  global _REPLAYER
+  with _LOCK:
+    if not _REPLAYER or not _REPLAYER.is_alive():
+      _REPLAYER = Replayer()
+      _REPLAYER.start()
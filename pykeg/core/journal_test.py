@@ -0,0 +1,134 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+
+from django.test import TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from . import backend
+from . import journal
+from . import models
+from .testutils import make_datetime
+
+class JournalTestCase(TransactionTestCase):
+  def setUp(self):
+    self.tempdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tempdir, 'journal')
+
+  def tearDown(self):
+    shutil.rmtree(self.tempdir)
+
+  def testAppendAndReplay(self):
+    j = journal.Journal(self.path)
+    self.assertFalse(j.Pending())
+    for i in range(3):
+      j.Append({'kind': 'test', 'value': i})
+    self.assertTrue(j.Pending())
+
+    # A failing handler stops replay at the failed record.
+    seen = []
+    def handler(record):
+      if record['value'] == 1 and not seen.count(1):
+        seen.append(1)
+        raise ValueError('Failed')
+      seen.append(record['value'])
+    self.assertRaises(ValueError, j.Replay, handler)
+    self.assertEquals([0, 1], seen)
+    self.assertTrue(j.Pending())
+
+    self.assertEquals(2, j.Replay(handler))
+    self.assertEquals([0, 1, 1, 2], seen)
+    self.assertFalse(j.Pending())
+    self.assertEquals(0, os.path.getsize(self.path))
+    self.assertEquals(0, j.Replay(handler))
+
+  def testPartialRecord(self):
+    j = journal.Journal(self.path)
+    j.Append({'kind': 'test', 'value': 0})
+    with open(self.path, 'ab') as f:
+      f.write('\x00\x00\x01\x00garbage')
+
+    seen = []
+    handler = lambda record: seen.append(record['value'])
+    self.assertEquals(1, j.Replay(handler))
+    self.assertTrue(j.Pending())
+
+    # The next append drops the partial record.
+    j = journal.Journal(self.path)
+    j.Append({'kind': 'test', 'value': 1})
+    self.assertEquals(1, j.Replay(handler))
+    self.assertEquals([0, 1], seen)
+    self.assertFalse(j.Pending())
+
+    # So does a journal already open, eg in another process.
+    other = journal.Journal(self.path)
+    other.Append({'kind': 'test', 'value': 2})
+    with open(self.path, 'ab') as f:
+      f.write('\x00\x00\x01\x00garbage')
+    j.Append({'kind': 'test', 'value': 3})
+    self.assertEquals(2, j.Replay(handler))
+    self.assertEquals([0, 1, 2, 3], seen)
+    self.assertFalse(j.Pending())
+
+  def testDrain(self):
+    site = models.KegbotSite.objects.create(name='default')
+    b = backend.KegbotBackend(site=site)
+    b.CreateTap('tap1', 'kegboard.flow0', ml_per_tick=1/2200.0)
+    pour_time = make_datetime(2011, 05, 01, 12, 00)
+    reading_time = timezone.now().replace(second=0, microsecond=0)
+
+    with override_settings(KEGBOT_JOURNAL_PATH=self.path):
+      j = journal.GetJournal()
+      j.Append({'kind': 'drink', 'site': 'default', 'pour': {
+        'tap_name': 'kegboard.flow0', 'ticks': 100, 'volume_ml': 100,
+        'pour_time': pour_time, 'pour_key': 'journal-1'}})
+      j.Append({'kind': 'drink', 'site': 'default', 'pour': {
+        'tap_name': 'kegboard.unknown', 'ticks': 100, 'pour_key': 'journal-2'}})
+      j.Append({'kind': 'thermo', 'site': 'default',
+        'sensor_name': 'sensor1', 'temperature': 4.5,
+        'reading_time': reading_time})
+      offset = os.path.getsize(self.path)
+
+      self.assertEquals(3, journal.Drain())
+      self.assertFalse(j.Pending())
+      drink = models.Drink.objects.get()
+      self.assertEquals(pour_time, drink.time)
+      self.assertEquals(100, drink.volume_ml)
+      self.assertEquals(1, models.SystemEvent.objects.filter(
+          kind='drink_poured').count())
+      reading = models.Thermolog.objects.get()
+      self.assertEquals(4.5, reading.temp)
+      self.assertEquals(reading_time, reading.time)
+
+      # An interrupted replay is repeated without duplicates.
+      with open(self.path, 'ab') as f:
+        f.write('x' * offset)
+      j._WriteOffset(offset)
+      j.Append({'kind': 'drink', 'site': 'default', 'pour': {
+        'tap_name': 'kegboard.flow0', 'ticks': 100, 'volume_ml': 100,
+        'pour_time': pour_time, 'pour_key': 'journal-1'}})
+      self.assertEquals(1, journal.Drain())
+      self.assertEquals(1, models.Drink.objects.count())
+      self.assertEquals(1, models.SystemEvent.objects.filter(
+          kind='drink_poured').count())
+
+    self.assertEquals(None, journal.Drain())
@@ -66,6 +66,9 @@ AUTH_DEVICE_MAX_IDLE_SECS = {
   'default': 10
 }
 
+# Number of drinks in a stats scope between stats checkpoints.
+STATS_CHECKPOINT_INTERVAL = 100
+
 # How often to record a thermo reading?
 THERMO_RECORD_DELTA_SECONDS = 60
 
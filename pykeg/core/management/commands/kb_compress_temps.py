@@ -19,34 +19,19 @@
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 
-import datetime
-
-from django.utils import timezone
-from pykeg.core import models
+from pykeg.core import thermo
 
 
 class Command(BaseCommand):
-  help = u'Deletes any old temperature sensor records'
+  help = u'Downsamples old temperature sensor records'
   args = '<none>'
 
   def handle(self, *args, **options):
     if len(args) != 0:
       raise CommandError('No arguments required')
 
-    now = timezone.now()
-
-    # keep at least the most recent 24 hours
-    keep_time = now - datetime.timedelta(hours=24)
-
-    # round down to the start of the day
-    keep_date = datetime.datetime(year=keep_time.year, month=keep_time.month,
-        day=keep_time.day)
-
-    print "Deleting entries older than %s" % keep_date
-
-    for sensor in models.ThermoSensor.objects.all():
-      old_entries = sensor.thermolog_set.filter(time__lt=keep_date).order_by('time')
+    for sensor, num_readings, num_summaries in thermo.Downsample():
       print "Sensor: %s" % sensor
-      print "Deleting %s entries ..." % (old_entries.count())
-      old_entries.delete()
+      print "Summarized %s readings and %s 15-minute summaries" % (
+          num_readings, num_summaries)
       print ""
@@ -0,0 +1,62 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import transaction
+
+from pykeg.core import flow_stats
+from pykeg.core import models
+from pykeg.core.management.commands.common import progbar
+
+
+class Command(BaseCommand):
+  help = u'Computes flow analytics for all drinks which lack them.'
+  args = '<none>'
+  option_list = BaseCommand.option_list + (
+      make_option('-c', '--chunk-size',
+        type='int',
+        dest='chunk_size',
+        default=1000,
+        help='Drinks to analyse in each transaction.'),
+  )
+
+  def handle(self, *args, **options):
+    if len(args) != 0:
+      raise CommandError('No arguments required')
+    chunk_size = options['chunk_size']
+    if chunk_size < 1:
+      raise CommandError('Chunk size must be positive')
+
+    pending = models.Drink.objects.filter(flow_stats__isnull=True)
+    total = pending.count()
+    done = 0
+    last_id = 0
+    while True:
+      ids = list(pending.filter(id__gt=last_id).order_by('id').values_list(
+          'id', flat=True)[:chunk_size])
+      if not ids:
+        break
+      with transaction.commit_on_success():
+        done += flow_stats.UpdateDrinks(models.Drink.objects.filter(id__in=ids))
+      last_id = ids[-1]
+      progbar('analysing drinks', done, total)
+    print ''
+    print 'done!'
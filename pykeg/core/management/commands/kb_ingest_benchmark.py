@@ -0,0 +1,120 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Compares pour throughput with and without the ingest writer."""
+
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+from django.db import connection
+
+from pykeg.core import backend
+from pykeg.core import models
+
+from optparse import make_option
+
+class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+      make_option('-t', '--threads',
+        type='int',
+        dest='threads',
+        default=8,
+        help='Number of concurrent clients.'),
+      make_option('-n', '--count',
+        type='int',
+        dest='count',
+        default=50,
+        help='Number of pours recorded by each client.'),
+      )
+
+  help = (u'Benchmarks recording pours from concurrent clients, with and '
+      'without KEGBOT_INGEST_WRITER, in a scratch test database.')
+  args = '<none>'
+
+  def handle(self, *args, **options):
+    if len(args) != 0:
+      raise CommandError('No arguments required')
+
+    # Threads cannot share an in-memory SQLite database, so use a file.
+    tempdir = None
+    settings_dict = connection.settings_dict
+    if settings_dict['ENGINE'].endswith('sqlite3'):
+      tempdir = tempfile.mkdtemp()
+      settings_dict['TEST_NAME'] = os.path.join(tempdir, 'benchmark.db')
+
+    from south.management.commands import patch_for_test_db_setup
+    patch_for_test_db_setup()
+    old_name = settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+      old_value = settings.KEGBOT_INGEST_WRITER
+      try:
+        for ingest_writer in (False, True):
+          # Each run gets its own site, so it starts without sessions or stats.
+          site = models.KegbotSite.objects.create(
+              name='benchmark%i' % ingest_writer)
+          b = backend.KegbotBackend(site=site)
+          b.CreateTap('tap1', 'benchmark.flow0', ml_per_tick=1/2200.0)
+          b.CreateTap('tap2', 'benchmark.flow1', ml_per_tick=1/2200.0)
+          settings.KEGBOT_INGEST_WRITER = ingest_writer
+          self._Run(site, ingest_writer, options['threads'], options['count'])
+      finally:
+        settings.KEGBOT_INGEST_WRITER = old_value
+    finally:
+      connection.creation.destroy_test_db(old_name, verbosity=0)
+      if tempdir:
+        os.rmdir(tempdir)
+
+  def _Run(self, site, ingest_writer, num_threads, count):
+    errors = []
+    def client(index):
+      b = backend.KegbotBackend(site=site)
+      tap_name = 'benchmark.flow%i' % (index % 2)
+      try:
+        for i in range(count):
+          try:
+            # Every tenth request is a sensor reading, as from a thermo post.
+            if i % 10 == 9:
+              b.LogSensorReading('benchmark-sensor%i' % index, 4.0)
+            else:
+              b.RecordDrink(tap_name, ticks=200)
+          except Exception, e:
+            errors.append(e)
+      finally:
+        connection.close()
+
+    threads = [threading.Thread(target=client, args=(i,))
+        for i in range(num_threads)]
+    start = time.time()
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    elapsed = time.time() - start
+
+    total = num_threads * count
+    mode = 'ingest writer' if ingest_writer else 'per-request commits'
+    print '%-20s %5i requests in %6.2fs: %7.1f/s, %i error(s)' % (
+        mode, total, elapsed, (total - len(errors)) / elapsed, len(errors))
+    if errors:
+      print '  first error: %s' % errors[0]
@@ -0,0 +1,51 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from pykeg.core import deferred
+from pykeg.core import kb_common
+from pykeg.web.api import ingest_server
+
+from optparse import make_option
+
+class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+      make_option('-a', '--addr',
+        dest='addr',
+        default='localhost:%i' % kb_common.JSON_SERVER_PORT_DEFAULT,
+        help='Address to listen on, as host:port.'),
+      )
+
+  help = u'Serves the socket ingest API for tap controllers.'
+  args = '<none>'
+
+  def handle(self, *args, **options):
+    if len(args) != 0:
+      raise CommandError('No arguments required')
+    try:
+      host, port = options['addr'].rsplit(':', 1)
+      port = int(port)
+    except ValueError:
+      raise CommandError('Address must be host:port')
+
+    server = ingest_server.IngestServer(host, port)
+    deferred.StartWorkers()
+    print 'Listening on %s:%i' % (host, port)
+    server.serve_forever()
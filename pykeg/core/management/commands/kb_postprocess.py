@@ -0,0 +1,52 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from pykeg.core import deferred
+from pykeg.core import models
+
+from optparse import make_option
+
+class Command(BaseCommand):
+  option_list = BaseCommand.option_list + (
+      make_option('-w', '--watch',
+        action='store_true',
+        dest='watch',
+        default=False,
+        help='Keep running, processing new drinks as they are queued.'),
+      )
+
+  help = u'Post-processes drinks whose post-processing was deferred.'
+  args = '<none>'
+
+  def handle(self, *args, **options):
+    if len(args) != 0:
+      raise CommandError('No arguments required')
+
+    while True:
+      for site in models.KegbotSite.objects.all():
+        count = deferred.Flush(site)
+        if count:
+          print 'site %s: processed %i drink(s)' % (site, count)
+      if not options['watch']:
+        break
+      time.sleep(deferred.POLL_INTERVAL_SECS)
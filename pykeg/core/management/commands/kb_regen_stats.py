@@ -20,6 +20,7 @@ from django.core.management.base import CommandError
 from django.core.management.base import NoArgsCommand
 
 from pykeg.core import models
+from pykeg.core import stats
 from pykeg.core.management.commands.common import progbar
 
 
@@ -28,58 +29,19 @@ class Command(NoArgsCommand):
   args = '<none>'
 
   def handle(self, **options):
-    models.SystemStats.objects.all().delete()
-    models.KegStats.objects.all().delete()
-    models.UserStats.objects.all().delete()
-    models.SessionStats.objects.all().delete()
-
     for site in models.KegbotSite.objects.all():
       print 'site: %s' % site
       self.handle_site(site)
 
   def handle_site(self, site):
-    drinks = site.drinks.valid()
-
-    last_drinks = drinks.order_by('-time')
-    if last_drinks:
-      progbar('recalc system stats', 0, 1)
-      last_drinks[0]._UpdateSystemStats()
-    progbar('recalc system stats', 1, 1)
-    print ''
-
-    kegs = site.kegs.all()
-    count = kegs.count()
-    pos = 0
-    for k in kegs:
-      pos += 1
-      progbar('recalc keg stats', pos, count)
-      last_drinks = k.drinks.valid().order_by('-time')
-      if last_drinks:
-        last_drinks[0]._UpdateKegStats()
-    print ''
-
-    users = models.User.objects.all()
-    count = users.count()
-    pos = 0
-    for user in users:
-      pos += 1
-      progbar('recalc user stats', pos, count)
-      user_drinks = user.drinks.valid().filter(site=site).order_by('-time')
-      if user_drinks:
-        last = user_drinks[0]
-        last._UpdateUserStats()
-    print ''
+    def progress(pos, total):
+      if pos == total or pos % 100 == 0:
+        progbar('recalc all stats', pos, total)
 
-    sessions = models.DrinkingSession.objects.all()
-    count = sessions.count()
-    pos = 0
-    for session in sessions:
-      pos += 1
-      progbar('recalc session stats', pos, count)
-      session_drinks = session.drinks.valid().filter(site=site).order_by('-time')
-      if session_drinks:
-        last = session_drinks[0]
-        last._UpdateSessionStats()
+    stats.RebuildAllStats(site, progress_cb=progress)
     print ''
-
+    print 'recalc volume rollups'
+    models.VolumeRollup.RebuildAll(site)
+    print 'recalc leaderboards'
+    models.LeaderboardEntry.RebuildAll(site)
     print 'done!'
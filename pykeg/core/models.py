@@ -17,15 +17,22 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
 import datetime
+import operator
 import os
 import random
 
 from django.conf import settings
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
+from django.db import connection
 from django.db import models
+from django.db import transaction
+from django.db.models.signals import post_delete
 from django.db.models.signals import post_save
 from django.db.models.signals import pre_save
+from django.db.utils import IntegrityError
 from django.contrib.sites.models import Site
 from django.contrib.auth.models import User
 from django.utils import timezone
@@ -38,14 +45,12 @@ from pykeg.core import imagespecs
 from pykeg.core import jsonfield
 from pykeg.core import managers
 from pykeg.core import stats
+from pykeg.core import time_series
 from pykeg.core.util import make_serial
 
 from kegbot.util import units
 from kegbot.util import util
 
-from kegbot.api import models_pb2
-from kegbot.api import protoutil
-
 """Django models definition for the kegbot database."""
 
 class KegbotSite(models.Model):
@@ -466,21 +471,8 @@ class Keg(models.Model):
     return sessions
 
   def TopDrinkers(self):
-    stats = self.GetStats()
-    if not stats:
-      return []
-    ret = []
-    entries = stats.get('volume_by_drinker', [])
-    for entry in entries:
-      username = str(entry.username)
-      vol = entry.volume_ml
-      try:
-        user = User.objects.get(username=username)
-      except User.DoesNotExist:
-        continue  # should not happen
-      ret.append((vol, user))
-    ret.sort(reverse=True)
-    return ret
+    return LeaderboardEntry.TopDrinkers(self.site_id, scope='keg', keg=self,
+        limit=None)
 
   def __str__(self):
     return "Keg #%s - %s" % (self.id, self.type)
@@ -528,12 +520,21 @@ def _keg_post_save(sender, instance, **kwargs):
 
 post_save.connect(_keg_post_save, sender=Keg)
 
+def _invalidate_tap_cache(sender, **kwargs):
+  from pykeg.core import tap_cache
+  tap_cache.Invalidate()
+
+for _sender in (KegTap, Keg, SiteSettings, BeerType, KegSize):
+  post_save.connect(_invalidate_tap_cache, sender=_sender)
+  post_delete.connect(_invalidate_tap_cache, sender=_sender)
+
 
 class Drink(models.Model):
   """ Table of drinks records """
   class Meta:
     get_latest_by = 'time'
     ordering = ('-time',)
+    unique_together = ('site', 'pour_key')
 
   @models.permalink
   def get_absolute_url(self):
@@ -551,6 +552,10 @@ class Drink(models.Model):
     ounces = self.Volume().InOunces()
     return self.keg.type.calories_oz * ounces
 
+  def TickTimeSeries(self):
+    """Returns the tick time series as a list of (time, amount) tuples."""
+    return time_series.from_string(self.tick_time_series or '')
+
   def __str__(self):
     return "Drink %s:%i by %s" % (self.site.name, self.id, self.user)
 
@@ -573,12 +578,128 @@ class Drink(models.Model):
       stats, created = SessionStats.objects.get_or_create(session=self.session, site=self.site)
       stats.Update(self)
 
+  def _StatsScopes(self):
+    """Returns (stats model, scope kwargs) for each scope of this drink."""
+    scopes = [(SystemStats, {})]
+    if self.user_id:
+      scopes.append((UserStats, {'user_id': self.user_id}))
+    if self.keg_id:
+      scopes.append((KegStats, {'keg_id': self.keg_id}))
+    if self.session_id:
+      scopes.append((SessionStats, {'session_id': self.session_id}))
+    return scopes
+
+  @classmethod
+  def _UpdateAllStats(cls, drinks):
+    """Adds new drinks, in order, to the system, user, keg and session stats.
+
+    Each affected record is locked and loaded with a single query, updated in
+    memory with every drink in its scope, and written back once with a single
+    UPDATE (or INSERT, for a new scope); any checkpoints due are inserted
+    together at the end.
+    """
+    records = {}
+    checkpoints = []
+    for drink in drinks:
+      for model, kwargs in drink._StatsScopes():
+        key = (model,) + tuple(kwargs.iteritems())
+        record = records.get(key)
+        if record is None:
+          record = model.objects.select_for_update().filter(
+              site=drink.site_id, **kwargs)[:1]
+          if record:
+            record = record[0]
+          else:
+            record = model(site_id=drink.site_id, **kwargs)
+          records[key] = record
+        acc = record._Accumulate(drink)
+        record.stats = acc.ToDict()
+        if acc.total_pours % kb_common.STATS_CHECKPOINT_INTERVAL == 0:
+          checkpoints.append(StatsCheckpoint(site_id=drink.site_id,
+              scope=model.SCOPE, drink=drink, stats=record.stats, **kwargs))
+
+    for record in records.itervalues():
+      if record.id:
+        record.__class__.objects.filter(id=record.id).update(
+            stats=record.stats)
+      else:
+        record.save()
+    if checkpoints:
+      StatsCheckpoint.objects.bulk_create(checkpoints)
+
+  def _StatsRecords(self):
+    """Returns the existing stats records which include this drink."""
+    records = list(SystemStats.objects.filter(site=self.site_id))
+    if self.user_id:
+      records += UserStats.objects.filter(site=self.site_id, user=self.user_id)
+    if self.keg_id:
+      records += KegStats.objects.filter(site=self.site_id, keg=self.keg_id)
+    if self.session_id:
+      records += SessionStats.objects.filter(site=self.site_id,
+          session=self.session_id)
+    return records
+
+  def _InvalidateCheckpoints(self):
+    """Deletes stats checkpoints which include this drink."""
+    scopes = models.Q(scope='system')
+    if self.user_id:
+      scopes |= models.Q(scope='user', user=self.user_id)
+    if self.keg_id:
+      scopes |= models.Q(scope='keg', keg=self.keg_id)
+    if self.session_id:
+      scopes |= models.Q(scope='session', session=self.session_id)
+    StatsCheckpoint.objects.filter(scopes, site=self.site_id,
+        drink__gte=self.id).delete()
+
+  def RemoveFromStats(self):
+    """Retracts this drink, once no longer valid, from all stats."""
+    self._InvalidateCheckpoints()
+    for record in self._StatsRecords():
+      record.RemoveDrink(self)
+    VolumeRollup.RemoveDrink(self)
+    LeaderboardEntry.RemoveDrink(self)
+
+  def SetVolume(self, volume_ml):
+    """Changes the volume of this drink, updating its session and stats."""
+    old_volume_ml = self.volume_ml
+    self.volume_ml = volume_ml
+    self.save()
+    # Flow rates depend on the volume.
+    from pykeg.core import flow_stats
+    DrinkFlowStats.objects.filter(drink=self.id).delete()
+    flow_stats.UpdateDrinks(Drink.objects.filter(id=self.id))
+    if self.session_id:
+      self.session.RebuildForDrink(self)
+    self._InvalidateCheckpoints()
+    for record in self._StatsRecords():
+      record.ChangeDrinkVolume(self, old_volume_ml)
+    VolumeRollup.ChangeDrinkVolume(self, old_volume_ml)
+    LeaderboardEntry.ChangeDrinkVolume(self, old_volume_ml)
+
   def PostProcess(self):
-    self._UpdateSystemStats()
-    self._UpdateUserStats()
-    self._UpdateKegStats()
-    self._UpdateSessionStats()
-    SystemEvent.ProcessDrink(self)
+    """Updates stats, rollups, leaderboards and events for a new drink.
+
+    All of the work is done in a single transaction.
+    """
+    Drink.PostProcessAll([self])
+
+  @classmethod
+  def PostProcessAll(cls, drinks):
+    """Post-processes several new drinks, in order, in one transaction.
+
+    This is equivalent to calling PostProcess() on each drink, except that
+    each stats record is loaded and saved only once, and the rollups and
+    leaderboard entries of all the drinks are written together.
+    """
+    from pykeg.core import flow_stats
+    with transaction.commit_on_success():
+      cls._UpdateAllStats(drinks)
+      VolumeRollup.ProcessDrinks(drinks)
+      LeaderboardEntry.ProcessDrinks(drinks)
+      flow_stats.UpdateDrinks(Drink.objects.filter(
+          id__in=[drink.id for drink in drinks]))
+      for drink in drinks:
+        SystemEvent.ProcessDrink(drink)
 
   objects = managers.DrinkManager()
 
@@ -596,6 +717,9 @@ class Drink(models.Model):
   duration = models.PositiveIntegerField(blank=True, default=0)
   user = models.ForeignKey(User, null=True, blank=True, related_name='drinks')
   keg = models.ForeignKey(Keg, null=True, blank=True, related_name='drinks')
+  tap = models.ForeignKey(KegTap, null=True, blank=True,
+      on_delete=models.SET_NULL, related_name='drinks',
+      help_text='Tap the drink was poured from, if known.')
   status = models.CharField(max_length=128, choices = (
      ('valid', 'valid'),
      ('invalid', 'invalid'),
@@ -607,6 +731,48 @@ class Drink(models.Model):
       help_text='Comment from the drinker at the time of the pour.')
   tick_time_series = models.TextField(blank=True, null=True, editable=False,
       help_text='Tick update sequence that generated this drink')
+  pour_key = models.CharField(max_length=64, blank=True, null=True,
+      editable=False,
+      help_text='Client-supplied key for the pour, used to ignore retries.')
+
+
+class PendingDrink(models.Model):
+  """A recorded drink whose post-processing has been deferred.
+
+  Each site's pending drinks are processed, and their rows deleted, in id
+  order; see pykeg.core.deferred.
+  """
+  site = models.ForeignKey(KegbotSite, related_name='pending_drinks')
+  drink = models.OneToOneField(Drink, related_name='pending')
+  time = models.DateTimeField(default=timezone.now,
+      help_text='Time the drink was queued for post-processing.')
+
+  def __str__(self):
+    return 'PendingDrink for %s' % self.drink_id
+
+
+class DrinkFlowStats(models.Model):
+  """Flow analytics of a drink, computed from its tick time series.
+
+  Computed once per drink by pykeg.core.flow_stats as the drink is
+  post-processed, and again if its volume changes.  Drinks with no ticks in their time series get a record
+  without `first_tick_ms`, so that they are not analysed again.
+  """
+  site = models.ForeignKey(KegbotSite, related_name='drink_flow_stats')
+  drink = models.OneToOneField(Drink, related_name='flow_stats')
+  first_tick_ms = models.PositiveIntegerField(blank=True, null=True,
+      help_text='Time of the first meter tick, from the start of the series.')
+  duration_ms = models.PositiveIntegerField(default=0,
+      help_text='Time from the first meter tick to the last.')
+  peak_ml_per_sec = models.FloatField(default=0)
+  mean_ml_per_sec = models.FloatField(default=0)
+  stall_count = models.PositiveIntegerField(default=0,
+      help_text='Number of pauses in the flow.')
+  foaming = models.BooleanField(default=False,
+      help_text='Whether the flow rate was erratic enough to suggest foam.')
+
+  def __str__(self):
+    return 'DrinkFlowStats for %s' % self.drink_id
 
 
 class AuthenticationToken(models.Model):
@@ -662,6 +828,14 @@ def _auth_token_pre_save(sender, instance, **kwargs):
 
 pre_save.connect(_auth_token_pre_save, sender=AuthenticationToken)
 
+def _invalidate_token_cache(sender, **kwargs):
+  from pykeg.core import token_cache
+  token_cache.Invalidate()
+
+for _sender in (AuthenticationToken, User, UserProfile):
+  post_save.connect(_invalidate_token_cache, sender=_sender)
+  post_delete.connect(_invalidate_token_cache, sender=_sender)
+
 class _AbstractChunk(models.Model):
   class Meta:
     abstract = True
@@ -675,8 +849,9 @@ class _AbstractChunk(models.Model):
   def Duration(self):
     return self.end_time - self.start_time
 
-  def _AddDrinkNoSave(self, drink):
-    session_delta = drink.site.settings.GetSessionTimeoutDelta()
+  def _AddDrinkNoSave(self, drink, session_delta=None):
+    if session_delta is None:
+      session_delta = drink.site.settings.GetSessionTimeoutDelta()
     session_end = drink.time + session_delta
 
     if self.start_time > drink.time:
@@ -685,11 +860,14 @@ class _AbstractChunk(models.Model):
       self.end_time = session_end
     self.volume_ml += drink.volume_ml
 
-  def AddDrink(self, drink):
-    self._AddDrinkNoSave(drink)
+  def AddDrink(self, drink, session_delta=None):
+    self._AddDrinkNoSave(drink, session_delta)
     self.save()
 
 
+# Cache key of a site's current session pointer; see DrinkingSession.
+CURRENT_SESSION_KEY = 'kegbot:current_session:%s'
+
 class DrinkingSession(_AbstractChunk):
   """A collection of contiguous drinks. """
   class Meta:
@@ -789,29 +967,39 @@ class DrinkingSession(_AbstractChunk):
         # Not yet saved.
         return 'New Session'
 
-  def AddDrink(self, drink):
-    super(DrinkingSession, self).AddDrink(drink)
-    session_delta = drink.site.settings.GetSessionTimeoutDelta()
+  def AddDrink(self, drink, session_delta=None):
+    if session_delta is None:
+      session_delta = drink.site.settings.GetSessionTimeoutDelta()
+    super(DrinkingSession, self).AddDrink(drink, session_delta)
+    self._AddDrinkToChunks(drink, session_delta)
 
+  def _AddDrinkToChunks(self, drink, session_delta):
     defaults = {
       'start_time': drink.time,
       'end_time': drink.time + session_delta,
     }
 
+    # Each chunk is known to exist once fetched, so is saved with a bare
+    # UPDATE.
+    fields = ('start_time', 'end_time', 'volume_ml')
+
     # Update or create a SessionChunk.
     chunk, created = SessionChunk.objects.get_or_create(session=self,
         user=drink.user, keg=drink.keg, defaults=defaults)
-    chunk.AddDrink(drink)
+    chunk._AddDrinkNoSave(drink, session_delta)
+    chunk.save(update_fields=fields)
 
     # Update or create a UserSessionChunk.
     chunk, created = UserSessionChunk.objects.get_or_create(session=self,
         site=drink.site, user=drink.user, defaults=defaults)
-    chunk.AddDrink(drink)
+    chunk._AddDrinkNoSave(drink, session_delta)
+    chunk.save(update_fields=fields)
 
     # Update or create a KegSessionChunk.
     chunk, created = KegSessionChunk.objects.get_or_create(session=self,
         site=drink.site, keg=drink.keg, defaults=defaults)
-    chunk.AddDrink(drink)
+    chunk._AddDrinkNoSave(drink, session_delta)
+    chunk.save(update_fields=fields)
 
   def UserChunksByVolume(self):
     chunks = self.user_chunks.all().order_by('-volume_ml')
@@ -848,31 +1036,233 @@ class DrinkingSession(_AbstractChunk):
     self.end_time = max_time + session_delta
     self.save()
 
+  def RebuildForDrink(self, drink):
+    """Recomputes the parts of this session affected by a changed drink.
+
+    Unlike Rebuild(), only the chunks containing `drink` are recomputed, each
+    with a single aggregate query.  Use this when a drink has been cancelled
+    or its volume changed.
+
+    A session left without valid drinks is kept, with no volume, as is done
+    by Rebuild().  Stats are not updated here: stats bucket drinks by their
+    session's start time (see StatsAccumulator), so when the first drink of a
+    session is cancelled, the remaining drinks stay under the weekday of the
+    old start time until the stats are rebuilt with kb_regen_stats.
+    """
+    session_delta = self.site.settings.GetSessionTimeoutDelta()
+    drinks = self.drinks.valid()
+
+    def _Recompute(record, qs):
+      """Updates volume and times from `qs`; returns False if it is empty."""
+      agg = qs.aggregate(models.Count('id'), models.Sum('volume_ml'),
+          models.Min('time'), models.Max('time'))
+      if not agg['id__count']:
+        return False
+      record.volume_ml = agg['volume_ml__sum']
+      record.start_time = agg['time__min']
+      record.end_time = agg['time__max'] + session_delta
+      return True
+
+    chunks = (
+      (SessionChunk.objects.filter(session=self, user=drink.user_id,
+          keg=drink.keg_id), drinks.filter(user=drink.user_id, keg=drink.keg_id)),
+      (UserSessionChunk.objects.filter(session=self, user=drink.user_id),
+          drinks.filter(user=drink.user_id)),
+      (KegSessionChunk.objects.filter(session=self, keg=drink.keg_id),
+          drinks.filter(keg=drink.keg_id)),
+    )
+    for chunk_qs, drink_qs in chunks:
+      for chunk in chunk_qs:
+        if _Recompute(chunk, drink_qs):
+          chunk.save()
+        else:
+          chunk.delete()
+
+    if _Recompute(self, drinks):
+      self.save()
+    else:
+      self.volume_ml = 0
+      self.save()
+
+  @classmethod
+  def AssignSessionsForDrinks(cls, drinks):
+    """Assigns sessions to new drinks, in order.
+
+    Sessions are chosen just as by AssignSessionForDrink(), but each session
+    and chunk is loaded and saved only once.  The drinks themselves are not
+    saved.
+    """
+    if not drinks:
+      return
+    site = drinks[0].site
+    session_delta = site.settings.GetSessionTimeoutDelta()
+    latest = site.sessions.all().order_by('-end_time')[:1]
+    current = latest[0] if latest else None
+    sessions = []
+    chunks = {}
+
+    def _AddToChunk(model, drink, **kwargs):
+      key = (model,) + tuple((k, getattr(v, 'id', None))
+          for k, v in sorted(kwargs.iteritems()))
+      chunk = chunks.get(key)
+      if chunk is None:
+        defaults = {
+          'start_time': drink.time,
+          'end_time': drink.time + session_delta,
+        }
+        chunk, created = model.objects.get_or_create(defaults=defaults,
+            **kwargs)
+        chunks[key] = chunk
+      chunk._AddDrinkNoSave(drink)
+
+    for drink in drinks:
+      if drink.session:
+        continue
+      if not current or not current.IsActive(drink.time):
+        current = cls(start_time=drink.time, end_time=drink.time, site=site)
+        current.save()
+      if current not in sessions:
+        sessions.append(current)
+      current._AddDrinkNoSave(drink)
+      drink.session = current
+      _AddToChunk(SessionChunk, drink, session=current, user=drink.user,
+          keg=drink.keg)
+      _AddToChunk(UserSessionChunk, drink, session=current, site=site,
+          user=drink.user)
+      _AddToChunk(KegSessionChunk, drink, session=current, site=site,
+          keg=drink.keg)
+
+    for record in sessions + chunks.values():
+      record.save()
+
+  @classmethod
+  def _LoadCurrent(cls, site):
+    """Reads the site's latest session into its current session pointer."""
+    pointer = {
+      'session': None,
+      'timeout': site.settings.GetSessionTimeoutDelta(),
+    }
+    latest = site.sessions.all().order_by('-end_time')[:1]
+    if latest:
+      pointer['session'] = dict((f.attname, getattr(latest[0], f.attname))
+          for f in cls._meta.fields)
+    cache.set(CURRENT_SESSION_KEY % site.id, pointer)
+    return pointer
+
+  @classmethod
+  def _GetCurrent(cls, site, when):
+    """Returns the site's current session pointer.
+
+    The pointer, kept in Django's cache, holds the fields of the site's
+    latest session and the site's session timeout.  It is dropped whenever a
+    session or the site's settings are saved or deleted, other than by
+    AssignSessionForDrink(), which keeps it up to date itself.  If it shows
+    no session active at `when`, it is reloaded, in case it is stale.
+    """
+    pointer = cache.get(CURRENT_SESSION_KEY % site.id)
+    if pointer is None or not pointer['session'] or \
+        when >= pointer['session']['end_time']:
+      pointer = cls._LoadCurrent(site)
+    return pointer
+
+  @classmethod
+  def GetCurrent(cls, site):
+    """Returns the site's active session, or None."""
+    now = timezone.now()
+    fields = cls._GetCurrent(site, now)['session']
+    if fields and now < fields['end_time']:
+      return cls(**fields)
+    return None
+
+  @classmethod
+  def _ContinueSession(cls, pointer, drink):
+    """Adds the drink to the pointer's session if it is active; returns the
+    session, or None.
+
+    Usually this takes a single UPDATE.  The update only applies if it moves
+    neither the session's start nor its end back, which would happen if the
+    session changed since the pointer was read, eg by a pour in another
+    process.  The session is then read again, and the update retried.
+    """
+    fields = pointer['session']
+    for attempt in range(3):
+      if not fields or drink.time >= fields['end_time']:
+        return None
+      fields = dict(fields)
+      fields['start_time'] = min(fields['start_time'], drink.time)
+      fields['end_time'] = max(fields['end_time'],
+          drink.time + pointer['timeout'])
+      fields['volume_ml'] += drink.volume_ml
+      updated = cls.objects.filter(id=fields['id'],
+          start_time__gte=fields['start_time'],
+          end_time__lte=fields['end_time']).update(
+          volume_ml=models.F('volume_ml') + drink.volume_ml,
+          start_time=fields['start_time'], end_time=fields['end_time'])
+      if updated:
+        return cls(**fields)
+      rows = cls.objects.filter(id=fields['id']).values()
+      fields = rows[0] if rows else None
+    return None
+
+  @classmethod
+  def _StorePointer(cls, site, session, timeout):
+    """Caches the pointer to `session`, unless the cached pointer is to a
+    session ending later, eg as written meanwhile by another process."""
+    key = CURRENT_SESSION_KEY % site.id
+    cached = cache.get(key)
+    if cached and cached['session'] and cached['timeout'] == timeout and \
+        cached['session']['end_time'] > session.end_time:
+      return
+    fields = dict((f.attname, getattr(session, f.attname))
+        for f in cls._meta.fields)
+    cache.set(key, {'session': fields, 'timeout': timeout})
+
   @classmethod
   def AssignSessionForDrink(cls, drink):
+    """Assigns the drink to the site's active session, or to a new one, and
+    saves it.
+
+    Continuing a session takes one UPDATE of the session, found from the
+    cached pointer; each of its three chunks is then read and updated (or
+    inserted), and the drink saved.  A stale pointer costs another query or
+    two, and is otherwise harmless.
+    """
     # Return existing session if already assigned.
-    if drink.session:
+    if drink.session_id:
       return drink.session
 
-    # Return last session if one already exists
-    q = drink.site.sessions.all().order_by('-end_time')[:1]
-    if q and q[0].IsActive(drink.time):
-      session = q[0]
-      session.AddDrink(drink)
-      drink.session = session
-      drink.save()
-      return session
-
-    # Create a new session
-    session = cls(start_time=drink.time, end_time=drink.time,
-        site=drink.site)
-    session.save()
-    session.AddDrink(drink)
+    site = drink.site
+    pointer = cls._GetCurrent(site, drink.time)
+    session = cls._ContinueSession(pointer, drink)
+    if not session and pointer['session'] and \
+        drink.time < pointer['session']['end_time']:
+      # The pointed-to session is gone; the pointer was stale.
+      pointer = cls._LoadCurrent(site)
+      session = cls._ContinueSession(pointer, drink)
+
+    session_delta = pointer['timeout']
+    if session:
+      session._AddDrinkToChunks(drink, session_delta)
+    else:
+      # Create a new session
+      session = cls(start_time=drink.time, end_time=drink.time, site=site)
+      session.save()
+      session.AddDrink(drink, session_delta)
+
     drink.session = session
     drink.save()
+    cls._StorePointer(site, session, session_delta)
     return session
 
 
+def _drop_current_session(sender, instance, **kwargs):
+  cache.delete(CURRENT_SESSION_KEY % instance.site_id)
+
+for _sender in (DrinkingSession, SiteSettings):
+  post_save.connect(_drop_current_session, sender=_sender)
+  post_delete.connect(_drop_current_session, sender=_sender)
+
+
 class SessionChunk(_AbstractChunk):
   """A specific user and keg contribution to a session."""
   class Meta:
@@ -962,21 +1352,166 @@ class Thermolog(models.Model):
     return util.CtoF(self.temp)
 
 
+class ThermoSummary(models.Model):
+  """Minimum, average and maximum of a sensor's readings over a period.
+
+  Thermolog readings are downsampled to these by kb_compress_temps; see
+  pykeg.core.thermo.
+  """
+  class Meta:
+    get_latest_by = 'time'
+    ordering = ('-time',)
+    unique_together = ('sensor', 'period', 'time')
+
+  site = models.ForeignKey(KegbotSite, related_name='thermosummaries')
+  sensor = models.ForeignKey(ThermoSensor)
+  period = models.PositiveIntegerField(
+      help_text='Length of the period, in seconds.')
+  time = models.DateTimeField(help_text='Start of the period.')
+  num_readings = models.PositiveIntegerField(default=0)
+  min_temp = models.FloatField()
+  avg_temp = models.FloatField()
+  max_temp = models.FloatField()
+
+  def __str__(self):
+    return '%s %.2f/%.2f/%.2f C [%s +%is]' % (self.sensor, self.min_temp,
+        self.avg_temp, self.max_temp, self.time, self.period)
+
+  def Merge(self, num_readings, min_temp, avg_temp, max_temp):
+    """Adds a summary of more readings to this one."""
+    total = self.num_readings + num_readings
+    if self.num_readings:
+      self.avg_temp = (self.avg_temp * self.num_readings +
+          avg_temp * num_readings) / total
+      self.min_temp = min(self.min_temp, min_temp)
+      self.max_temp = max(self.max_temp, max_temp)
+    else:
+      self.avg_temp = avg_temp
+      self.min_temp = min_temp
+      self.max_temp = max_temp
+    self.num_readings = total
+
+
 class _StatsModel(models.Model):
   STATS_BUILDER = None
 
+  # Name of this record's scope in StatsCheckpoint.
+  SCOPE = None
+
   class Meta:
     abstract = True
 
+  def _ScopeKwargs(self):
+    """Returns filter arguments selecting this record's scope."""
+    return {}
+
+  def _ScopeDrinks(self):
+    return Drink.objects.valid().filter(site=self.site_id,
+        **self._ScopeKwargs())
+
+  def Checkpoints(self):
+    return StatsCheckpoint.objects.filter(site=self.site_id, scope=self.SCOPE,
+        **self._ScopeKwargs())
+
+  def _Accumulate(self, drink, force=False):
+    """Returns a StatsAccumulator of these stats with `drink` added."""
+    if force or not self.stats:
+      return self._AccumulateFromCheckpoint(drink)
+    try:
+      return self.STATS_BUILDER(drink, self.stats).Accumulate()
+    except ValueError:
+      # Malformed stats; rebuild from scratch.
+      return self._AccumulateFromCheckpoint(drink)
+
   def Update(self, drink, force=False):
-    previous = None
+    acc = self._Accumulate(drink, force)
+    self.stats = acc.ToDict()
+    self.save()
+    if acc.total_pours % kb_common.STATS_CHECKPOINT_INTERVAL == 0:
+      StatsCheckpoint.objects.create(site_id=self.site_id, scope=self.SCOPE,
+          drink=drink, stats=self.stats, **self._ScopeKwargs())
+
+  def RemoveDrink(self, drink):
+    """Retracts `drink`, which must no longer be valid, from these stats.
+
+    The record is deleted if no drinks remain in its scope.
+    """
     try:
-      if not force and self.stats:
-        previous = protoutil.DictToProtoMessage(self.stats, models_pb2.Stats())
-    except TypeError, e:
-      pass
-    builder = self.STATS_BUILDER(drink, previous)
-    self.stats = protoutil.ProtoMessageToDict(builder.Build())
+      acc = self.STATS_BUILDER(drink, self.stats).Remove()
+    except ValueError:
+      # Malformed stats; rebuild from scratch.
+      acc = self._Rebuild()
+    self._SaveOrDelete(acc)
+
+  def ChangeDrinkVolume(self, drink, old_volume_ml):
+    """Updates these stats after `drink` changed from `old_volume_ml`."""
+    try:
+      acc = self.STATS_BUILDER(drink, self.stats).ChangeVolume(old_volume_ml)
+    except ValueError:
+      # Malformed stats; rebuild from scratch.
+      acc = self._Rebuild()
+    self._SaveOrDelete(acc)
+
+  def StatsAsOf(self, drink_id=None, time=None):
+    """Returns a copy of this record with stats as of an earlier point.
+
+    The copy, which is not saved, includes the drinks in scope up to
+    `drink_id` and/or poured at or before `time`.  Returns None if there were
+    no such drinks.
+    """
+    drinks = self._ScopeDrinks()
+    if drink_id is not None:
+      drinks = drinks.filter(id__lte=drink_id)
+    if time is not None:
+      drinks = drinks.filter(time__lte=time)
+    drinks = drinks.order_by('-id')[:1]
+    if not drinks:
+      return None
+    ret = copy.copy(self)
+    ret.id = None
+    ret.stats = self._AccumulateFromCheckpoint(drinks[0]).ToDict()
+    return ret
+
+  def PourDistributions(self):
+    """Returns percentiles and histograms of pour volumes and durations.
+
+    See stats.StatsAccumulator.DistributionSummaries().  For stats stored
+    before these distributions were kept, they are computed from the scope's
+    drinks, but not saved; kb_regen_stats stores them.
+    """
+    try:
+      acc = stats.StatsAccumulator.FromDict(self.stats)
+    except ValueError:
+      acc = None
+    if not acc or acc.pour_volumes is None:
+      acc = self._Rebuild()
+    return acc.DistributionSummaries()
+
+  def _AccumulateFromCheckpoint(self, drink):
+    """Returns a StatsAccumulator for this scope up to and including `drink`.
+
+    Only drinks after the latest checkpoint at or before `drink` are read.
+    """
+    checkpoints = self.Checkpoints().filter(drink__lte=drink.id)
+    checkpoints = checkpoints.order_by('-drink__id')[:1]
+    if checkpoints:
+      try:
+        return self.STATS_BUILDER(drink, checkpoints[0].stats).Replay()
+      except ValueError:
+        pass
+    return self.STATS_BUILDER(drink).Accumulate()
+
+  def _Rebuild(self):
+    drinks = self._ScopeDrinks().order_by('-id')[:1]
+    if not drinks:
+      return stats.StatsAccumulator()
+    return self._AccumulateFromCheckpoint(drinks[0])
+
+  def _SaveOrDelete(self, acc):
+    if not acc.total_pours:
+      self.delete()
+      return
+    self.stats = acc.ToDict()
     self.save()
 
   site = models.ForeignKey(KegbotSite)
@@ -986,6 +1521,7 @@ class _StatsModel(models.Model):
 
 class SystemStats(_StatsModel):
   STATS_BUILDER = stats.SystemStatsBuilder
+  SCOPE = 'system'
 
   def __str__(self):
     return 'SystemStats for %s' % self.site
@@ -995,29 +1531,689 @@ class UserStats(_StatsModel):
   class Meta:
     unique_together = ('site', 'user')
   STATS_BUILDER = stats.DrinkerStatsBuilder
+  SCOPE = 'user'
   user = models.ForeignKey(User, blank=True, null=True, related_name='stats')
 
   def __str__(self):
     return 'UserStats for %s' % self.user
 
+  def _ScopeKwargs(self):
+    return {'user_id': self.user_id}
+
 
 class KegStats(_StatsModel):
   STATS_BUILDER = stats.KegStatsBuilder
+  SCOPE = 'keg'
   keg = models.ForeignKey(Keg, unique=True, related_name='stats')
   completed = models.BooleanField(default=False)
 
   def __str__(self):
     return 'KegStats for %s' % self.keg
 
+  def _ScopeKwargs(self):
+    return {'keg_id': self.keg_id}
+
 
 class SessionStats(_StatsModel):
   STATS_BUILDER = stats.SessionStatsBuilder
+  SCOPE = 'session'
   session = models.ForeignKey(DrinkingSession, unique=True, related_name='stats')
   completed = models.BooleanField(default=False)
 
   def __str__(self):
     return 'SessionStats for %s' % self.session
 
+  def _ScopeKwargs(self):
+    return {'session_id': self.session_id}
+
+
+class StatsCheckpoint(models.Model):
+  """A snapshot of a stats record, taken every few drinks in its scope.
+
+  Rebuilding stats, or computing them as of an earlier drink, only needs to
+  replay the drinks after the nearest checkpoint.
+  """
+  site = models.ForeignKey(KegbotSite, related_name='stats_checkpoints')
+  scope = models.CharField(max_length=16, choices = (
+      ('system', 'system'),
+      ('user', 'user'),
+      ('keg', 'keg'),
+      ('session', 'session'),
+    ))
+  user = models.ForeignKey(User, blank=True, null=True,
+      related_name='stats_checkpoints')
+  keg = models.ForeignKey(Keg, blank=True, null=True,
+      related_name='stats_checkpoints')
+  session = models.ForeignKey(DrinkingSession, blank=True, null=True,
+      related_name='stats_checkpoints')
+  drink = models.ForeignKey(Drink, related_name='stats_checkpoints',
+      help_text='Last drink included in the stats.')
+  stats = jsonfield.JSONField()
+
+  def __str__(self):
+    return 'StatsCheckpoint for %s %s at drink %s' % (self.site, self.scope,
+        self.drink_id)
+
+
+def _BulkUpdate(model, instances, fields):
+  """Writes `fields` of several saved instances with a single UPDATE."""
+  if not instances:
+    return
+  qn = connection.ops.quote_name
+  pk = model._meta.pk
+  assignments = []
+  params = []
+  for name in fields:
+    field = model._meta.get_field(name)
+    cases = []
+    for instance in instances:
+      cases.append('WHEN %s THEN %s')
+      params.append(instance.pk)
+      params.append(field.get_db_prep_save(getattr(instance, name),
+          connection=connection))
+    assignments.append('%s = CASE %s %s END' % (qn(field.column),
+        qn(pk.column), ' '.join(cases)))
+  params.extend(instance.pk for instance in instances)
+  sql = 'UPDATE %s SET %s WHERE %s IN (%s)' % (qn(model._meta.db_table),
+      ', '.join(assignments), qn(pk.column),
+      ', '.join(['%s'] * len(instances)))
+  connection.cursor().execute(sql, params)
+  transaction.commit_unless_managed()
+
+
+def _RetryOnIntegrityError(func, *args):
+  """Calls `func` in a savepoint, calling it again if it raises IntegrityError.
+
+  For writers which insert rows only after finding them missing: a concurrent
+  writer may insert the same rows first, in which case the second call finds
+  them.  `func` must do its inserts before any other write.
+  """
+  for attempt in range(3):
+    sid = transaction.savepoint()
+    try:
+      ret = func(*args)
+      transaction.savepoint_commit(sid)
+      return ret
+    except IntegrityError:
+      transaction.savepoint_rollback(sid)
+      if attempt == 2:
+        raise
+
+
+def _LocalPeriodStart(when, period):
+  """Returns the start of the hour, day, month or year containing `when`.
+
+  Periods follow the local time zone.
+  """
+  tz = timezone.get_current_timezone()
+  local = timezone.localtime(when, tz).replace(tzinfo=None, minute=0,
+      second=0, microsecond=0)
+  if period in ('day', 'month', 'year'):
+    local = local.replace(hour=0)
+  if period in ('month', 'year'):
+    local = local.replace(day=1)
+  if period == 'year':
+    local = local.replace(month=1)
+  elif period not in ('hour', 'day', 'month'):
+    raise ValueError('Unknown period: %s' % period)
+  return tz.normalize(tz.localize(local))
+
+
+class VolumeRollup(models.Model):
+  """Total volume and number of pours within an hour or a day.
+
+  Rollups are kept for the whole site, and for each keg, user and tap.  They
+  are updated as drinks are recorded, so that totals over a time range can be
+  read from a handful of rows rather than by scanning drinks.
+  """
+  class Meta:
+    unique_together = ('site', 'scope_key', 'granularity', 'start_time')
+    ordering = ('start_time',)
+
+  GRANULARITIES = ('hour', 'day')
+
+  site = models.ForeignKey(KegbotSite, related_name='volume_rollups')
+  scope = models.CharField(max_length=16, choices = (
+      ('system', 'system'),
+      ('keg', 'keg'),
+      ('user', 'user'),
+      ('tap', 'tap'),
+    ))
+  keg = models.ForeignKey(Keg, blank=True, null=True,
+      related_name='volume_rollups')
+  user = models.ForeignKey(User, blank=True, null=True,
+      related_name='volume_rollups')
+  tap = models.ForeignKey(KegTap, blank=True, null=True,
+      related_name='volume_rollups')
+  # Unlike the nullable keg, user and tap columns, this can be covered by a
+  # unique index; see _ScopeKey.
+  scope_key = models.CharField(max_length=32, editable=False,
+      help_text='Scope and the id of its keg, user or tap, eg "keg:12".')
+  granularity = models.CharField(max_length=8,
+      choices=[(g, g) for g in GRANULARITIES])
+  start_time = models.DateTimeField(
+      help_text='Start of the hour or day, in the local time zone.')
+  volume_ml = models.FloatField(default=0)
+  pours = models.IntegerField(default=0)
+
+  # Prefix sums over the scope's rollups of the same granularity, so that the
+  # total for any range needs only its two end points.
+  cumulative_volume_ml = models.FloatField(default=0,
+      help_text='Volume of this and all earlier rollups.')
+  cumulative_pours = models.IntegerField(default=0,
+      help_text='Pours in this and all earlier rollups.')
+
+  def __str__(self):
+    return 'VolumeRollup for %s %s (%s of %s)' % (self.site, self.scope,
+        self.granularity, self.start_time)
+
+  @classmethod
+  def BucketStart(cls, when, granularity):
+    """Returns the start of the hour or day containing `when`."""
+    if granularity not in cls.GRANULARITIES:
+      raise ValueError('Unknown granularity: %s' % granularity)
+    return _LocalPeriodStart(when, granularity)
+
+  @classmethod
+  def _ScopeKwargs(cls, keg=None, user=None, tap=None):
+    """Returns (scope, filter kwargs) for at most one of keg, user or tap."""
+    if len([o for o in (keg, user, tap) if o is not None]) > 1:
+      raise ValueError('At most one of keg, user or tap may be given.')
+    if keg is not None:
+      return 'keg', {'keg': keg}
+    if user is not None:
+      return 'user', {'user': user}
+    if tap is not None:
+      return 'tap', {'tap': tap}
+    return 'system', {}
+
+  @classmethod
+  def _ScopeKey(cls, scope, kwargs):
+    """Returns the scope_key for a scope, as returned by _ScopeKwargs."""
+    for value in kwargs.itervalues():
+      return '%s:%s' % (scope, getattr(value, 'id', value))
+    return scope
+
+  @classmethod
+  def _DrinkScopes(cls, drink):
+    scopes = [cls._ScopeKwargs()]
+    if drink.keg_id:
+      scopes.append(cls._ScopeKwargs(keg=drink.keg_id))
+    if drink.user_id:
+      scopes.append(cls._ScopeKwargs(user=drink.user_id))
+    if drink.tap_id:
+      scopes.append(cls._ScopeKwargs(tap=drink.tap_id))
+    return scopes
+
+  @classmethod
+  def _Apply(cls, changes):
+    """Applies (drink, volume_ml, pours) changes to the drinks' rollups.
+
+    Drinks must belong to the same site.  However many drinks there are, the
+    rollups are read with at most two queries and written with at most one
+    INSERT, one UPDATE and one DELETE.
+    """
+    _RetryOnIntegrityError(cls._ApplyOnce, changes)
+
+  @classmethod
+  def _ApplyOnce(cls, changes):
+    site_id = changes[0][0].site_id
+    deltas = {}
+    for drink, volume_ml, pours in changes:
+      for granularity in cls.GRANULARITIES:
+        start_time = cls.BucketStart(drink.time, granularity)
+        for scope, kwargs in cls._DrinkScopes(drink):
+          key = (cls._ScopeKey(scope, kwargs), granularity, start_time)
+          delta = deltas.setdefault(key, [scope, kwargs, 0.0, 0])
+          delta[2] += volume_ml
+          delta[3] += pours
+
+    # Rollups are read from the oldest bucket changed in each granularity;
+    # each series (scope and granularity) is sorted oldest first.
+    since = {}
+    for scope_key, granularity, start_time in deltas:
+      since[granularity] = min(since.get(granularity, start_time), start_time)
+    scope_rollups = cls.objects.filter(site=site_id,
+        scope_key__in=set(key[0] for key in deltas))
+    recent = models.Q()
+    for granularity, start_time in since.iteritems():
+      recent |= models.Q(granularity=granularity, start_time__gte=start_time)
+    series = {}
+    existing = {}
+    for rollup in scope_rollups.select_for_update().filter(recent).order_by(
+        'start_time'):
+      key = (rollup.scope_key, rollup.granularity)
+      series.setdefault(key, []).append(rollup)
+      existing[key + (rollup.start_time,)] = rollup
+
+    # A new rollup carries on from the cumulative sums of the rollup before
+    # it, which, if older than all the drinks, is found by a second query.
+    # Cumulative sums never decrease, so the latest is also the largest.
+    new_keys = sorted(key for key, delta in deltas.iteritems()
+        if key not in existing and delta[3] > 0)
+    earlier = {}
+    if new_keys:
+      older = models.Q()
+      for granularity, start_time in since.iteritems():
+        older |= models.Q(granularity=granularity, start_time__lt=start_time)
+      rows = scope_rollups.filter(older).values('scope_key',
+          'granularity').annotate(models.Max('cumulative_volume_ml'),
+          models.Max('cumulative_pours'))
+      for row in rows:
+        earlier[(row['scope_key'], row['granularity'])] = (
+            row['cumulative_volume_ml__max'], row['cumulative_pours__max'])
+
+    new_rollups = []
+    for key in new_keys:
+      scope, kwargs = deltas[key][:2]
+      cumulative_volume_ml, cumulative_pours = earlier.get(key[:2], (0.0, 0))
+      for rollup in series.get(key[:2], []):
+        if rollup.start_time >= key[2]:
+          break
+        cumulative_volume_ml = rollup.cumulative_volume_ml
+        cumulative_pours = rollup.cumulative_pours
+      rollup = cls(site_id=site_id, scope=scope, scope_key=key[0],
+          granularity=key[1], start_time=key[2],
+          cumulative_volume_ml=cumulative_volume_ml,
+          cumulative_pours=cumulative_pours)
+      for field, value in kwargs.iteritems():
+        setattr(rollup, field + '_id', value)
+      new_rollups.append(rollup)
+    for rollup in new_rollups:
+      series.setdefault((rollup.scope_key, rollup.granularity), []).append(
+          rollup)
+
+    # Each delta counts towards its own rollup and the cumulative sums of
+    # every later one.  Usually there are none, since drinks tend to arrive
+    # in time order.
+    changed = {}
+    for (scope_key, granularity, start_time), delta in deltas.iteritems():
+      volume_ml, pours = delta[2:]
+      for rollup in series.get((scope_key, granularity), []):
+        if rollup.start_time == start_time:
+          rollup.volume_ml += volume_ml
+          rollup.pours += pours
+        if rollup.start_time >= start_time:
+          rollup.cumulative_volume_ml += volume_ml
+          rollup.cumulative_pours += pours
+          if rollup.id:
+            changed[rollup.id] = rollup
+
+    if new_rollups:
+      cls.objects.bulk_create(new_rollups)
+    emptied = [rollup.id for key, rollup in existing.iteritems()
+        if key in deltas and rollup.pours <= 0]
+    _BulkUpdate(cls, [rollup for rollup in changed.itervalues()
+        if rollup.id not in emptied], ('volume_ml', 'pours',
+        'cumulative_volume_ml', 'cumulative_pours'))
+    if emptied:
+      cls.objects.filter(id__in=emptied).delete()
+
+  @classmethod
+  def _CumulativeBefore(cls, rollups, when):
+    """Returns cumulative (volume_ml, pours) of `rollups` starting before
+    `when`, or of all of them if `when` is None."""
+    if when is not None:
+      rollups = rollups.filter(start_time__lt=when)
+    rows = rollups.order_by('-start_time').values_list('cumulative_volume_ml',
+        'cumulative_pours')[:1]
+    if rows:
+      return rows[0]
+    return (0.0, 0)
+
+  @classmethod
+  def ProcessDrinks(cls, drinks):
+    """Adds newly recorded drinks, all of one site, to their rollups."""
+    if drinks:
+      cls._Apply([(drink, drink.volume_ml, 1) for drink in drinks])
+
+  @classmethod
+  def ProcessDrink(cls, drink):
+    """Adds a newly recorded drink to its rollups."""
+    cls.ProcessDrinks([drink])
+
+  @classmethod
+  def RemoveDrink(cls, drink):
+    """Retracts a drink, once no longer valid, from its rollups."""
+    cls._Apply([(drink, -drink.volume_ml, -1)])
+
+  @classmethod
+  def ChangeDrinkVolume(cls, drink, old_volume_ml):
+    cls._Apply([(drink, drink.volume_ml - old_volume_ml, 0)])
+
+  @classmethod
+  def RebuildAll(cls, site):
+    """Regenerates all rollups for `site` from its valid drinks."""
+    totals = {}
+    rows = site.drinks.valid().values_list('volume_ml', 'time', 'keg_id',
+        'user_id', 'tap_id')
+    for volume_ml, time, keg_id, user_id, tap_id in rows.iterator():
+      scopes = [('system', None, None, None)]
+      if keg_id:
+        scopes.append(('keg', keg_id, None, None))
+      if user_id:
+        scopes.append(('user', None, user_id, None))
+      if tap_id:
+        scopes.append(('tap', None, None, tap_id))
+      for granularity in cls.GRANULARITIES:
+        start_time = cls.BucketStart(time, granularity)
+        for scope in scopes:
+          key = scope + (granularity, start_time)
+          total = totals.setdefault(key, [0.0, 0])
+          total[0] += volume_ml
+          total[1] += 1
+
+    rollups = []
+    cumulative = {}
+    for key in sorted(totals):
+      volume_ml, pours = totals[key]
+      scope, keg_id, user_id, tap_id, granularity, start_time = key
+      running = cumulative.setdefault(key[:5], [0.0, 0])
+      running[0] += volume_ml
+      running[1] += pours
+      scope_key = scope
+      if scope != 'system':
+        scope_key = '%s:%s' % (scope, keg_id or user_id or tap_id)
+      rollups.append(cls(site=site, scope=scope, scope_key=scope_key,
+          keg_id=keg_id, user_id=user_id, tap_id=tap_id, granularity=granularity,
+          start_time=start_time, volume_ml=volume_ml, pours=pours,
+          cumulative_volume_ml=running[0], cumulative_pours=running[1]))
+
+    with transaction.commit_on_success():
+      cls.objects.filter(site=site).delete()
+      cls.objects.bulk_create(rollups)
+
+  @classmethod
+  def Buckets(cls, site, granularity, since=None, until=None, keg=None,
+      user=None, tap=None):
+    """Returns the rollups starting in [since, until), oldest first.
+
+    Rollups are for the whole site unless one of `keg`, `user` or `tap` (an
+    instance or id) is given.  Hours or days without drinks are absent.
+    """
+    scope, kwargs = cls._ScopeKwargs(keg=keg, user=user, tap=tap)
+    qs = cls.objects.filter(site=site, scope_key=cls._ScopeKey(scope, kwargs),
+        granularity=granularity)
+    if since is not None:
+      qs = qs.filter(start_time__gte=since)
+    if until is not None:
+      qs = qs.filter(start_time__lt=until)
+    return qs.order_by('start_time')
+
+  @classmethod
+  def Totals(cls, site, since=None, until=None, granularity='day', keg=None,
+      user=None, tap=None):
+    """Returns total (volume_ml, pours) of the rollups in [since, until).
+
+    `since` and `until` should fall on `granularity` boundaries (see
+    BucketStart); a bucket is counted if it starts within the range.  Only two
+    rollups are read, whatever the size of the range.
+    """
+    qs = cls.Buckets(site, granularity, keg=keg, user=user, tap=tap)
+    end_volume_ml, end_pours = cls._CumulativeBefore(qs, until)
+    start_volume_ml, start_pours = 0.0, 0
+    if since is not None:
+      start_volume_ml, start_pours = cls._CumulativeBefore(qs, since)
+    return (end_volume_ml - start_volume_ml, end_pours - start_pours)
+
+  @classmethod
+  def Window(cls, name, now=None):
+    """Returns (since, until) for a window named in WINDOWS, ending now.
+
+    `until` is None, meaning open-ended.  Raises ValueError for an unknown
+    name.
+    """
+    if now is None:
+      now = timezone.now()
+    if name in cls.RECENT_WINDOWS:
+      since = now - cls.RECENT_WINDOWS[name]
+      return cls.BucketStart(since, 'hour'), None
+
+    periods = {
+      'today': 'day',
+      'this_month': 'month',
+      'this_year': 'year',
+    }
+    if name not in periods:
+      raise ValueError('Unknown window: %s' % name)
+    return _LocalPeriodStart(now, periods[name]), None
+
+  RECENT_WINDOWS = {
+    'last_24h': datetime.timedelta(hours=24),
+    'last_7d': datetime.timedelta(days=7),
+    'last_30d': datetime.timedelta(days=30),
+  }
+  WINDOWS = ('today', 'this_month', 'this_year') + tuple(sorted(RECENT_WINDOWS))
+
+  @classmethod
+  def WindowStats(cls, site, since=None, until=None, keg=None, user=None,
+      tap=None):
+    """Returns a dict of totals for drinks in [since, until).
+
+    The bounds are rounded down to the hour.
+    """
+    if since is not None:
+      since = cls.BucketStart(since, 'hour')
+    if until is not None:
+      until = cls.BucketStart(until, 'hour')
+    volume_ml, pours = cls.Totals(site, since=since, until=until,
+        granularity='hour', keg=keg, user=user, tap=tap)
+    ret = {
+      'total_volume_ml': volume_ml,
+      'total_pours': pours,
+      'average_volume_ml': volume_ml / pours if pours else 0.0,
+    }
+    if since is not None:
+      ret['since'] = since
+    if until is not None:
+      ret['until'] = until
+    return ret
+
+
+class LeaderboardEntry(models.Model):
+  """A drinker's total volume in some scope, for ranking drinkers.
+
+  Entries are kept for the whole site, for each keg and session, and for each
+  calendar month and year; they are updated as drinks are recorded.  Guest
+  pours are not ranked.
+  """
+  class Meta:
+    unique_together = ('site', 'scope_key', 'user')
+
+  SCOPES = ('system', 'keg', 'session', 'month', 'year')
+
+  site = models.ForeignKey(KegbotSite, related_name='leaderboard_entries')
+  scope = models.CharField(max_length=16, choices=[(s, s) for s in SCOPES])
+  keg = models.ForeignKey(Keg, blank=True, null=True,
+      related_name='leaderboard_entries')
+  session = models.ForeignKey(DrinkingSession, blank=True, null=True,
+      related_name='leaderboard_entries')
+  period_start = models.DateTimeField(blank=True, null=True,
+      help_text='Start of the month or year, for those scopes.')
+  # Unlike the nullable keg, session and period_start columns, this can be
+  # covered by a unique index.
+  scope_key = models.CharField(max_length=32, editable=False,
+      help_text='Scope and its keg, session or period, eg "month:2013-05".')
+  user = models.ForeignKey(User, related_name='leaderboard_entries')
+  volume_ml = models.FloatField(default=0)
+  pours = models.IntegerField(default=0)
+
+  def __str__(self):
+    return 'LeaderboardEntry for %s in %s %s' % (self.user, self.site,
+        self.scope)
+
+  @classmethod
+  def _ScopeKwargs(cls, scope, keg=None, session=None, when=None):
+    """Returns filter arguments selecting the entries of a scope."""
+    kwargs = {'scope': scope, 'keg_id': None, 'session_id': None,
+        'period_start': None, 'scope_key': scope}
+    if scope == 'keg':
+      kwargs['keg_id'] = getattr(keg, 'id', keg)
+      kwargs['scope_key'] = 'keg:%s' % kwargs['keg_id']
+    elif scope == 'session':
+      kwargs['session_id'] = getattr(session, 'id', session)
+      kwargs['scope_key'] = 'session:%s' % kwargs['session_id']
+    elif scope in ('month', 'year'):
+      start = _LocalPeriodStart(when or timezone.now(), scope)
+      kwargs['period_start'] = start
+      kwargs['scope_key'] = '%s:%s' % (scope,
+          start.strftime('%Y-%m' if scope == 'month' else '%Y'))
+    elif scope != 'system':
+      raise ValueError('Unknown scope: %s' % scope)
+    return kwargs
+
+  @classmethod
+  def _DrinkScopes(cls, drink):
+    scopes = [cls._ScopeKwargs('system')]
+    if drink.keg_id:
+      scopes.append(cls._ScopeKwargs('keg', keg=drink.keg_id))
+    if drink.session_id:
+      scopes.append(cls._ScopeKwargs('session', session=drink.session_id))
+    scopes.append(cls._ScopeKwargs('month', when=drink.time))
+    scopes.append(cls._ScopeKwargs('year', when=drink.time))
+    return scopes
+
+  @classmethod
+  def _Apply(cls, changes):
+    """Applies (drink, volume_ml, pours) changes to the drinkers' entries.
+
+    Drinks must belong to the same site.  However many drinks there are, the
+    entries are read with one query and written with at most one INSERT, one
+    UPDATE and one DELETE.
+    """
+    _RetryOnIntegrityError(cls._ApplyOnce, changes)
+
+  @classmethod
+  def _ApplyOnce(cls, changes):
+    site_id = changes[0][0].site_id
+    deltas = {}
+    for drink, volume_ml, pours in changes:
+      if not drink.user_id:
+        continue
+      for kwargs in cls._DrinkScopes(drink):
+        key = (drink.user_id, kwargs['scope_key'])
+        delta = deltas.setdefault(key, [kwargs, 0.0, 0])
+        delta[1] += volume_ml
+        delta[2] += pours
+    if not deltas:
+      return
+
+    entries = cls.objects.select_for_update().filter(site=site_id,
+        user__in=set(key[0] for key in deltas),
+        scope_key__in=set(key[1] for key in deltas))
+    existing = dict(((entry.user_id, entry.scope_key), entry)
+        for entry in entries)
+    new_entries = []
+    changed = []
+    emptied = []
+    for key, (kwargs, volume_ml, pours) in deltas.iteritems():
+      entry = existing.get(key)
+      if entry is None:
+        if pours > 0:
+          new_entries.append(cls(site_id=site_id, user_id=key[0],
+              volume_ml=volume_ml, pours=pours, **kwargs))
+        continue
+      entry.volume_ml += volume_ml
+      entry.pours += pours
+      if entry.pours <= 0:
+        emptied.append(entry.id)
+      else:
+        changed.append(entry)
+
+    if new_entries:
+      cls.objects.bulk_create(new_entries)
+    _BulkUpdate(cls, changed, ('volume_ml', 'pours'))
+    if emptied:
+      cls.objects.filter(id__in=emptied).delete()
+
+  @classmethod
+  def ProcessDrinks(cls, drinks):
+    """Adds newly recorded drinks, all of one site, to their drinkers'
+    entries."""
+    if drinks:
+      cls._Apply([(drink, drink.volume_ml, 1) for drink in drinks])
+
+  @classmethod
+  def ProcessDrink(cls, drink):
+    """Adds a newly recorded drink to its drinker's entries."""
+    cls.ProcessDrinks([drink])
+
+  @classmethod
+  def RemoveDrink(cls, drink):
+    """Retracts a drink, once no longer valid, from its drinker's entries."""
+    cls._Apply([(drink, -drink.volume_ml, -1)])
+
+  @classmethod
+  def ChangeDrinkVolume(cls, drink, old_volume_ml):
+    cls._Apply([(drink, drink.volume_ml - old_volume_ml, 0)])
+
+  @classmethod
+  def RebuildAll(cls, site):
+    """Regenerates all leaderboard entries for `site` from its valid drinks."""
+    totals = {}
+    rows = site.drinks.valid().filter(user__isnull=False).values_list(
+        'volume_ml', 'time', 'user_id', 'keg_id', 'session_id')
+    for volume_ml, time, user_id, keg_id, session_id in rows.iterator():
+      drink = Drink(volume_ml=volume_ml, time=time, user_id=user_id,
+          keg_id=keg_id, session_id=session_id)
+      for kwargs in cls._DrinkScopes(drink):
+        key = (user_id,) + tuple(sorted(kwargs.iteritems()))
+        total = totals.setdefault(key, [0.0, 0])
+        total[0] += volume_ml
+        total[1] += 1
+
+    entries = []
+    for key, (volume_ml, pours) in totals.iteritems():
+      entries.append(cls(site=site, user_id=key[0], volume_ml=volume_ml,
+          pours=pours, **dict(key[1:])))
+    with transaction.commit_on_success():
+      cls.objects.filter(site=site).delete()
+      cls.objects.bulk_create(entries)
+
+  @classmethod
+  def Leaders(cls, site, scope='system', keg=None, session=None, when=None,
+      limit=10):
+    """Returns the top `limit` entries of a scope, largest volume first.
+
+    `when` selects the month or year for those scopes, defaulting to now.
+    Entries come with their users, profiles and mugshots, from a single
+    query.
+    """
+    kwargs = cls._ScopeKwargs(scope, keg=keg, session=session, when=when)
+    entries = cls.objects.filter(site=site, **kwargs)
+    entries = entries.select_related('user', 'user__userprofile',
+        'user__userprofile__mugshot')
+    entries = list(entries.order_by('-volume_ml', 'user__username')[:limit])
+    for entry in entries:
+      # Lets User.get_profile() use the profile which was just loaded.
+      try:
+        entry.user._profile_cache = entry.user.userprofile
+      except UserProfile.DoesNotExist:
+        pass
+    return entries
+
+  @classmethod
+  def TopDrinkers(cls, site, limit=10, **scope):
+    """Returns (volume_ml, user) tuples of Leaders(); see that method."""
+    return [(e.volume_ml, e.user) for e in cls.Leaders(site, limit=limit,
+        **scope)]
+
+  @classmethod
+  def GetEntry(cls, site, user, scope='system', keg=None, session=None,
+      when=None):
+    """Returns the user's entry in a scope, or None."""
+    kwargs = cls._ScopeKwargs(scope, keg=keg, session=session, when=when)
+    try:
+      return cls.objects.get(site=site, user=user, **kwargs)
+    except cls.DoesNotExist:
+      return None
+
+  def Rank(self):
+    """Returns the 1-based rank of this entry.  Equal volumes share a rank."""
+    siblings = LeaderboardEntry.objects.filter(site=self.site_id,
+        scope_key=self.scope_key)
+    return siblings.filter(volume_ml__gt=self.volume_ml).count() + 1
+
 
 class SystemEvent(models.Model):
   class Meta:
@@ -1085,38 +2281,42 @@ class SystemEvent(models.Model):
 
   @classmethod
   def ProcessDrink(cls, drink):
+    """Creates the events for a drink which do not already exist.
+
+    Existing events are found with a single query, and new ones inserted
+    with another.
+    """
     keg = drink.keg
     session = drink.session
     site = drink.site
     user = drink.user
 
+    # Candidate events, in the order they are to be created, each with the
+    # filter matching an existing equivalent.
+    candidates = []
     if keg:
-      q = keg.events.filter(kind='keg_tapped')
-      if q.count() == 0:
-        e = keg.events.create(site=site, kind='keg_tapped', time=drink.time,
-            keg=keg, user=user, drink=drink, session=session)
-        e.save()
-
+      candidates.append((models.Q(kind='keg_tapped', keg=keg),
+          cls(site=site, kind='keg_tapped', time=drink.time, keg=keg,
+              user=user, drink=drink, session=session)))
     if session:
-      q = session.events.filter(kind='session_started')
-      if q.count() == 0:
-        e = session.events.create(site=site, kind='session_started',
-            time=session.start_time, drink=drink, user=user)
-        e.save()
-
+      candidates.append((models.Q(kind='session_started', session=session),
+          cls(site=site, kind='session_started', time=session.start_time,
+              drink=drink, user=user, session=session)))
     if user:
-      q = user.events.filter(kind='session_joined', session=session)
-      if q.count() == 0:
-        e = user.events.create(site=site, kind='session_joined',
-            time=drink.time, session=session, drink=drink, user=user)
-        e.save()
-
-    q = drink.events.filter(kind='drink_poured')
-    if q.count() == 0:
-      e = drink.events.create(site=site, kind='drink_poured',
-          time=drink.time, drink=drink, user=user, keg=keg,
-          session=session)
-      e.save()
+      candidates.append((
+          models.Q(kind='session_joined', user=user, session=session),
+          cls(site=site, kind='session_joined', time=drink.time,
+              session=session, drink=drink, user=user)))
+    candidates.append((models.Q(kind='drink_poured', drink=drink),
+        cls(site=site, kind='drink_poured', time=drink.time, drink=drink,
+            user=user, keg=keg, session=session)))
+
+    query = reduce(operator.or_, (q for q, event in candidates))
+    existing = set(cls.objects.filter(query).values_list('kind', flat=True))
+    new_events = [event for q, event in candidates
+        if event.kind not in existing]
+    if new_events:
+      cls.objects.bulk_create(new_events)
 
 
 def _pics_file_name(instance, filename):
@@ -22,6 +22,7 @@ import datetime
 import unittest
 
 from django.conf import settings
+from django.test import TransactionTestCase
 from django.utils import timezone
 
 from . import backend
@@ -30,6 +31,7 @@ from . import models
 from .testutils import make_datetime
 
 from kegbot.util import units
+from pykeg.proto import protolib
 
 class CoreModelsTestCase(unittest.TestCase):
   def setUp(self):
@@ -123,6 +125,18 @@ class CoreModelsTestCase(unittest.TestCase):
 
     self.assertEqual(self.keg.served_volume(), d.volume_ml)
 
+  def testLegacyTimeSeries(self):
+    d = self.backend.RecordDrink(tap_name=self.tap.meter_name, ticks=100,
+        username=self.user.username, tick_time_series='0:10 5:20',
+        pour_time=make_datetime(2000, 4, 2))
+    self.assertEqual('0:10 5:20', protolib.ToProto(d).tick_time_series)
+
+    # Series stored before they were validated are returned unparsed.
+    models.Drink.objects.filter(id=d.id).update(tick_time_series='0:105:20')
+    d = models.Drink.objects.get(id=d.id)
+    self.assertRaises(ValueError, d.TickTimeSeries)
+    self.assertEqual('0:105:20', protolib.ToProto(d).tick_time_series)
+
   def testDrinkSessions(self):
     """ Checks for the DrinkingSession records. """
     u1 = self.user
@@ -224,3 +238,69 @@ class CoreModelsTestCase(unittest.TestCase):
     self.assertEqual(all_groups[1].start_time, base_time+td_190m)
     self.assertEqual(all_groups[1].end_time, base_time+td_200m)
     self.assertEqual(all_groups[1].user_chunks.all().count(), 2)
+
+
+class DrinkingSessionTestCase(TransactionTestCase):
+  def setUp(self):
+    self.site, created = models.KegbotSite.objects.get_or_create(
+        name='default')
+    self.backend = backend.KegbotBackend(site=self.site)
+    self.backend.CreateTap('tap1', 'kegboard.flow0', ml_per_tick=1/2200.0)
+
+  def _drink(self, minutes, volume_ml=100):
+    """Returns a new drink, without a session."""
+    drink = self.backend._MakeDrink('kegboard.flow0', ticks=volume_ml,
+        volume_ml=volume_ml,
+        pour_time=timezone.now() + datetime.timedelta(minutes=minutes))
+    drink.save()
+    return drink
+
+  def testCurrentSession(self):
+    self.assertEqual(None, models.DrinkingSession.GetCurrent(self.site))
+    session = models.DrinkingSession.AssignSessionForDrink(self._drink(-10))
+
+    # Continuing the session needs no lookup of it, or of the site settings:
+    # one UPDATE for the session, then a SELECT and an UPDATE for each chunk,
+    # and two queries for the drink.
+    drink = self._drink(-5)
+    with self.assertNumQueries(9):
+      self.assertEqual(session.id,
+          models.DrinkingSession.AssignSessionForDrink(drink).id)
+    with self.assertNumQueries(0):
+      current = models.DrinkingSession.GetCurrent(self.site)
+    self.assertEqual(session.id, current.id)
+    self.assertEqual(200, current.volume_ml)
+    self.assertEqual(current.end_time, models.DrinkingSession.objects.get(
+        id=session.id).end_time)
+    self.assertEqual(200, models.DrinkingSession.objects.get(
+        id=session.id).volume_ml)
+
+    # A stale pointer never moves the session's end back, eg after another
+    # process extended it.
+    end_time = current.end_time + datetime.timedelta(minutes=30)
+    models.DrinkingSession.objects.filter(id=session.id).update(
+        end_time=end_time)
+    models.DrinkingSession.AssignSessionForDrink(self._drink(-4))
+    self.assertEqual(end_time, models.DrinkingSession.objects.get(
+        id=session.id).end_time)
+    self.assertEqual(300, models.DrinkingSession.objects.get(
+        id=session.id).volume_ml)
+    self.assertEqual(end_time,
+        models.DrinkingSession.GetCurrent(self.site).end_time)
+
+    # A pointer to a deleted session is noticed.
+    models.DrinkingSession.objects.filter(id=session.id).delete()
+    drink = self._drink(-1)
+    other = models.DrinkingSession.AssignSessionForDrink(drink)
+    self.assertEqual(drink.time, other.start_time)
+    self.assertEqual(100, models.DrinkingSession.objects.get(
+        id=other.id).volume_ml)
+
+    # Saving settings drops the pointer, so a new timeout applies.
+    self.site.settings.session_timeout_minutes = 1
+    self.site.settings.save()
+    later = models.DrinkingSession.AssignSessionForDrink(
+        self._drink(kb_common.DRINK_SESSION_TIME_MINUTES + 10))
+    self.assertNotEqual(other.id, later.id)
+    self.assertEqual(later.start_time + datetime.timedelta(minutes=1),
+        later.end_time)
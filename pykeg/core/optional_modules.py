@@ -41,3 +41,9 @@ try:
   HAVE_DJANGOTORNADO = True
 except ImportError:
   HAVE_DJANGOTORNADO = False
+
+try:
+  import numpy
+  HAVE_NUMPY = True
+except ImportError:
+  HAVE_NUMPY = False
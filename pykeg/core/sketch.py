@@ -0,0 +1,210 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Bounded-memory, mergeable summaries of value distributions.
+
+These are kept in stats to describe pour sizes and durations, which helps spot
+a mis-calibrated meter without reading every drink.
+"""
+
+import bisect
+import math
+
+# Histogram bucket boundaries for pour volumes (mL) and durations (seconds).
+VOLUME_EDGES_ML = (50, 100, 200, 300, 400, 500, 750, 1000)
+DURATION_EDGES_SECS = (2, 5, 10, 20, 30, 60, 120)
+
+# Percentiles reported by Distribution.Summary().
+PERCENTILES = (50, 90, 95, 99)
+
+
+class QuantileSketch(object):
+  """Estimates quantiles of non-negative values to a relative accuracy.
+
+  Positive values are counted in logarithmically sized bins, as in DDSketch:
+  value v falls in bin ceil(log(v) / log(GAMMA)), and the bin's representative
+  value is within RELATIVE_ACCURACY of every value in it.  Values are clamped
+  to [MIN_VALUE, MAX_VALUE], which bounds the number of bins; zero is counted
+  separately.
+
+  Sketches merge by adding counts, and a value is removed as cheaply as it is
+  added.
+  """
+  RELATIVE_ACCURACY = 0.01
+  GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+  MIN_VALUE = 0.1
+  MAX_VALUE = 1e6
+  _LOG_GAMMA = math.log(GAMMA)
+
+  def __init__(self):
+    self.bins = {}
+    self.zero_count = 0
+    self.count = 0
+
+  @classmethod
+  def Key(cls, value):
+    """Returns the bin for `value`, or None if it is zero or negative."""
+    if value <= 0:
+      return None
+    value = min(max(value, cls.MIN_VALUE), cls.MAX_VALUE)
+    return int(math.ceil(math.log(value) / cls._LOG_GAMMA))
+
+  def Add(self, value, count=1):
+    key = self.Key(value)
+    if key is None:
+      self.zero_count += count
+    else:
+      total = self.bins.get(key, 0) + count
+      if total:
+        self.bins[key] = total
+      else:
+        del self.bins[key]
+    self.count += count
+
+  def Remove(self, value):
+    self.Add(value, -1)
+
+  def Merge(self, other):
+    for key, count in other.bins.iteritems():
+      total = self.bins.get(key, 0) + count
+      if total:
+        self.bins[key] = total
+      else:
+        self.bins.pop(key, None)
+    self.zero_count += other.zero_count
+    self.count += other.count
+
+  def Quantile(self, q):
+    """Returns an estimate of the q-quantile, 0 <= q <= 1, or None if empty."""
+    if self.count <= 0:
+      return None
+    rank = q * (self.count - 1)
+    seen = self.zero_count
+    if rank < seen:
+      return 0.0
+    key = None
+    for key in sorted(self.bins):
+      seen += self.bins[key]
+      if seen > rank:
+        break
+    return 2 * self.GAMMA ** key / (self.GAMMA + 1)
+
+  def ToDict(self):
+    # JSON object keys must be strings.
+    bins = dict((str(key), count) for key, count in self.bins.iteritems())
+    return {'bins': bins, 'zero_count': self.zero_count}
+
+  @classmethod
+  def FromDict(cls, d):
+    sketch = cls()
+    for key, count in d['bins'].iteritems():
+      sketch.bins[int(key)] = count
+    sketch.zero_count = d['zero_count']
+    sketch.count = sketch.zero_count + sum(sketch.bins.itervalues())
+    return sketch
+
+
+class Histogram(object):
+  """Counts of values between fixed bucket boundaries.
+
+  With boundaries (e1, ..., en), bucket 0 counts values below e1, bucket i
+  values in [ei, ei+1), and bucket n values of en and above.
+  """
+  def __init__(self, edges):
+    self.edges = tuple(edges)
+    self.counts = [0] * (len(self.edges) + 1)
+
+  def Bucket(self, value):
+    return bisect.bisect_right(self.edges, value)
+
+  def Add(self, value, count=1):
+    self.counts[self.Bucket(value)] += count
+
+  def Remove(self, value):
+    self.Add(value, -1)
+
+  def Merge(self, other):
+    if other.edges != self.edges:
+      raise ValueError('Histogram boundaries differ.')
+    for i, count in enumerate(other.counts):
+      self.counts[i] += count
+
+  def Buckets(self):
+    """Returns (low, high, count) for each bucket; low or high may be None."""
+    lows = (None,) + self.edges
+    highs = self.edges + (None,)
+    return zip(lows, highs, self.counts)
+
+  def ToDict(self):
+    return list(self.counts)
+
+  @classmethod
+  def FromDict(cls, edges, counts):
+    histogram = cls(edges)
+    if len(counts) != len(histogram.counts):
+      raise ValueError('Histogram has %i buckets, expected %i.' % (
+          len(counts), len(histogram.counts)))
+    histogram.counts = list(counts)
+    return histogram
+
+
+class Distribution(object):
+  """A QuantileSketch and a Histogram of the same values."""
+  def __init__(self, edges):
+    self.sketch = QuantileSketch()
+    self.histogram = Histogram(edges)
+
+  def Add(self, value):
+    self.sketch.Add(value)
+    self.histogram.Add(value)
+
+  def Remove(self, value):
+    self.sketch.Remove(value)
+    self.histogram.Remove(value)
+
+  def Merge(self, other):
+    self.sketch.Merge(other.sketch)
+    self.histogram.Merge(other.histogram)
+
+  def Summary(self):
+    """Returns the count, percentiles and histogram as a dictionary."""
+    ret = {
+      'count': self.sketch.count,
+      'histogram': [{'min': low, 'max': high, 'count': count}
+          for low, high, count in self.histogram.Buckets()],
+    }
+    for percentile in PERCENTILES:
+      ret['p%i' % percentile] = self.sketch.Quantile(percentile / 100.0)
+    return ret
+
+  def ToDict(self):
+    return {
+      'sketch': self.sketch.ToDict(),
+      'histogram': self.histogram.ToDict(),
+    }
+
+  @classmethod
+  def FromDict(cls, edges, d):
+    """Loads a distribution; raises ValueError if `d` is malformed."""
+    ret = cls(edges)
+    try:
+      ret.sketch = QuantileSketch.FromDict(d['sketch'])
+      ret.histogram = Histogram.FromDict(edges, d['histogram'])
+    except (AttributeError, KeyError, TypeError), e:
+      raise ValueError('Malformed distribution: %s' % e)
+    return ret
@@ -18,14 +18,47 @@
 
 """Methods to generate cached statistics from drinks."""
 
+import collections
 import copy
 import inspect
 import itertools
 import logging
 
 from kegbot.api import models_pb2
-
-STAT_MAP = {}
+from kegbot.api import protoutil
+from kegbot.util import util
+
+from pykeg.core import kb_common
+from pykeg.core import sketch
+
+# Maps each builder class to a {statname: method name} dict; see _StatMap.
+_STAT_MAPS = {}
+
+# Volumes at or below this amount are considered to be zero after retraction.
+_VOLUME_EPSILON = 1e-6
+
+def _DrinkValues(drink):
+  """Returns the values StatsAccumulator.Add() expects for a Drink."""
+  session_start_time = None
+  if drink.session_id:
+    session_start_time = drink.session.start_time
+  username = None
+  if drink.user_id:
+    username = drink.user.username
+  return (drink.id, drink.volume_ml, drink.time, username, drink.session_id,
+      session_start_time, drink.duration)
+
+def _AddVolume(volmap, key, volume_ml):
+  """Adds to (or, if negative, subtracts from) a volume map entry.
+
+  The entry is deleted when it drops to zero.  Returns False if so.
+  """
+  volume_ml += volmap.get(key, 0)
+  if volume_ml <= _VOLUME_EPSILON:
+    volmap.pop(key, None)
+    return False
+  volmap[key] = volume_ml
+  return True
 
 def stat(statname):
   def decorate(f):
@@ -37,14 +70,29 @@ class StatsBuilder:
   def __init__(self, drink, previous=None):
     self.drink = drink
     self.previous = previous
-    self.STAT_MAP = {}
-    for name, fn in inspect.getmembers(self, inspect.ismethod):
-      if hasattr(fn, 'statname'):
-        self.STAT_MAP[fn.statname] = fn
 
-  def _AllDrinks(self):
+  @classmethod
+  def _StatMap(cls):
+    """Returns the class's stat methods, found by introspection only once."""
+    stat_map = _STAT_MAPS.get(cls)
+    if stat_map is None:
+      stat_map = {}
+      for name, fn in inspect.getmembers(cls, inspect.ismethod):
+        if hasattr(fn, 'statname'):
+          stat_map[fn.statname] = name
+      _STAT_MAPS[cls] = stat_map
+    return stat_map
+
+  def _ScopeDrinks(self):
+    """Returns all valid drinks in this builder's scope."""
     return []
 
+  def _AllDrinks(self):
+    """Returns the valid drinks in scope up to and including the drink."""
+    qs = self._ScopeDrinks().filter(id__lte=self.drink.id)
+    qs = qs.order_by('id')
+    return qs
+
   def Build(self):
     self.stats = models_pb2.Stats()
     if not self.drink:
@@ -52,13 +100,139 @@ class StatsBuilder:
     self.drinks = self._AllDrinks()
     if self.previous:
       self.stats.MergeFrom(self.previous)
-    for statname, fn in self.STAT_MAP.iteritems():
-      fn()
+    for statname, method_name in self._StatMap().iteritems():
+      getattr(self, method_name)()
     return self.stats
 
 
 class BaseStatsBuilder(StatsBuilder):
-  """Builder which generates a variety of stats from object information."""
+  """Builder which generates a variety of stats from object information.
+
+  When `previous` stats are given, the new drink is folded into them with a
+  StatsAccumulator instead of running the per-stat methods below, which
+  only handle the full (from scratch) build.  `previous` may either be a
+  models_pb2.Stats message or a stats dictionary as stored by _StatsModel.
+
+  Given a stored stats dictionary, the incremental build issues no queries
+  as long as the drink's `user` and `session` are already loaded (as they
+  are for a drink just recorded by the backend, or one fetched with
+  select_related).
+  """
+
+  def Build(self):
+    if self.drink and self.previous:
+      self.stats = self.Accumulate().ToProto()
+      return self.stats
+    return StatsBuilder.Build(self)
+
+  def _PreviousAccumulator(self):
+    if isinstance(self.previous, dict):
+      return StatsAccumulator.FromDict(self.previous)
+    return StatsAccumulator.FromProto(self.previous)
+
+  def Accumulate(self):
+    """Returns a StatsAccumulator with stats up to and including the drink."""
+    if not self.previous:
+      acc = StatsAccumulator.FromProto(StatsBuilder.Build(self))
+      # The drink is the latest in this scope.
+      acc.SetLastSession(self.drink.session_id or 0)
+      acc.ResetDistributions()
+      for volume_ml, duration in self.drinks.values_list('volume_ml',
+          'duration'):
+        acc.AddPour(volume_ml, duration)
+      return acc
+
+    acc = self._PreviousAccumulator()
+    if acc.last_session_id is None and self.drink.session_id:
+      # A bare Stats message, or stats stored before the accumulator state
+      # was kept, does not know which session this scope saw last; a drink
+      # counts toward a new session if it is the first in its session.
+      first_drink = self.drink.session.drinks.order_by('id')[0]
+      if self.drink.id == first_drink.id:
+        acc.last_session_id = 0
+      else:
+        acc.SetLastSession(self.drink.session_id)
+
+    acc.AddDrink(self.drink)
+    return acc
+
+  def Replay(self):
+    """Returns a StatsAccumulator built by adding, to `previous`, every drink
+    after it up to and including the drink.
+
+    `previous` is typically a checkpoint of an earlier state of the stats.
+    """
+    if not self.previous:
+      return self.Accumulate()
+    acc = self._PreviousAccumulator()
+    if acc.last_session_id is None or acc.pour_volumes is None:
+      raise ValueError('Stats have no accumulator state.')
+    drinks = self._AllDrinks().filter(id__gt=acc.last_drink_id)
+    for drink in drinks.select_related('user', 'session'):
+      acc.AddDrink(drink)
+    return acc
+
+  def Remove(self):
+    """Returns a StatsAccumulator with the drink retracted from `previous`.
+
+    The drink must already be marked as no longer valid.  Stats that cannot
+    be inverted (the greatest and the last drink, and whether a drinker or
+    session still appears in this scope) are recomputed with a targeted query,
+    and only when the removed drink could have affected them.
+    """
+    if not self.previous:
+      return self.RebuildScope()
+    acc = self._PreviousAccumulator()
+    if acc.last_session_id is None or not acc.total_pours:
+      return self.RebuildScope()
+    stale = acc.Remove(*_DrinkValues(self.drink))
+    self._Recompute(acc, stale)
+    return acc
+
+  def ChangeVolume(self, old_volume_ml):
+    """Returns a StatsAccumulator with the drink's volume change applied.
+
+    `previous` must include the drink at `old_volume_ml`; the drink itself
+    carries the new volume.
+    """
+    if not self.previous:
+      return self.RebuildScope()
+    acc = self._PreviousAccumulator()
+    if acc.last_session_id is None or not acc.total_pours:
+      return self.RebuildScope()
+    stale = acc.ChangeVolume(old_volume_ml, *_DrinkValues(self.drink))
+    self._Recompute(acc, stale)
+    return acc
+
+  def RebuildScope(self):
+    """Returns a StatsAccumulator built from every valid drink in scope."""
+    last_drinks = self._ScopeDrinks().order_by('-id')[:1]
+    if not last_drinks:
+      return StatsAccumulator()
+    return self.__class__(last_drinks[0]).Accumulate()
+
+  def _Recompute(self, acc, stale):
+    """Queries for the stats named in `stale`; see StatsAccumulator.Remove."""
+    drinks = self._ScopeDrinks()
+    if 'last_drink_id' in stale:
+      drink_id, session_id = drinks.order_by('-id').values_list('id',
+          'session_id')[0]
+      acc.last_drink_id = drink_id
+      acc.SetLastSession(session_id or 0)
+    if 'greatest_volume_ml' in stale:
+      drink_id, volume_ml = drinks.order_by('-volume_ml', 'id').values_list(
+          'id', 'volume_ml')[0]
+      acc.greatest_volume_id = drink_id
+      acc.greatest_volume_ml = volume_ml
+    if 'registered_drinkers' in stale:
+      if self.drink.user_id:
+        if not drinks.filter(user=self.drink.user_id).exists():
+          acc.registered_drinkers.pop(self.drink.user.username, None)
+      else:
+        acc.has_guest_pour = drinks.filter(user__isnull=True).exists()
+    if 'sessions_count' in stale:
+      if not drinks.filter(session=self.drink.session_id).exists():
+        acc.sessions_count -= 1
 
   @stat('last_drink_id')
   def LastDrinkId(self):
@@ -66,193 +240,429 @@ class BaseStatsBuilder(StatsBuilder):
 
   @stat('total_volume_ml')
   def TotalVolume(self):
-    if not self.previous:
-      self.stats.total_volume_ml = sum(drink.volume_ml for drink in self.drinks)
-    else:
-      self.stats.total_volume_ml += self.drink.volume_ml
+    self.stats.total_volume_ml = sum(drink.volume_ml for drink in self.drinks)
 
   @stat('total_pours')
   def TotalPours(self):
-    if not self.previous:
-      self.stats.total_pours = self.drinks.count()
-    else:
-      self.stats.total_pours += 1
+    self.stats.total_pours = self.drinks.count()
 
   @stat('average_volume_ml')
   def AverageVolume(self):
-    if not self.previous:
-      count = self.drinks.count()
-      average = 0.0
-      if count:
-        average = sum(drink.volume_ml for drink in self.drinks) / float(count)
-      self.stats.average_volume_ml = average
-    else:
-      vol = self.previous.total_volume_ml
-      count = self.previous.total_pours
-      vol += self.drink.volume_ml
-      count += 1
-      self.stats.average_volume_ml = vol / float(count)
+    count = self.drinks.count()
+    average = 0.0
+    if count:
+      average = sum(drink.volume_ml for drink in self.drinks) / float(count)
+    self.stats.average_volume_ml = average
 
   @stat('greatest_volume_ml')
   def GreatestVolume(self):
-    if not self.previous:
-      res = 0
-      drinks = self.drinks.order_by('-volume_ml')
-      if drinks.count():
-        res = drinks[0].volume_ml
-      self.stats.greatest_volume_ml = res
-    else:
-      if self.drink.volume_ml > self.previous.greatest_volume_ml:
-        self.stats.greatest_volume_ml = self.drink.volume_ml
+    res = 0
+    drinks = self.drinks.order_by('-volume_ml')
+    if drinks.count():
+      res = drinks[0].volume_ml
+    self.stats.greatest_volume_ml = res
 
   @stat('greatest_volume_id')
   def GreatestVolumeId(self):
-    if not self.previous:
-      res = 0
-      drinks = self.drinks.order_by('-volume_ml')
-      if drinks.count():
-        res = drinks[0].id
-      self.stats.greatest_volume_id = res
-    else:
-      if self.drink.volume_ml > self.previous.greatest_volume_ml:
-        self.stats.greatest_volume_id = self.drink.id
+    res = 0
+    drinks = self.drinks.order_by('-volume_ml')
+    if drinks.count():
+      res = drinks[0].id
+    self.stats.greatest_volume_id = res
 
   @stat('volume_by_day_of_week')
   def VolumeByDayOfweek(self):
     result = self.stats.volume_by_day_of_week
-    if not self.previous:
-      # Note: uses the session's start_time, rather than the drink's. This
-      # causes late-night sessions to be reported for the day on which they were
-      # started.
-      volmap = {}
-      for drink in self.drinks:
-        weekday = drink.session.start_time.strftime('%w')
-        if weekday not in volmap:
-          volmap[weekday] = 0.0
-        volmap[weekday] += drink.volume_ml
-      for weekday, volume_ml in volmap.iteritems():
-        if volume_ml:
-          day = result.add()
-          day.weekday = weekday
-          day.volume_ml = volume_ml
-    else:
-      drink_weekday = self.drink.session.start_time.strftime('%w')
-      for message in self.stats.volume_by_day_of_week:
-        if message.weekday == drink_weekday:
-          message.volume_ml += self.drink.volume_ml
-          return
-      message = result.add()
-      message.weekday = drink_weekday
-      message.volume_ml = self.drink.volume_ml
+    # Note: uses the session's start_time, rather than the drink's. This
+    # causes late-night sessions to be reported for the day on which they were
+    # started.
+    volmap = {}
+    for drink in self.drinks:
+      # A drink still awaiting post-processing has no session yet; as in
+      # StatsAccumulator, it counts towards no weekday.
+      if not drink.session_id:
+        continue
+      weekday = drink.session.start_time.strftime('%w')
+      if weekday not in volmap:
+        volmap[weekday] = 0.0
+      volmap[weekday] += drink.volume_ml
+    for weekday, volume_ml in volmap.iteritems():
+      if volume_ml:
+        day = result.add()
+        day.weekday = weekday
+        day.volume_ml = volume_ml
 
   @stat('registered_drinkers')
   def RegisteredDrinkers(self):
-    if not self.previous:
-      drinkers = set()
-      for drink in self.drinks:
-        if drink.user:
-          drinkers.add(str(drink.user.username))
-      self.stats.registered_drinkers.extend(drinkers)
-    else:
-      if self.drink.user:
-        result = self.stats.registered_drinkers
-        username = str(self.drink.user.username)
-        if username not in result:
-          result.append(username)
+    drinkers = set()
+    for drink in self.drinks:
+      if drink.user:
+        drinkers.add(str(drink.user.username))
+    self.stats.registered_drinkers.extend(drinkers)
 
   @stat('sessions_count')
   def SessionsCount(self):
-    if not self.previous:
-      all_sessions = set()
-      for drink in self.drinks:
-        all_sessions.add(drink.session.id)
-      self.stats.sessions_count = len(all_sessions)
-    else:
-      first_drink = self.drink.session.drinks.order_by('id')[0]
-      if self.drink.id == first_drink.id:
-        self.stats.sessions_count += 1
+    all_sessions = set()
+    for drink in self.drinks:
+      if drink.session_id:
+        all_sessions.add(drink.session_id)
+    self.stats.sessions_count = len(all_sessions)
 
   @stat('volume_by_year')
   def VolumeByYear(self):
-    if not self.previous:
-      volmap = {}
-      for drink in self.drinks:
-        year = drink.time.year
-        volmap[year] = volmap.get(year, 0) + drink.volume_ml
-      for year, volume_ml in volmap.iteritems():
-        rec = self.stats.volume_by_year.add()
-        rec.year = year
-        rec.volume_ml = volume_ml
-    else:
-      year = self.drink.time.year
-      for entry in self.stats.volume_by_year:
-        if entry.year == year:
-          entry.volume_ml += self.drink.volume_ml
-          return
+    volmap = {}
+    for drink in self.drinks:
+      year = drink.time.year
+      volmap[year] = volmap.get(year, 0) + drink.volume_ml
+    for year, volume_ml in volmap.iteritems():
       rec = self.stats.volume_by_year.add()
       rec.year = year
-      rec.volume_ml = self.drink.volume_ml
+      rec.volume_ml = volume_ml
 
   @stat('has_guest_pour')
   def HasGuestPour(self):
-    if not self.previous:
-      for drink in self.drinks:
-        if not drink.user:
-          self.stats.has_guest_pour = True
-          return
-      self.stats.has_guest_pour = False
-    else:
-      if not self.stats.has_guest_pour:
-        if not self.drink.user:
-          self.stats.has_guest_pour = True
+    for drink in self.drinks:
+      if not drink.user:
+        self.stats.has_guest_pour = True
+        return
+    self.stats.has_guest_pour = False
 
   @stat('volume_by_drinker')
   def VolumeByDrinker(self):
-    if not self.previous:
-      result = self.stats.volume_by_drinker
-      volmap = {}
-      for drink in self.drinks:
-        if drink.user:
-          u = drink.user.username
-        else:
-          u = ''
-        volmap[u] = volmap.get(u, 0) + drink.volume_ml
-      for username, volume_ml in volmap.iteritems():
-        if volume_ml:
-          record = result.add()
-          record.username = username
-          record.volume_ml = volume_ml
-    else:
-      result = self.stats.volume_by_drinker
-      if self.drink.user:
-        u = self.drink.user.username
+    result = self.stats.volume_by_drinker
+    volmap = {}
+    for drink in self.drinks:
+      if drink.user:
+        u = drink.user.username
       else:
         u = ''
-      for message in result:
-        if message.username == u:
-          message.volume_ml += self.drink.volume_ml
-          return
-      message = result.add()
-      message.username = u
-      message.volume_ml = self.drink.volume_ml
+      volmap[u] = volmap.get(u, 0) + drink.volume_ml
+    for username, volume_ml in volmap.iteritems():
+      if volume_ml:
+        record = result.add()
+        record.username = username
+        record.volume_ml = volume_ml
+
+
+class StatsAccumulator:
+  """Folds drinks, in id order, into a single scope's stats.
+
+  Per-drinker, per-year and per-weekday volumes are kept in dictionaries, so
+  adding a drink costs O(1) regardless of how many drinkers or years a scope
+  has seen.  The accumulator is converted to the models_pb2.Stats shape only
+  when it is serialized, with ToProto() or ToDict(); the latter also carries
+  the accumulator's own state (under STATE_KEY) so that stored stats can be
+  reloaded with FromDict() and updated without touching earlier drinks.
+
+  Unlike the builders above, an accumulator never queries the database when
+  given plain values, which makes it suitable for streaming a site's entire
+  drink history once while maintaining many scopes side by side.
+
+  The state also holds sketch.Distributions of pour volumes and durations,
+  from which DistributionSummaries() reports percentiles and histograms.
+  These are None when loaded from stats stored without them; kb_regen_stats
+  rebuilds them.
+  """
+  STATE_KEY = '_state'
+
+  def __init__(self):
+    self.last_drink_id = 0
+    self.total_volume_ml = 0.0
+    self.total_pours = 0
+    self.greatest_volume_ml = 0.0
+    self.greatest_volume_id = 0
+    self.has_guest_pour = False
+    self.sessions_count = 0
+    # Session of the most recent drink; None if not known.
+    self.last_session_id = 0
+    # Sessions known to be counted in sessions_count; always includes
+    # last_session_id.
+    self._session_ids = set()
+    self.volume_by_day_of_week = collections.OrderedDict()
+    self.volume_by_drinker = collections.OrderedDict()
+    self.volume_by_year = collections.OrderedDict()
+    self.registered_drinkers = collections.OrderedDict()
+    self.ResetDistributions()
+
+  def ResetDistributions(self):
+    self.pour_volumes = sketch.Distribution(sketch.VOLUME_EDGES_ML)
+    self.pour_durations = sketch.Distribution(sketch.DURATION_EDGES_SECS)
+
+  @classmethod
+  def FromDict(cls, d):
+    """Loads an accumulator from a stats dictionary.
+
+    Raises ValueError if the dictionary is malformed.
+    """
+    acc = cls()
+    try:
+      acc.last_drink_id = d.get('last_drink_id', 0)
+      acc.total_volume_ml = d.get('total_volume_ml', 0.0)
+      acc.total_pours = d.get('total_pours', 0)
+      acc.greatest_volume_ml = d.get('greatest_volume_ml', 0.0)
+      acc.greatest_volume_id = d.get('greatest_volume_id', 0)
+      acc.has_guest_pour = d.get('has_guest_pour', False)
+      acc.sessions_count = d.get('sessions_count', 0)
+      for rec in d.get('volume_by_day_of_week', []):
+        acc.volume_by_day_of_week[str(rec['weekday'])] = rec['volume_ml']
+      for rec in d.get('volume_by_drinker', []):
+        acc.volume_by_drinker[rec['username']] = rec['volume_ml']
+      for rec in d.get('volume_by_year', []):
+        acc.volume_by_year[int(rec['year'])] = rec['volume_ml']
+      for username in d.get('registered_drinkers', []):
+        acc.registered_drinkers[username] = True
+      state = d.get(cls.STATE_KEY)
+      if state:
+        acc.SetLastSession(state['last_session_id'])
+      else:
+        acc.last_session_id = None
+      if state and 'pour_volumes' in state:
+        acc.pour_volumes = sketch.Distribution.FromDict(
+            sketch.VOLUME_EDGES_ML, state['pour_volumes'])
+        acc.pour_durations = sketch.Distribution.FromDict(
+            sketch.DURATION_EDGES_SECS, state['pour_durations'])
+      else:
+        acc.pour_volumes = acc.pour_durations = None
+    except (AttributeError, KeyError, TypeError), e:
+      raise ValueError('Malformed stats: %s' % e)
+    return acc
+
+  @classmethod
+  def FromProto(cls, stats):
+    """Loads an accumulator from a models_pb2.Stats message."""
+    return cls.FromDict(protoutil.ProtoMessageToDict(stats))
+
+  def SetLastSession(self, session_id):
+    """Records `session_id` as the session of this scope's latest drink."""
+    self.last_session_id = session_id
+    if session_id:
+      self._session_ids.add(session_id)
+
+  def AddDrink(self, drink):
+    """Adds a Drink instance to the accumulated stats."""
+    self.Add(*_DrinkValues(drink))
+
+  def AddPour(self, volume_ml, duration):
+    """Adds a drink's volume and duration to the pour distributions."""
+    if self.pour_volumes is not None:
+      self.pour_volumes.Add(volume_ml)
+      self.pour_durations.Add(duration)
+
+  def RemovePour(self, volume_ml, duration):
+    if self.pour_volumes is not None:
+      self.pour_volumes.Remove(volume_ml)
+      self.pour_durations.Remove(duration)
+
+  def Add(self, drink_id, volume_ml, time, username, session_id,
+      session_start_time, duration=0):
+    """Adds a single drink, given as plain values, to the accumulated stats.
+
+    Drinks must be added in increasing id order.  `username` is None for guest
+    pours.
+    """
+    self.last_drink_id = drink_id
+    self.total_volume_ml += volume_ml
+    self.total_pours += 1
+    self.AddPour(volume_ml, duration)
+
+    if volume_ml > self.greatest_volume_ml or not self.greatest_volume_id:
+      self.greatest_volume_ml = volume_ml
+      self.greatest_volume_id = drink_id
+
+    if session_start_time is not None:
+      # Note: uses the session's start_time, rather than the drink's; see
+      # BaseStatsBuilder.VolumeByDayOfweek.
+      weekday = session_start_time.strftime('%w')
+      self.volume_by_day_of_week[weekday] = \
+          self.volume_by_day_of_week.get(weekday, 0.0) + volume_ml
+
+    year = time.year
+    self.volume_by_year[year] = self.volume_by_year.get(year, 0) + volume_ml
+
+    if username:
+      self.registered_drinkers[username] = True
+      drinker = username
+    else:
+      self.has_guest_pour = True
+      drinker = ''
+    self.volume_by_drinker[drinker] = \
+        self.volume_by_drinker.get(drinker, 0) + volume_ml
+
+    # A session counts the first time one of its drinks is added.  Stored
+    # stats only remember the latest session, which suffices because new
+    # pours join the site's current session; folding the whole history with
+    # one accumulator also copes with back-dated drinks.
+    if session_id:
+      if session_id not in self._session_ids:
+        self.sessions_count += 1
+      self.SetLastSession(session_id)
+
+  def Remove(self, drink_id, volume_ml, time, username, session_id,
+      session_start_time, duration=0):
+    """Retracts a drink previously given to Add().
+
+    Returns the set of stats which can no longer be derived from the
+    accumulator alone and must be recomputed by the caller; a subset of
+    'last_drink_id', 'greatest_volume_ml', 'registered_drinkers' (or
+    has_guest_pour, for guest drinks) and 'sessions_count'.
+    """
+    stale = set()
+    self.total_pours -= 1
+    if not self.total_pours:
+      self.__init__()
+      return stale
+    self.total_volume_ml -= volume_ml
+    self.RemovePour(volume_ml, duration)
+
+    if drink_id == self.last_drink_id:
+      stale.add('last_drink_id')
+    if drink_id == self.greatest_volume_id:
+      stale.add('greatest_volume_ml')
+
+    if session_start_time is not None:
+      _AddVolume(self.volume_by_day_of_week, session_start_time.strftime('%w'),
+          -volume_ml)
+    _AddVolume(self.volume_by_year, time.year, -volume_ml)
+    if not _AddVolume(self.volume_by_drinker, username or '', -volume_ml):
+      stale.add('registered_drinkers')
+
+    # The session is certainly still present if the scope's last drink, which
+    # is a different one, belongs to it.
+    if session_id:
+      if session_id != self.last_session_id or drink_id == self.last_drink_id:
+        stale.add('sessions_count')
+        self._session_ids.discard(session_id)
+    return stale
+
+  def ChangeVolume(self, old_volume_ml, drink_id, volume_ml, time, username,
+      session_id, session_start_time, duration=0):
+    """Changes the volume of a drink previously given to Add().
+
+    `volume_ml` is the drink's new volume.  Returns the set of stats to be
+    recomputed by the caller, as for Remove().
+    """
+    stale = set()
+    delta = volume_ml - old_volume_ml
+    self.total_volume_ml += delta
+    if self.pour_volumes is not None:
+      self.pour_volumes.Remove(old_volume_ml)
+      self.pour_volumes.Add(volume_ml)
+
+    if session_start_time is not None:
+      _AddVolume(self.volume_by_day_of_week, session_start_time.strftime('%w'),
+          delta)
+    _AddVolume(self.volume_by_year, time.year, delta)
+    _AddVolume(self.volume_by_drinker, username or '', delta)
+
+    if volume_ml > self.greatest_volume_ml or (
+        volume_ml == self.greatest_volume_ml and
+        drink_id < self.greatest_volume_id):
+      self.greatest_volume_ml = volume_ml
+      self.greatest_volume_id = drink_id
+    elif drink_id == self.greatest_volume_id and delta < 0:
+      stale.add('greatest_volume_ml')
+    return stale
+
+  def ToDict(self):
+    """Returns the accumulated stats as a stats dictionary.
+
+    The result has the same shape as ProtoMessageToDict(self.ToProto()), plus
+    the accumulator state under STATE_KEY.
+    """
+    ret = util.AttrDict()
+    if not self.total_pours:
+      return ret
+    ret['last_drink_id'] = self.last_drink_id
+    ret['total_volume_ml'] = self.total_volume_ml
+    ret['total_pours'] = self.total_pours
+    ret['average_volume_ml'] = self.total_volume_ml / float(self.total_pours)
+    ret['greatest_volume_ml'] = self.greatest_volume_ml
+    ret['greatest_volume_id'] = self.greatest_volume_id
+    ret['has_guest_pour'] = self.has_guest_pour
+    ret['sessions_count'] = self.sessions_count
+    ret['volume_by_day_of_week'] = [
+        util.AttrDict(weekday=weekday, volume_ml=volume_ml)
+        for weekday, volume_ml in self.volume_by_day_of_week.iteritems()
+        if volume_ml]
+    ret['volume_by_drinker'] = [
+        util.AttrDict(username=username, volume_ml=volume_ml)
+        for username, volume_ml in self.volume_by_drinker.iteritems()
+        if volume_ml]
+    ret['volume_by_year'] = [
+        util.AttrDict(year=year, volume_ml=volume_ml)
+        for year, volume_ml in self.volume_by_year.iteritems()]
+    ret['registered_drinkers'] = self.registered_drinkers.keys()
+    for k in ('volume_by_day_of_week', 'volume_by_drinker', 'volume_by_year',
+        'registered_drinkers'):
+      if not ret[k]:
+        del ret[k]
+    if self.last_session_id is not None:
+      state = util.AttrDict(last_session_id=self.last_session_id)
+      if self.pour_volumes is not None:
+        state.pour_volumes = self.pour_volumes.ToDict()
+        state.pour_durations = self.pour_durations.ToDict()
+      ret[self.STATE_KEY] = state
+    return ret
+
+  def DistributionSummaries(self):
+    """Returns percentiles and histograms of pour volumes and durations.
+
+    See sketch.Distribution.Summary(); returns None if the distributions are
+    not known.
+    """
+    if self.pour_volumes is None:
+      return None
+    return {
+      'pour_volume': self.pour_volumes.Summary(),
+      'pour_duration': self.pour_durations.Summary(),
+    }
+
+  def ToProto(self):
+    """Returns the accumulated stats as a models_pb2.Stats message."""
+    stats = models_pb2.Stats()
+    if not self.total_pours:
+      return stats
+    stats.last_drink_id = self.last_drink_id
+    stats.total_volume_ml = self.total_volume_ml
+    stats.total_pours = self.total_pours
+    stats.average_volume_ml = self.total_volume_ml / float(self.total_pours)
+    stats.greatest_volume_ml = self.greatest_volume_ml
+    stats.greatest_volume_id = self.greatest_volume_id
+    stats.has_guest_pour = self.has_guest_pour
+    stats.sessions_count = self.sessions_count
+    for weekday, volume_ml in self.volume_by_day_of_week.iteritems():
+      if volume_ml:
+        day = stats.volume_by_day_of_week.add()
+        day.weekday = weekday
+        day.volume_ml = volume_ml
+    for username, volume_ml in self.volume_by_drinker.iteritems():
+      if volume_ml:
+        record = stats.volume_by_drinker.add()
+        record.username = username
+        record.volume_ml = volume_ml
+    for year, volume_ml in self.volume_by_year.iteritems():
+      rec = stats.volume_by_year.add()
+      rec.year = year
+      rec.volume_ml = volume_ml
+    stats.registered_drinkers.extend(self.registered_drinkers.keys())
+    return stats
+
 
 class SystemStatsBuilder(BaseStatsBuilder):
   """Builder of systemwide stats by drink."""
   REVISION = 5
 
-  def _AllDrinks(self):
-    qs = self.drink.site.drinks.valid().filter(id__lte=self.drink.id)
-    qs = qs.order_by('id')
-    return qs
+  def _ScopeDrinks(self):
+    return self.drink.site.drinks.valid()
 
 
 class DrinkerStatsBuilder(SystemStatsBuilder):
   """Builder of user-specific stats by drink."""
   REVISION = 5
 
-  def _AllDrinks(self):
-    qs = SystemStatsBuilder._AllDrinks(self)
-    qs = qs.filter(user=self.drink.user)
+  def _ScopeDrinks(self):
+    qs = SystemStatsBuilder._ScopeDrinks(self)
+    qs = qs.filter(user=self.drink.user_id)
     return qs
 
 
@@ -260,9 +670,9 @@ class KegStatsBuilder(SystemStatsBuilder):
   """Builder of keg-specific stats."""
   REVISION = 5
 
-  def _AllDrinks(self):
-    qs = SystemStatsBuilder._AllDrinks(self)
-    qs = qs.filter(keg=self.drink.keg)
+  def _ScopeDrinks(self):
+    qs = SystemStatsBuilder._ScopeDrinks(self)
+    qs = qs.filter(keg=self.drink.keg_id)
     return qs
 
 
@@ -270,12 +680,137 @@ class SessionStatsBuilder(SystemStatsBuilder):
   """Builder of user-specific stats by drink."""
   REVISION = 5
 
-  def _AllDrinks(self):
-    qs = SystemStatsBuilder._AllDrinks(self)
-    qs = qs.filter(session=self.drink.session)
+  def _ScopeDrinks(self):
+    qs = SystemStatsBuilder._ScopeDrinks(self)
+    qs = qs.filter(session=self.drink.session_id)
     return qs
 
 
+def FoldDrinks(rows, total, progress_cb=None):
+  """Folds drink rows, in id order, into accumulators for every scope.
+
+  Args
+    rows: iterable of (id, volume_ml, time, user_id, username, keg_id,
+      session_id, session_start_time, duration) tuples
+    total: number of rows, for progress_cb
+    progress_cb: optional callable, invoked as progress_cb(pos, total) while
+      drinks are processed
+
+  Returns
+    A tuple (system_stats, keg_stats, user_stats, session_stats, checkpoints):
+    the site's StatsAccumulator; dicts mapping keg, user and session ids to
+    their StatsAccumulators; and a list of (scope, scope_id, drink_id, stats)
+    tuples, one for every kb_common.STATS_CHECKPOINT_INTERVAL drinks in a
+    scope.
+  """
+  system_stats = StatsAccumulator()
+  keg_stats = {}
+  user_stats = {}
+  session_stats = {}
+  checkpoints = []
+
+  def _Add(acc, args, scope, scope_id=None):
+    acc.Add(*args)
+    if acc.total_pours % kb_common.STATS_CHECKPOINT_INTERVAL == 0:
+      checkpoints.append((scope, scope_id, args[0], acc.ToDict()))
+
+  pos = 0
+  for row in rows:
+    drink_id, volume_ml, time, user_id, username, keg_id, session_id, \
+        session_start_time, duration = row
+    args = (drink_id, volume_ml, time, username, session_id, session_start_time,
+        duration)
+
+    _Add(system_stats, args, 'system')
+    if keg_id:
+      _Add(keg_stats.setdefault(keg_id, StatsAccumulator()), args, 'keg',
+          keg_id)
+    if user_id:
+      _Add(user_stats.setdefault(user_id, StatsAccumulator()), args, 'user',
+          user_id)
+    if session_id:
+      _Add(session_stats.setdefault(session_id, StatsAccumulator()), args,
+          'session', session_id)
+
+    pos += 1
+    if progress_cb:
+      progress_cb(pos, total)
+
+  return system_stats, keg_stats, user_stats, session_stats, checkpoints
+
+
+def RebuildAllStats(site, progress_cb=None, use_numpy=None):
+  """Regenerates all system, keg, user and session stats for `site`.
+
+  The site's valid drinks are read exactly once, in id order, with a single
+  query; each drink is folded into the accumulators of every scope it belongs
+  to.  Existing stats rows and checkpoints for the site are then replaced in
+  bulk.
+
+  Args
+    site: the KegbotSite to rebuild
+    progress_cb: optional callable, invoked as progress_cb(pos, total) while
+      drinks are processed
+    use_numpy: whether to fold drinks with the vectorized stats_numpy
+      backend; by default, it is used whenever NumPy is installed
+  """
+  from django.conf import settings
+  from django.db import transaction
+  from pykeg.core import models
+
+  if use_numpy is None:
+    use_numpy = settings.HAVE_NUMPY
+  if use_numpy:
+    from pykeg.core import stats_numpy
+    fold = stats_numpy.FoldDrinks
+  else:
+    fold = FoldDrinks
+
+  drinks = site.drinks.valid().order_by('id')
+  total = drinks.count()
+  rows = drinks.values_list('id', 'volume_ml', 'time', 'user_id',
+      'user__username', 'keg_id', 'session_id', 'session__start_time',
+      'duration')
+  system_stats, keg_stats, user_stats, session_stats, checkpoints = fold(
+      rows.iterator(), total, progress_cb)
+
+  scope_fields = {
+    'system': None,
+    'keg': 'keg_id',
+    'user': 'user_id',
+    'session': 'session_id',
+  }
+  checkpoint_rows = []
+  for scope, scope_id, drink_id, stats in checkpoints:
+    row = models.StatsCheckpoint(site=site, scope=scope, drink_id=drink_id,
+        stats=stats)
+    if scope_fields[scope]:
+      setattr(row, scope_fields[scope], scope_id)
+    checkpoint_rows.append(row)
+
+  with transaction.commit_on_success():
+    models.SystemStats.objects.filter(site=site).delete()
+    models.KegStats.objects.filter(site=site).delete()
+    models.UserStats.objects.filter(site=site).delete()
+    models.SessionStats.objects.filter(site=site).delete()
+    models.StatsCheckpoint.objects.filter(site=site).delete()
+
+    if system_stats.total_pours:
+      models.SystemStats.objects.create(site=site,
+          stats=system_stats.ToDict())
+    models.KegStats.objects.bulk_create([
+        models.KegStats(site=site, keg_id=keg_id, stats=acc.ToDict())
+        for keg_id, acc in keg_stats.iteritems()])
+    models.UserStats.objects.bulk_create([
+        models.UserStats(site=site, user_id=user_id, stats=acc.ToDict())
+        for user_id, acc in user_stats.iteritems()])
+    models.SessionStats.objects.bulk_create([
+        models.SessionStats(site=site, session_id=session_id,
+            stats=acc.ToDict())
+        for session_id, acc in session_stats.iteritems()])
+    models.StatsCheckpoint.objects.bulk_create(checkpoint_rows)
+
+
 def main():
   from pykeg.core import models
   last_drink = models.Drink.objects.valid().order_by('-id')[0]
@@ -16,16 +16,27 @@
 # You should have received a copy of the GNU General Public License
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
+import datetime
+
+from django.conf import settings
+from django.db.utils import IntegrityError
+from django.test import TransactionTestCase
 from django.utils import unittest
 
 from kegbot.api import models_pb2
+from kegbot.api.protoutil import DictToProtoMessage
 from kegbot.api.protoutil import ProtoMessageToDict
 
 from . import backend
+from . import deferred
+from . import kb_common
 from . import models
 from . import stats
 from .testutils import make_datetime
 
+def _StatsFromDict(d):
+  return DictToProtoMessage(d, models_pb2.Stats())
+
 class StatsTestCase(unittest.TestCase):
   def setUp(self):
     self.site, created = models.KegbotSite.objects.get_or_create(name='default')
@@ -46,6 +57,11 @@ class StatsTestCase(unittest.TestCase):
     #        volume_ml=amt, username=user.username, do_postprocess=False)
     #    self.drinks.append(d)
 
+  def tearDown(self):
+    self.site.delete()
+    for user in self.users:
+      user.delete()
+
   def assertProtosEqual(self, expected, actual):
     d1 = ProtoMessageToDict(expected)
     d2 = ProtoMessageToDict(actual)
@@ -135,3 +151,657 @@ class StatsTestCase(unittest.TestCase):
     system_stats_d2_inc = stats.SystemStatsBuilder(drink2, system_stats_d1).Build()
     self.assertProtosEqual(system_stats_d2, system_stats_d2_inc)
 
+
+class StatsBuildTestCase(TransactionTestCase):
+  reset_sequences = True
+
+  def setUp(self):
+    self.site, created = models.KegbotSite.objects.get_or_create(name='default')
+    self.backend = backend.KegbotBackend(site=self.site)
+
+    test_usernames = ('user1', 'user2', 'user3')
+    self.users = [self.backend.CreateNewUser(name) for name in test_usernames]
+
+    self.taps = [
+        self.backend.CreateTap('tap1', 'kegboard.flow0', ml_per_tick=1/2200.0),
+        self.backend.CreateTap('tap2', 'kegboard.flow1', ml_per_tick=1/2200.0),
+    ]
+
+  def assertStatsEqual(self, expected, actual):
+    """Like StatsTestCase.assertProtosEqual, but ignores the order of repeated fields."""
+    def normalize(message):
+      d = ProtoMessageToDict(message)
+      for k, v in d.iteritems():
+        if isinstance(v, list):
+          d[k] = sorted(v)
+      return d
+    self.assertEquals(normalize(expected), normalize(actual))
+
+  def _makeKeg(self):
+    brewer = models.Brewer.objects.create(name='Test Brewer')
+    style = models.BeerStyle.objects.create(name='Test Style')
+    beer_type = models.BeerType.objects.create(name='Test Beer',
+        brewer=brewer, style=style)
+    size = models.KegSize.objects.create(name='Test Size', volume_ml=58673.9)
+    keg = models.Keg.objects.create(site=self.site, type=beer_type,
+        size=size, status='online')
+    self.taps[0].current_keg = keg
+    self.taps[0].save()
+    return keg
+
+  def _recordDrinks(self):
+    base_time = make_datetime(2011, 05, 01, 12, 00)
+    hour = datetime.timedelta(hours=1)
+    pours = (
+      ('kegboard.flow0', 100, 'user1', base_time, 4),
+      ('kegboard.flow1', 200, 'user2', base_time + hour, 8),
+      ('kegboard.flow0', 300, None, base_time + hour * 2, 15),
+      ('kegboard.flow0', 50, 'user1', base_time + hour * 30, 3),
+      ('kegboard.flow1', 450, 'user3', base_time + hour * 31, 40),
+      ('kegboard.flow0', 120, 'user2', base_time + hour * 24 * 400, 6),
+    )
+    drinks = []
+    for meter_name, volume_ml, username, pour_time, duration in pours:
+      drinks.append(self.backend.RecordDrink(meter_name, ticks=volume_ml,
+          volume_ml=volume_ml, username=username, pour_time=pour_time,
+          duration=duration, do_postprocess=False))
+    return drinks
+
+  def _recordProcessedDrinks(self):
+    """Records the test pours on a new keg, post-processing each one."""
+    self._makeKeg()
+    drinks = self._recordDrinks()
+    for drink in drinks:
+      drink.PostProcess()
+    return drinks
+
+  def testRebuildAllStats(self):
+    keg = self._makeKeg()
+    drinks = self._recordDrinks()
+    last = drinks[-1]
+
+    stats.RebuildAllStats(self.site)
+
+    expected = stats.SystemStatsBuilder(last).Build()
+    record = models.SystemStats.objects.get(site=self.site)
+    self.assertStatsEqual(expected, _StatsFromDict(record.stats))
+
+    keg_drinks = keg.drinks.valid().order_by('-id')
+    self.assertEquals(1, models.KegStats.objects.filter(site=self.site).count())
+    expected = stats.KegStatsBuilder(keg_drinks[0]).Build()
+    record = models.KegStats.objects.get(keg=keg)
+    self.assertStatsEqual(expected, _StatsFromDict(record.stats))
+
+    self.assertEquals(3, models.UserStats.objects.filter(site=self.site).count())
+    for user in self.users:
+      user_drinks = user.drinks.valid().order_by('-id')
+      expected = stats.DrinkerStatsBuilder(user_drinks[0]).Build()
+      record = models.UserStats.objects.get(site=self.site, user=user)
+      self.assertStatsEqual(expected, _StatsFromDict(record.stats))
+
+    sessions = models.DrinkingSession.objects.filter(site=self.site)
+    self.assertEquals(3, sessions.count())
+    self.assertEquals(3, models.SessionStats.objects.filter(site=self.site).count())
+    for session in sessions:
+      session_drinks = session.drinks.valid().order_by('-id')
+      expected = stats.SessionStatsBuilder(session_drinks[0]).Build()
+      record = models.SessionStats.objects.get(session=session)
+      self.assertStatsEqual(expected, _StatsFromDict(record.stats))
+
+  def testIncrementalUpdates(self):
+    drinks = self._recordProcessedDrinks()
+    keg = drinks[0].keg
+
+    record = models.SystemStats.objects.get(site=self.site)
+    self.assertTrue(stats.StatsAccumulator.STATE_KEY in record.stats)
+    expected = stats.SystemStatsBuilder(drinks[-1]).Build()
+    self.assertStatsEqual(expected, _StatsFromDict(record.stats))
+
+    for user in self.users:
+      last = user.drinks.valid().order_by('-id')[0]
+      expected = stats.DrinkerStatsBuilder(last).Build()
+      record = models.UserStats.objects.get(site=self.site, user=user)
+      self.assertStatsEqual(expected, _StatsFromDict(record.stats))
+
+    last = keg.drinks.valid().order_by('-id')[0]
+    expected = stats.KegStatsBuilder(last).Build()
+    record = models.KegStats.objects.get(keg=keg)
+    self.assertStatsEqual(expected, _StatsFromDict(record.stats))
+
+    # Round trip through the stored form.
+    acc = stats.StatsAccumulator.FromDict(record.stats)
+    self.assertEquals(record.stats, acc.ToDict())
+    self.assertRaises(ValueError, stats.StatsAccumulator.FromDict,
+        {'volume_by_year': [{'volume_ml': 1.0}]})
+
+  def testIncrementalBuildIsQueryFree(self):
+    drink = self._recordProcessedDrinks()[-1]
+    keg = drink.keg
+
+    drink = self.backend.RecordDrink('kegboard.flow0', ticks=80,
+        volume_ml=80, username='user3', pour_time=drink.time,
+        do_postprocess=False)
+    reloaded = models.Drink.objects.select_related('user', 'session').get(
+        id=drink.id)
+
+    scopes = (
+      (stats.SystemStatsBuilder, models.SystemStats.objects.get(site=self.site)),
+      (stats.DrinkerStatsBuilder, models.UserStats.objects.get(user=drink.user)),
+      (stats.KegStatsBuilder, models.KegStats.objects.get(keg=keg)),
+      (stats.SessionStatsBuilder,
+          models.SessionStats.objects.get(session=drink.session)),
+    )
+    for builder_cls, record in scopes:
+      for d in (drink, reloaded):
+        with self.assertNumQueries(0):
+          incremental = builder_cls(d, record.stats).Build()
+        expected = builder_cls(d).Build()
+        self.assertStatsEqual(expected, incremental)
+
+  def testPostProcessQueryCount(self):
+    drink = self._recordProcessedDrinks()[-1]
+    drink = self.backend.RecordDrink('kegboard.flow0', ticks=80,
+        volume_ml=80, username='user3', pour_time=drink.time,
+        do_postprocess=False)
+
+    # One SELECT and one UPDATE per stats table.
+    with self.assertNumQueries(8):
+      models.Drink._UpdateAllStats([drink])
+    self._assertStatsMatchDrinks()
+
+    # The drink's user joins the session; no other events are new.
+    with self.assertNumQueries(2):
+      models.SystemEvent.ProcessDrink(drink)
+    with self.assertNumQueries(1):
+      models.SystemEvent.ProcessDrink(drink)
+    self.assertEquals(['session_joined', 'drink_poured'],
+        [e.kind for e in drink.events.order_by('id')])
+    self._assertStatsMatchDrinks()
+
+    drinks = []
+    for minutes in (5, 65):
+      drinks.append(self.backend.RecordDrink('kegboard.flow0', ticks=90,
+          volume_ml=90, username='user2',
+          pour_time=drink.time + datetime.timedelta(minutes=minutes),
+          do_postprocess=False))
+    # As above for the stats; the rollups are read with two queries (the
+    # second for the new hour) and written with one INSERT and one UPDATE, and
+    # the leaderboard entries with one SELECT and one UPDATE, and the flow
+    # stats with one SELECT and one INSERT, whatever the number of drinks.
+    # Events are still found and inserted per drink.
+    with self.assertNumQueries(8 + 4 + 2 + 2 + 2 * 2):
+      models.Drink.PostProcessAll(drinks)
+    self._assertStatsMatchDrinks()
+
+  def testDeferredPostProcessing(self):
+    self._makeKeg()
+    recorded = self._recordDrinks()
+    models.Drink.objects.all().delete()
+    models.DrinkingSession.objects.all().delete()
+
+    drinks = []
+    for drink in recorded:
+      drinks.append(self.backend.RecordDrink(drink.tap.meter_name,
+          ticks=drink.ticks, volume_ml=drink.volume_ml,
+          username=drink.user and drink.user.username, pour_time=drink.time,
+          duration=drink.duration, defer_postprocess=True))
+    self.assertEquals(6, deferred.Pending(self.site))
+    self.assertEquals(None, drinks[0].session)
+    self.assertFalse(models.SystemStats.objects.exists())
+
+    # Full builds skip the sessions of drinks which have none yet.
+    pending_stats = stats.SystemStatsBuilder(drinks[-1]).Build()
+    self.assertEquals(6, pending_stats.total_pours)
+    self.assertEquals(0, pending_stats.sessions_count)
+    self.assertEquals(0, len(pending_stats.volume_by_day_of_week))
+
+    self.assertEquals(6, deferred.Flush(self.site))
+    self.assertEquals(0, deferred.Pending(self.site))
+    self.assertEquals(0, deferred.Flush(self.site))
+    self.assertEquals(3, models.DrinkingSession.objects.count())
+    self._assertStatsMatchDrinks()
+    self.assertEquals(6, models.SystemEvent.objects.filter(
+        kind='drink_poured').count())
+
+    # Drinks are processed before they are cancelled.
+    drink = self.backend.RecordDrink('kegboard.flow0', ticks=80, volume_ml=80,
+        username='user3', pour_time=drinks[-1].time, defer_postprocess=True)
+    self.backend.CancelDrink(drink.id)
+    self.assertEquals(0, deferred.Pending(self.site))
+    self._assertStatsMatchDrinks()
+
+    # And before later drinks recorded synchronously.
+    pending = self.backend.RecordDrink('kegboard.flow0', ticks=80,
+        volume_ml=80, username='user3', pour_time=drinks[-1].time,
+        defer_postprocess=True)
+    drink = self.backend.RecordDrink('kegboard.flow0', ticks=90, volume_ml=90,
+        username='user3', pour_time=drinks[-1].time, defer_postprocess=False)
+    self.assertEquals(0, deferred.Pending(self.site))
+    self.assertTrue(pending.id < drink.id)
+    self.assertEquals(drink.id,
+        models.SystemStats.objects.get(site=self.site).stats['last_drink_id'])
+    self._assertStatsMatchDrinks()
+
+  def testRecordDrinks(self):
+    self._makeKeg()
+    recorded = self._recordDrinks()
+    pours = [{'tap_name': d.tap.meter_name, 'ticks': d.ticks,
+        'volume_ml': d.volume_ml, 'username': d.user and d.user.username,
+        'pour_time': d.time, 'duration': d.duration} for d in recorded]
+
+    def reset():
+      models.Drink.objects.all().delete()
+      models.DrinkingSession.objects.all().delete()
+      models.SystemEvent.objects.all().delete()
+      for model in (models.SystemStats, models.UserStats, models.KegStats,
+          models.VolumeRollup, models.LeaderboardEntry):
+        model.objects.all().delete()
+
+    # Post-processed one at a time.
+    reset()
+    for pour in pours:
+      self.backend.RecordDrink(**pour)
+    expected_chunks = sorted(models.UserSessionChunk.objects.values_list(
+        'user', 'volume_ml', 'start_time', 'end_time'))
+    reset()
+
+    drinks = self.backend.RecordDrinks(pours, defer_postprocess=False)
+    self.assertEquals(6, len(drinks))
+    self.assertEquals(3, models.DrinkingSession.objects.count())
+    self.assertEquals(drinks[0].session, drinks[2].session)
+    self.assertNotEquals(drinks[2].session, drinks[3].session)
+    self.assertEquals(expected_chunks,
+        sorted(models.UserSessionChunk.objects.values_list(
+            'user', 'volume_ml', 'start_time', 'end_time')))
+    self._assertStatsMatchDrinks()
+    self.assertEquals(6, models.SystemEvent.objects.filter(
+        kind='drink_poured').count())
+    self.assertEquals(3, models.SystemEvent.objects.filter(
+        kind='session_started').count())
+    rollups = self._rollupRows()
+    models.VolumeRollup.RebuildAll(self.site)
+    self.assertEquals(rollups, self._rollupRows())
+    entries = self._leaderboardRows()
+    models.LeaderboardEntry.RebuildAll(self.site)
+    self.assertEquals(entries, self._leaderboardRows())
+
+    # Nothing is recorded if any pour is bad.
+    bad = dict(pours[0], tap_name='kegboard.unknown')
+    self.assertRaises(backend.BackendError, self.backend.RecordDrinks,
+        [pours[0], bad])
+    self.assertEquals(6, models.Drink.objects.count())
+
+  def testPourKeys(self):
+    self._makeKeg()
+    pour_time = make_datetime(2011, 05, 01, 12, 00)
+    drink = self.backend.RecordDrink('kegboard.flow0', ticks=100,
+        volume_ml=100, username='user1', pour_time=pour_time,
+        pour_key='board1-0001')
+
+    # A retry returns the recorded drink, without post-processing it again.
+    with self.assertNumQueries(1):
+      retry = self.backend.RecordDrink('kegboard.flow0', ticks=100,
+          volume_ml=100, username='user1', pour_time=pour_time,
+          pour_key='board1-0001')
+    self.assertEquals(drink.id, retry.id)
+    self.assertEquals(1, models.Drink.objects.count())
+    self.assertEquals(1, models.SystemEvent.objects.filter(
+        kind='drink_poured').count())
+
+    # Keys are also honoured when deferred, and in batches.
+    deferred_drink = self.backend.RecordDrink('kegboard.flow1', ticks=200,
+        volume_ml=200, pour_time=pour_time, pour_key='board1-0002',
+        defer_postprocess=True)
+    self.assertEquals(1, deferred.Flush(self.site))
+    pours = [
+      {'tap_name': 'kegboard.flow0', 'ticks': 100, 'pour_time': pour_time,
+          'pour_key': 'board1-0001'},
+      {'tap_name': 'kegboard.flow1', 'ticks': 200, 'pour_time': pour_time,
+          'pour_key': 'board1-0002'},
+      {'tap_name': 'kegboard.flow0', 'ticks': 300, 'volume_ml': 300,
+          'pour_time': pour_time, 'pour_key': 'board1-0003'},
+      {'tap_name': 'kegboard.flow0', 'ticks': 300, 'volume_ml': 300,
+          'pour_time': pour_time, 'pour_key': 'board1-0003'},
+      {'tap_name': 'kegboard.flow0', 'ticks': 50, 'volume_ml': 50,
+          'pour_time': pour_time},
+    ]
+    drinks = self.backend.RecordDrinks(pours, defer_postprocess=False)
+    self.assertEquals([drink.id, deferred_drink.id, drinks[2].id,
+        drinks[2].id, drinks[4].id], [d.id for d in drinks])
+    self.assertEquals(4, models.Drink.objects.count())
+    self._assertStatsMatchDrinks()
+
+    # The ingest writer's batches give pours keys, so that retrying the
+    # batch's calls one by one records nothing twice.
+    calls = [{'tap_name': 'kegboard.flow0', 'ticks': 70, 'volume_ml': 70,
+        'username': None, 'pour_time': pour_time, 'duration': 0, 'shout': '',
+        'tick_time_series': '', 'do_postprocess': True,
+        'defer_postprocess': False, 'pour_key': None} for i in range(2)]
+    batched = self.backend._RecordDrinkBatch(calls)
+    for call, drink in zip(calls, batched):
+      self.assertEquals(drink.id, self.backend.RecordDrink(**call).id)
+    self.assertEquals(6, models.Drink.objects.count())
+
+  def _assertStatsMatchDrinks(self):
+    """Checks every stats record against a full build of its scope."""
+    drinks = self.site.drinks.valid().order_by('-id')
+    scopes = (
+      (stats.SystemStatsBuilder, models.SystemStats.objects.all(), 'site'),
+      (stats.DrinkerStatsBuilder, models.UserStats.objects.all(), 'user'),
+      (stats.KegStatsBuilder, models.KegStats.objects.all(), 'keg'),
+      (stats.SessionStatsBuilder, models.SessionStats.objects.all(), 'session'),
+    )
+    for builder_cls, records, field in scopes:
+      for record in records:
+        scope_drinks = drinks.filter(**{field: getattr(record, field)})
+        self.assertTrue(scope_drinks.exists())
+        expected = builder_cls(scope_drinks[0]).Accumulate()
+        self.assertStatsEqual(expected.ToProto(), _StatsFromDict(record.stats))
+        self.assertEquals(expected.DistributionSummaries(),
+            record.PourDistributions())
+
+  def testCancelDrink(self):
+    drinks = self._recordProcessedDrinks()
+
+    # Cancel the greatest pour, a guest pour, the last pour, and finally the
+    # only pour of a session.
+    for index in (4, 2, 5, 3):
+      drink = drinks[index]
+      self.backend.CancelDrink(drink.id)
+      self._assertStatsMatchDrinks()
+
+      session = models.DrinkingSession.objects.get(id=drink.session_id)
+      session_drinks = session.drinks.valid()
+      self.assertAlmostEqual(sum(d.volume_ml for d in session_drinks),
+          session.volume_ml)
+      if session_drinks:
+        self.assertEquals(min(d.time for d in session_drinks),
+            session.start_time)
+      for chunk in session.user_chunks.all():
+        user_drinks = session_drinks.filter(user=chunk.user)
+        self.assertAlmostEqual(sum(d.volume_ml for d in user_drinks),
+            chunk.volume_ml)
+
+    self.assertFalse(models.SessionStats.objects.filter(
+        session=drinks[5].session).exists())
+    self.assertFalse(models.UserStats.objects.filter(user__username='user3').exists())
+
+  def testSetDrinkVolume(self):
+    drinks = self._recordProcessedDrinks()
+
+    # Shrink the greatest pour, then grow another past it.
+    self.backend.SetDrinkVolume(drinks[4].id, 10)
+    self._assertStatsMatchDrinks()
+    self.backend.SetDrinkVolume(drinks[0].id, 1000)
+    self._assertStatsMatchDrinks()
+
+    session = models.DrinkingSession.objects.get(id=drinks[0].session_id)
+    self.assertAlmostEqual(1000 + 200 + 300, session.volume_ml)
+
+  def testCheckpoints(self):
+    old_interval = kb_common.STATS_CHECKPOINT_INTERVAL
+    kb_common.STATS_CHECKPOINT_INTERVAL = 2
+    try:
+      self._testCheckpoints()
+    finally:
+      kb_common.STATS_CHECKPOINT_INTERVAL = old_interval
+
+  def _testCheckpoints(self):
+    drinks = self._recordProcessedDrinks()
+
+    record = models.SystemStats.objects.get(site=self.site)
+    self.assertEquals([2, 4, 6],
+        [c.drink_id for c in record.Checkpoints().order_by('drink__id')])
+    incremental = sorted(models.StatsCheckpoint.objects.values_list(
+        'scope', 'user', 'keg', 'session', 'drink'))
+
+    stats.RebuildAllStats(self.site)
+    rebuilt = sorted(models.StatsCheckpoint.objects.values_list(
+        'scope', 'user', 'keg', 'session', 'drink'))
+    self.assertEquals(incremental, rebuilt)
+
+    # Query stats as of each drink, by id and by time.
+    for drink in drinks:
+      expected = stats.SystemStatsBuilder(drink).Build()
+      as_of = record.StatsAsOf(drink_id=drink.id)
+      self.assertStatsEqual(expected, _StatsFromDict(as_of.stats))
+      as_of = record.StatsAsOf(time=drink.time)
+      self.assertStatsEqual(expected, _StatsFromDict(as_of.stats))
+    self.assertEquals(None, record.StatsAsOf(drink_id=0))
+
+    user_record = models.UserStats.objects.get(user=drinks[1].user)
+    expected = stats.DrinkerStatsBuilder(drinks[1]).Build()
+    as_of = user_record.StatsAsOf(drink_id=drinks[4].id)
+    self.assertStatsEqual(expected, _StatsFromDict(as_of.stats))
+
+    # Cancelling a drink discards the checkpoints which include it.
+    self.backend.CancelDrink(drinks[3].id)
+    self.assertEquals([2], [c.drink_id for c in record.Checkpoints()])
+    record = models.SystemStats.objects.get(site=self.site)
+    expected = stats.SystemStatsBuilder(drinks[-1]).Build()
+    as_of = record.StatsAsOf(drink_id=drinks[-1].id)
+    self.assertStatsEqual(expected, _StatsFromDict(as_of.stats))
+    self.assertStatsEqual(expected, _StatsFromDict(record.stats))
+
+  @unittest.skipUnless(settings.HAVE_NUMPY, 'NumPy is not installed.')
+  def testNumpyFoldDrinks(self):
+    from . import stats_numpy
+    keg = self._makeKeg()
+    drinks = self._recordDrinks()
+    # Add a tie for the greatest pour, and an empty pour.
+    for volume_ml, username in ((450, 'user1'), (0, None)):
+      self.backend.RecordDrink('kegboard.flow0', ticks=volume_ml,
+          volume_ml=volume_ml, username=username, pour_time=drinks[-1].time,
+          duration=volume_ml / 20, do_postprocess=False)
+
+    old_interval = kb_common.STATS_CHECKPOINT_INTERVAL
+    kb_common.STATS_CHECKPOINT_INTERVAL = 2
+    try:
+      rows = list(self.site.drinks.valid().order_by('id').values_list('id',
+          'volume_ml', 'time', 'user_id', 'user__username', 'keg_id',
+          'session_id', 'session__start_time', 'duration'))
+      expected = stats.FoldDrinks(rows, len(rows))
+      actual = stats_numpy.FoldDrinks(rows, len(rows))
+    finally:
+      kb_common.STATS_CHECKPOINT_INTERVAL = old_interval
+
+    self.assertEquals(expected[0].ToDict(), actual[0].ToDict())
+    for expected_scope, actual_scope in zip(expected[1:4], actual[1:4]):
+      self.assertEquals(sorted(expected_scope.keys()),
+          sorted(actual_scope.keys()))
+      for key, acc in expected_scope.iteritems():
+        self.assertEquals(acc.ToDict(), actual_scope[key].ToDict())
+    self.assertEquals(sorted(expected[4]), sorted(actual[4]))
+
+    columns = stats_numpy.DrinkColumns.FromQuerySet(keg.drinks.valid())
+    expected = stats.KegStatsBuilder(keg.drinks.valid().latest('id')).Build()
+    self.assertStatsEqual(expected, columns.Accumulate().ToProto())
+
+  def testPourDistributions(self):
+    drinks = self._recordProcessedDrinks()
+    keg = drinks[0].keg
+    self._assertStatsMatchDrinks()
+
+    summary = models.KegStats.objects.get(keg=keg).PourDistributions()
+    volumes = summary['pour_volume']
+    self.assertEquals(4, volumes['count'])
+    self.assertEquals([0, 1, 2, 0, 1, 0, 0, 0, 0],
+        [bucket['count'] for bucket in volumes['histogram']])
+    self.assertEquals((None, 50), (volumes['histogram'][0]['min'],
+        volumes['histogram'][0]['max']))
+    self.assertAlmostEqual(100, volumes['p50'], delta=1)
+    self.assertAlmostEqual(120, volumes['p99'], delta=1.2)
+    durations = summary['pour_duration']
+    self.assertEquals([0, 2, 1, 1, 0, 0, 0, 0],
+        [bucket['count'] for bucket in durations['histogram']])
+
+    # Distributions missing from stored stats are computed on demand, but
+    # not saved.
+    record = models.SystemStats.objects.get(site=self.site)
+    expected = record.PourDistributions()
+    del record.stats[stats.StatsAccumulator.STATE_KEY]['pour_volumes']
+    record.save()
+    self.assertEquals(expected, record.PourDistributions())
+    record = models.SystemStats.objects.get(site=self.site)
+    self.assertFalse('pour_volumes' in
+        record.stats[stats.StatsAccumulator.STATE_KEY])
+
+    # Stats stored without any state are updated by the next drink, without
+    # being rebuilt from its scope's history.
+    del record.stats[stats.StatsAccumulator.STATE_KEY]
+    record.save()
+    drink = self.backend.RecordDrink('kegboard.flow1', ticks=80, volume_ml=80,
+        pour_time=drinks[-1].time, duration=2, do_postprocess=False)
+    # A SELECT and an UPDATE for each of the system and session stats, and
+    # one query for the first drink of the session.
+    with self.assertNumQueries(5):
+      models.Drink._UpdateAllStats([drink])
+    self._assertStatsMatchDrinks()
+
+  def testQuantileSketch(self):
+    sketch_lib = stats.sketch
+    values = [x * 0.7 for x in range(1, 2001)]
+    sketch = sketch_lib.QuantileSketch()
+    other = sketch_lib.QuantileSketch()
+    for i, value in enumerate(values):
+      (sketch if i % 2 else other).Add(value)
+    sketch.Add(0)
+    sketch.Merge(other)
+    sketch.Remove(0)
+    self.assertEquals(len(values), sketch.count)
+    for q in (0.01, 0.5, 0.9, 0.99):
+      exact = values[int(q * (len(values) - 1))]
+      self.assertAlmostEqual(exact, sketch.Quantile(q),
+          delta=exact * sketch.RELATIVE_ACCURACY)
+    # Memory is bounded by the range of values, not their number.
+    self.assertTrue(len(sketch.bins) < 500)
+    self.assertEquals(sketch.bins,
+        sketch_lib.QuantileSketch.FromDict(sketch.ToDict()).bins)
+    self.assertEquals(None, sketch_lib.QuantileSketch().Quantile(0.5))
+
+  def _rollupRows(self):
+    return sorted(models.VolumeRollup.objects.values_list('scope', 'keg',
+        'user', 'tap', 'scope_key', 'granularity', 'start_time', 'volume_ml',
+        'pours', 'cumulative_volume_ml', 'cumulative_pours'))
+
+  def testVolumeRollups(self):
+    drinks = self._recordProcessedDrinks()
+    keg = drinks[0].keg
+
+    self.assertEquals((1220.0, 6), models.VolumeRollup.Totals(self.site))
+    self.assertEquals(1220.0, models.VolumeRollup.objects.filter(
+        scope='system', granularity='day').latest('start_time').cumulative_volume_ml)
+    self.assertEquals((1220.0, 6),
+        models.VolumeRollup.Totals(self.site, granularity='hour'))
+    self.assertEquals((570.0, 4),
+        models.VolumeRollup.Totals(self.site, keg=keg))
+    self.assertEquals((150.0, 2),
+        models.VolumeRollup.Totals(self.site, user=self.users[0]))
+    self.assertEquals((650.0, 2),
+        models.VolumeRollup.Totals(self.site, tap=self.taps[1]))
+
+    # The first day, in the local time zone.
+    since = models.VolumeRollup.BucketStart(drinks[0].time, 'day')
+    until = since + datetime.timedelta(days=1)
+    days = models.VolumeRollup.Buckets(self.site, 'day', since=since,
+        until=until)
+    self.assertEquals([(since, 600.0, 3)],
+        [(r.start_time, r.volume_ml, r.pours) for r in days])
+    hours = models.VolumeRollup.Buckets(self.site, 'hour', since=since,
+        until=until)
+    self.assertEquals([100.0, 200.0, 300.0], [r.volume_ml for r in hours])
+
+    incremental = self._rollupRows()
+    models.VolumeRollup.RebuildAll(self.site)
+    self.assertEquals(incremental, self._rollupRows())
+
+    # Each scope has at most one rollup per bucket, even for scopes whose
+    # keg, user and tap are all null.
+    rollup = models.VolumeRollup.objects.filter(scope='system')[0]
+    rollup.id = None
+    self.assertRaises(IntegrityError, rollup.save)
+
+    self.backend.CancelDrink(drinks[1].id)
+    self.backend.SetDrinkVolume(drinks[0].id, 150)
+    self.assertEquals((1070.0, 5), models.VolumeRollup.Totals(self.site))
+    self.assertEquals([150.0, 300.0],
+        [r.volume_ml for r in models.VolumeRollup.Buckets(self.site, 'hour',
+            since=since, until=until)])
+    incremental = self._rollupRows()
+    models.VolumeRollup.RebuildAll(self.site)
+    self.assertEquals(incremental, self._rollupRows())
+
+  def testWindowStats(self):
+    drinks = self._recordProcessedDrinks()
+
+    window = models.VolumeRollup.WindowStats(self.site,
+        since=drinks[1].time, until=drinks[3].time)
+    self.assertEquals(500.0, window['total_volume_ml'])
+    self.assertEquals(2, window['total_pours'])
+    self.assertEquals(250.0, window['average_volume_ml'])
+
+    window = models.VolumeRollup.WindowStats(self.site, user=self.users[1],
+        since=drinks[2].time)
+    self.assertEquals((120.0, 1),
+        (window['total_volume_ml'], window['total_pours']))
+
+    # A drink back-dated into the window.
+    self.backend.RecordDrink('kegboard.flow1', ticks=25, volume_ml=25,
+        username='user2', pour_time=drinks[1].time + datetime.timedelta(minutes=5))
+    window = models.VolumeRollup.WindowStats(self.site,
+        since=drinks[1].time, until=drinks[3].time)
+    self.assertEquals((525.0, 3),
+        (window['total_volume_ml'], window['total_pours']))
+    window = models.VolumeRollup.WindowStats(self.site, since=drinks[3].time)
+    self.assertEquals((620.0, 3),
+        (window['total_volume_ml'], window['total_pours']))
+
+    now = drinks[-1].time + datetime.timedelta(days=3)
+    since, until = models.VolumeRollup.Window('last_7d', now=now)
+    self.assertEquals(None, until)
+    window = models.VolumeRollup.WindowStats(self.site, since=since)
+    self.assertEquals((120.0, 1),
+        (window['total_volume_ml'], window['total_pours']))
+    since, until = models.VolumeRollup.Window('this_year', now=now)
+    self.assertEquals((1, 1, 0), (since.month, since.day, since.hour))
+    self.assertRaises(ValueError, models.VolumeRollup.Window, 'bogus')
+
+  def _leaderboardRows(self):
+    return sorted(models.LeaderboardEntry.objects.values_list('scope', 'keg',
+        'session', 'period_start', 'scope_key', 'user', 'volume_ml', 'pours'))
+
+  def testLeaderboards(self):
+    drinks = self._recordProcessedDrinks()
+    keg = drinks[0].keg
+    user1, user2, user3 = self.users
+
+    with self.assertNumQueries(1):
+      leaders = models.LeaderboardEntry.TopDrinkers(self.site)
+      for volume_ml, user in leaders:
+        user.get_profile().mugshot
+    self.assertEquals([(450.0, user3), (320.0, user2), (150.0, user1)], leaders)
+    self.assertEquals([(150.0, user1), (120.0, user2)], keg.TopDrinkers())
+    self.assertEquals([(450.0, user3), (200.0, user2)],
+        models.LeaderboardEntry.TopDrinkers(self.site, scope='year',
+            when=drinks[0].time, limit=2))
+    self.assertEquals([(120.0, user2)],
+        models.LeaderboardEntry.TopDrinkers(self.site, scope='session',
+            session=drinks[-1].session))
+
+    entry = models.LeaderboardEntry.GetEntry(self.site, user2)
+    self.assertEquals(2, entry.Rank())
+    entry = models.LeaderboardEntry.GetEntry(self.site, user1, scope='keg',
+        keg=keg)
+    self.assertEquals(1, entry.Rank())
+
+    incremental = self._leaderboardRows()
+    models.LeaderboardEntry.RebuildAll(self.site)
+    self.assertEquals(incremental, self._leaderboardRows())
+
+    self.backend.CancelDrink(drinks[4].id)
+    self.backend.SetDrinkVolume(drinks[0].id, 10)
+    self.assertEquals([(320.0, user2), (60.0, user1)],
+        models.LeaderboardEntry.TopDrinkers(self.site))
+    incremental = self._leaderboardRows()
+    models.LeaderboardEntry.RebuildAll(self.site)
+    self.assertEquals(incremental, self._leaderboardRows())
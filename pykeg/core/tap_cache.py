@@ -0,0 +1,112 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Process-wide cache of each site's taps, their kegs, and the default user.
+
+Every pour looks up its tap by meter name, and then the tap's current keg
+and the site's default user.  This module keeps those per process, loaded in
+two queries per site, and shares a version key through Django's cache so
+that all processes notice changes (with a cache backend shared between
+them, such as memcached): saving or deleting a KegTap, Keg,
+SiteSettings, BeerType or KegSize replaces the version, and each process
+reloads when it next sees a new one.
+
+Cached instances are shared between threads, and must not be modified.
+Because the version changes when a model is saved rather than when its
+transaction commits, another process may briefly reload data from before the
+change; entries are therefore also reloaded after MAX_AGE_SECS.
+"""
+
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+VERSION_KEY = 'kegbot:tap_cache:version'
+
+# Longest time an entry is used without reloading.
+MAX_AGE_SECS = 60
+
+_ENTRIES = {}
+_LOCK = threading.Lock()
+
+
+class _SiteTaps(object):
+  def __init__(self, site_id, version):
+    from pykeg.core import models
+    self.version = version
+    self.loaded = time.time()
+    self.taps = list(models.KegTap.objects.filter(site=site_id).select_related(
+        'current_keg', 'current_keg__type', 'current_keg__size',
+        'temperature_sensor').order_by('name'))
+    self.by_meter_name = dict((tap.meter_name, tap) for tap in self.taps)
+    default_users = models.SiteSettings.objects.filter(
+        site=site_id).values_list('default_user', flat=True)
+    self.default_user_id = default_users[0] if default_users else None
+
+  def IsCurrent(self, version):
+    return (self.version == version and
+        time.time() - self.loaded < MAX_AGE_SECS)
+
+
+def _GetVersion():
+  version = cache.get(VERSION_KEY)
+  if version is None:
+    version = uuid.uuid4().hex
+    if not cache.add(VERSION_KEY, version):
+      version = cache.get(VERSION_KEY) or version
+  return version
+
+
+def _GetEntry(site):
+  # Read the version before loading, so that a change made while loading
+  # will cause another load.
+  version = _GetVersion()
+  entry = _ENTRIES.get(site.id)
+  if not entry or not entry.IsCurrent(version):
+    entry = _SiteTaps(site.id, version)
+    with _LOCK:
+      _ENTRIES[site.id] = entry
+  return entry
+
+
+def GetTap(site, meter_name):
+  """Returns the site's tap with the given meter name, or None."""
+  return _GetEntry(site).by_meter_name.get(meter_name)
+
+
+def GetTaps(site):
+  """Returns all of the site's taps, ordered by name."""
+  return list(_GetEntry(site).taps)
+
+
+def GetDefaultUserId(site):
+  """Returns the id of the site's default user, or None."""
+  return _GetEntry(site).default_user_id
+
+
+def Invalidate(**kwargs):
+  """Causes every process to reload its entries.
+
+  Accepts and ignores signal arguments, so it may be connected to model
+  signals directly.
+  """
+  cache.set(VERSION_KEY, uuid.uuid4().hex)
+  with _LOCK:
+    _ENTRIES.clear()
@@ -0,0 +1,78 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+from django.core.cache import cache
+from django.test import TransactionTestCase
+
+from . import backend
+from . import models
+from . import tap_cache
+
+class TapCacheTestCase(TransactionTestCase):
+  def setUp(self):
+    self.site = models.KegbotSite.objects.create(name='default')
+    self.backend = backend.KegbotBackend(site=self.site)
+    self.tap = self.backend.CreateTap('tap1', 'kegboard.flow0',
+        ml_per_tick=0.5)
+    self.user = self.backend.CreateNewUser('user1')
+
+  def testCache(self):
+    with self.assertNumQueries(2):
+      self.assertEquals(self.tap.id,
+          tap_cache.GetTap(self.site, 'kegboard.flow0').id)
+    with self.assertNumQueries(0):
+      self.assertEquals(None, tap_cache.GetTap(self.site, 'kegboard.flow1'))
+      self.assertEquals([self.tap.id],
+          [t.id for t in tap_cache.GetTaps(self.site)])
+      self.assertEquals(None, tap_cache.GetDefaultUserId(self.site))
+
+    # Changes to taps, kegs and settings are seen.
+    brewer = models.Brewer.objects.create(name='Test Brewer')
+    style = models.BeerStyle.objects.create(name='Test Style')
+    beer_type = models.BeerType.objects.create(name='Test Beer',
+        brewer=brewer, style=style)
+    size = models.KegSize.objects.create(name='Test Size', volume_ml=1000)
+    keg = models.Keg.objects.create(site=self.site, type=beer_type,
+        size=size, status='online')
+    self.tap.current_keg = keg
+    self.tap.save()
+    tap = tap_cache.GetTap(self.site, 'kegboard.flow0')
+    with self.assertNumQueries(0):
+      self.assertEquals('Test Beer', tap.current_keg.type.name)
+      self.assertEquals(1000, tap.current_keg.size.volume_ml)
+
+    keg.status = 'offline'
+    keg.save()
+    self.assertEquals(None, self.backend._GetKegForTapName('kegboard.flow0'))
+
+    self.site.settings.default_user = self.user
+    self.site.settings.save()
+    drink = self.backend.RecordDrink('kegboard.flow0', ticks=100)
+    self.assertEquals(self.user, drink.user)
+    self.assertEquals(None, drink.keg)
+
+    # Another process's change is seen through the shared version.
+    models.KegTap.objects.filter(id=self.tap.id).update(ml_per_tick=0.25)
+    tap = tap_cache.GetTap(self.site, 'kegboard.flow0')
+    self.assertEquals(0.5, tap.ml_per_tick)
+    cache.set(tap_cache.VERSION_KEY, 'other')
+    tap = tap_cache.GetTap(self.site, 'kegboard.flow0')
+    self.assertEquals(0.25, tap.ml_per_tick)
+
+    self.tap.delete()
+    self.assertEquals(None, tap_cache.GetTap(self.site, 'kegboard.flow0'))
@@ -0,0 +1,129 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Tiered retention of temperature sensor readings.
+
+Thermolog keeps a sensor's readings at 1-minute resolution.  Downsample(),
+run periodically by kb_compress_temps, moves older history to coarser
+ThermoSummary records:
+
+  * readings are kept as they are for RAW_RETENTION;
+  * then as 15-minute minimum/average/maximum summaries for
+    SUMMARY_RETENTION;
+  * then as hourly summaries, forever.
+
+Readings which arrive late (for example, when a journal is replayed) are
+merged into any existing summary for their period.
+"""
+
+import datetime
+
+from django.db import transaction
+from django.utils import timezone
+
+from pykeg.core import models
+
+RAW_RETENTION = datetime.timedelta(hours=24)
+SUMMARY_RETENTION = datetime.timedelta(days=90)
+
+SUMMARY_PERIOD_SECS = 15 * 60
+HOURLY_PERIOD_SECS = 60 * 60
+
+
+def _PeriodStart(when, period):
+  """Rounds `when` down to the start of its period, which must divide an
+  hour."""
+  seconds = when.minute * 60 + when.second
+  return when.replace(minute=0, second=0, microsecond=0) + \
+      datetime.timedelta(seconds=seconds - seconds % period)
+
+
+def _Add(buckets, start, num_readings, min_temp, total, max_temp):
+  bucket = buckets.get(start)
+  if bucket:
+    buckets[start] = (bucket[0] + num_readings, min(bucket[1], min_temp),
+        bucket[2] + total, max(bucket[3], max_temp))
+  else:
+    buckets[start] = (num_readings, min_temp, total, max_temp)
+
+
+def _Save(sensor, period, buckets):
+  for start, (num_readings, min_temp, total, max_temp) in buckets.iteritems():
+    summary, created = models.ThermoSummary.objects.get_or_create(
+        sensor=sensor, period=period, time=start, defaults={
+          'site': sensor.site,
+          'min_temp': min_temp,
+          'avg_temp': total / num_readings,
+          'max_temp': max_temp,
+        })
+    summary.Merge(num_readings, min_temp, total / num_readings, max_temp)
+    summary.save()
+
+
+def DownsampleSensor(sensor, now=None):
+  """Downsamples one sensor's history.
+
+  Returns the number of readings and of 15-minute summaries which were
+  folded into coarser records.
+  """
+  if not now:
+    now = timezone.now()
+
+  cutoff = _PeriodStart(now - RAW_RETENTION, SUMMARY_PERIOD_SECS)
+  readings = sensor.thermolog_set.filter(time__lt=cutoff).order_by('id')
+  buckets = {}
+  last_id = None
+  num_readings = 0
+  for reading in readings.iterator():
+    _Add(buckets, _PeriodStart(reading.time, SUMMARY_PERIOD_SECS), 1,
+        reading.temp, reading.temp, reading.temp)
+    last_id = reading.id
+    num_readings += 1
+  if last_id is not None:
+    _Save(sensor, SUMMARY_PERIOD_SECS, buckets)
+    # Leave any reading logged since the query for the next run.
+    readings.filter(id__lte=last_id).delete()
+
+  cutoff = _PeriodStart(now - SUMMARY_RETENTION, HOURLY_PERIOD_SECS)
+  summaries = sensor.thermosummary_set.filter(period=SUMMARY_PERIOD_SECS,
+      time__lt=cutoff)
+  buckets = {}
+  num_summaries = 0
+  for summary in summaries.iterator():
+    _Add(buckets, _PeriodStart(summary.time, HOURLY_PERIOD_SECS),
+        summary.num_readings, summary.min_temp,
+        summary.avg_temp * summary.num_readings, summary.max_temp)
+    num_summaries += 1
+  if num_summaries:
+    _Save(sensor, HOURLY_PERIOD_SECS, buckets)
+    summaries.delete()
+
+  return num_readings, num_summaries
+
+
+def Downsample(now=None):
+  """Downsamples every sensor, each in its own transaction.
+
+  Returns a list of (sensor, num_readings, num_summaries).
+  """
+  ret = []
+  for sensor in models.ThermoSensor.objects.all():
+    with transaction.commit_on_success():
+      num_readings, num_summaries = DownsampleSensor(sensor, now)
+    ret.append((sensor, num_readings, num_summaries))
+  return ret
@@ -0,0 +1,94 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+
+from django.test import TransactionTestCase
+
+from . import backend
+from . import models
+from . import thermo
+from .testutils import make_datetime
+
+class ThermoTestCase(TransactionTestCase):
+  def setUp(self):
+    self.site = models.KegbotSite.objects.create(name='default')
+    self.backend = backend.KegbotBackend(site=self.site)
+    self.now = make_datetime(2013, 6, 1, 12, 5)
+
+  def _log(self, temp, **kwargs):
+    when = self.now - datetime.timedelta(**kwargs)
+    return self.backend.LogSensorReading('sensor1', temp, when=when)
+
+  def testDownsample(self):
+    # Old readings are no longer deleted when new ones are logged.
+    self._log(2.0, days=100, minutes=1)
+    self._log(4.0, days=100)
+    self._log(3.0, days=2, minutes=1)
+    self._log(5.0, days=2)
+    self._log(6.0, days=2, minutes=-20)
+    self._log(7.0, hours=1)
+    self.assertEquals(6, models.Thermolog.objects.count())
+
+    sensor = models.ThermoSensor.objects.get()
+    self.assertEquals((5, 1), thermo.DownsampleSensor(sensor, self.now))
+    self.assertEquals([7.0], [r.temp for r in models.Thermolog.objects.all()])
+
+    summaries = models.ThermoSummary.objects.order_by('time')
+    self.assertEquals([
+        (thermo.HOURLY_PERIOD_SECS, make_datetime(2013, 2, 21, 12, 0),
+            2, 2.0, 3.0, 4.0),
+        (thermo.SUMMARY_PERIOD_SECS, make_datetime(2013, 5, 30, 12, 0),
+            2, 3.0, 4.0, 5.0),
+        (thermo.SUMMARY_PERIOD_SECS, make_datetime(2013, 5, 30, 12, 15),
+            1, 6.0, 6.0, 6.0),
+      ], [(s.period, s.time, s.num_readings, s.min_temp, s.avg_temp,
+          s.max_temp) for s in summaries])
+
+    # A late reading is merged into its existing summary.
+    self._log(9.0, days=2, minutes=-1)
+    self.assertEquals((1, 0), thermo.DownsampleSensor(sensor, self.now))
+    summary = models.ThermoSummary.objects.get(
+        time=make_datetime(2013, 5, 30, 12, 0))
+    self.assertEquals((3, 3.0, 17.0 / 3, 9.0), (summary.num_readings,
+        summary.min_temp, summary.avg_temp, summary.max_temp))
+
+    self.assertEquals([(sensor, 0, 0)], thermo.Downsample(self.now))
+
+  def testLogSensorReadings(self):
+    existing = self._log(2.0, minutes=5)
+    records = self.backend.LogSensorReadings([
+      {'sensor_name': 'sensor1', 'temperature': 3.0,
+          'when': self.now - datetime.timedelta(minutes=5, seconds=-30)},
+      {'sensor_name': 'sensor2', 'temperature': 4.0, 'when': self.now},
+      {'sensor_name': 'sensor2', 'temperature': 5.0,
+          'when': self.now + datetime.timedelta(seconds=10)},
+      {'sensor_name': 'sensor3', 'temperature': 6.0},
+    ])
+    self.assertEquals(3, models.ThermoSensor.objects.count())
+    self.assertEquals(3, models.Thermolog.objects.count())
+    self.assertEquals(existing.id, records[0].id)
+    self.assertEquals(3.0, models.Thermolog.objects.get(id=existing.id).temp)
+    self.assertEquals(records[1].id, records[2].id)
+    self.assertEquals(5.0, models.Thermolog.objects.get(id=records[1].id).temp)
+    self.assertEquals('sensor3', records[3].sensor.raw_name)
+    self.assertTrue(all(r.id for r in records))
+
+    self.assertRaises(ValueError, self.backend.LogSensorReadings,
+        [{'sensor_name': 'sensor1', 'temperature': 1000.0}])
+    self.assertEquals([], self.backend.LogSensorReadings([]))
@@ -20,17 +20,36 @@
 
 A Kegbot core may report a time series (Drink.tick_time_series) for the meter
 events that caused a drink.
+
+A series has two string forms.  The text form, which cores report and the API
+returns, is a sequence of <time>:<amount> pairs.  The compact form, in which
+drinks are stored, is COMPACT_PREFIX followed by base64: each pair is the
+change in time from the previous pair and the amount, as zigzag-encoded
+varints.  from_string() accepts either form; time_series_numpy parses either
+into arrays.
 """
 
+import base64
+import re
+
+# Marks the compact form; the text form always starts with a digit.
+COMPACT_PREFIX = 'v1:'
+
+_BASE64_RE = re.compile(r'^[A-Za-z0-9+/]*={0,2}$')
+
 def from_string(s):
   """Converts a time series to a list of (int, int) tuples.
 
-  The string should be a sequence of zero or more <time>:<amount> pairs.
-  Whitespace delimits each pair; leading and trailing whitespace is ignored.
+  The string should be in compact form, or a sequence of zero or more
+  <time>:<amount> pairs.  Whitespace delimits each pair; leading and trailing
+  whitespace is ignored.
 
   ValueError is raised on any malformed input.
   """
-  pairs = s.strip().split()
+  s = s.strip()
+  if s.startswith(COMPACT_PREFIX):
+    return _from_compact_string(s)
+  pairs = s.split()
   ret = []
   for pair in pairs:
     time, amount = pair.split(':')
@@ -44,3 +63,60 @@ def from_string(s):
 def to_string(pairs):
   """Converts a series of (int, int) tuples to a time series string."""
   return ' '.join('%i:%i' % pair for pair in pairs)
+
+def to_compact_string(pairs):
+  """Converts a series of (int, int) tuples to a compact time series string."""
+  out = bytearray()
+  prev = 0
+  for time, amount in pairs:
+    _put_varint(out, _zigzag(time - prev))
+    _put_varint(out, _zigzag(amount))
+    prev = time
+  return COMPACT_PREFIX + base64.b64encode(str(out))
+
+def decode_compact(s):
+  """Returns the bytes of a compact time series string."""
+  data = s.strip()[len(COMPACT_PREFIX):]
+  if not _BASE64_RE.match(data):
+    raise ValueError('Malformed time series.')
+  try:
+    return base64.b64decode(data)
+  except TypeError, e:
+    raise ValueError('Malformed time series: %s' % e)
+
+def _zigzag(n):
+  if n < 0:
+    return -2 * n - 1
+  return 2 * n
+
+def _unzigzag(n):
+  if n & 1:
+    return -(n >> 1) - 1
+  return n >> 1
+
+def _put_varint(out, n):
+  while n > 0x7f:
+    out.append(0x80 | (n & 0x7f))
+    n >>= 7
+  out.append(n)
+
+def _from_compact_string(s):
+  values = []
+  n = shift = 0
+  for b in bytearray(decode_compact(s)):
+    n |= (b & 0x7f) << shift
+    if b & 0x80:
+      shift += 7
+    else:
+      values.append(_unzigzag(n))
+      n = shift = 0
+  if shift or len(values) % 2:
+    raise ValueError('Time series is truncated.')
+  ret = []
+  time = 0
+  for i in xrange(0, len(values), 2):
+    time += values[i]
+    if time < 0:
+      raise ValueError('Time cannot be less than zero: %s' % time)
+    ret.append((time, values[i + 1]))
+  return ret
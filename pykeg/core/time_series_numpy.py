@@ -0,0 +1,78 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Vectorized time series parsing with NumPy.
+
+from_string() parses either form of a time series (see time_series) into
+arrays, without a Python loop over its pairs.  This module requires NumPy;
+check settings.HAVE_NUMPY before importing it.
+"""
+
+import re
+
+import numpy
+
+from pykeg.core import time_series
+
+_TEXT_RE = re.compile(r'^\s*(?:\d+:-?\d+(?:\s+|$))*$')
+
+# Longest varint whose value fits an int64.
+_MAX_VARINT_BYTES = 9
+
+
+def from_string(s):
+  """Converts a time series to a (times, amounts) pair of int64 arrays.
+
+  ValueError is raised on any malformed input, as by time_series.from_string().
+  """
+  s = s.strip()
+  if s.startswith(time_series.COMPACT_PREFIX):
+    return _from_compact_string(s)
+  if not _TEXT_RE.match(s):
+    raise ValueError('Malformed time series.')
+  values = numpy.fromstring(s.replace(':', ' '), dtype=numpy.int64, sep=' ')
+  return values[0::2], values[1::2]
+
+
+def _from_compact_string(s):
+  data = numpy.frombuffer(time_series.decode_compact(s), dtype=numpy.uint8)
+  if not len(data):
+    empty = numpy.zeros(0, dtype=numpy.int64)
+    return empty, empty
+  if data[-1] & 0x80:
+    raise ValueError('Time series is truncated.')
+
+  # Each varint ends with the first byte whose high bit is clear.
+  ends = numpy.flatnonzero((data & 0x80) == 0)
+  starts = numpy.concatenate(([0], ends[:-1] + 1))
+  lengths = ends - starts + 1
+  if lengths.max() > _MAX_VARINT_BYTES:
+    raise ValueError('Time series value is too large.')
+  positions = numpy.arange(len(data)) - numpy.repeat(starts, lengths)
+  parts = (data & 0x7f).astype(numpy.uint64) << \
+      (7 * positions).astype(numpy.uint64)
+  zigzagged = numpy.add.reduceat(parts, starts)
+  values = (zigzagged >> numpy.uint64(1)).astype(numpy.int64) ^ \
+      -(zigzagged & numpy.uint64(1)).astype(numpy.int64)
+  if len(values) % 2:
+    raise ValueError('Time series is truncated.')
+
+  times = numpy.cumsum(values[0::2])
+  if len(times) and times.min() < 0:
+    raise ValueError('Time cannot be less than zero: %s' % times.min())
+  return times, values[1::2]
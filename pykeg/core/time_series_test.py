@@ -1,6 +1,9 @@
 #!/usr/bin/env python
 
 import unittest
+
+from django.conf import settings
+
 from pykeg.core import time_series
 
 class TimeSeriesTestCase(unittest.TestCase):
@@ -11,5 +14,36 @@ class TimeSeriesTestCase(unittest.TestCase):
 
     self.assertEqual(s.strip(), time_series.to_string(expected))
 
+  def testCompact(self):
+    pairs = [(0, 12), (45, 6789), (45, -3), (20, 0), (2 ** 40, 1)]
+    s = time_series.to_compact_string(pairs)
+    self.assertTrue(s.startswith(time_series.COMPACT_PREFIX))
+    self.assertEqual(pairs, time_series.from_string(s))
+    self.assertEqual([], time_series.from_string(
+        time_series.to_compact_string([])))
+
+    text = ' '.join('%i:%i' % (i * 100, 7) for i in range(100))
+    compact = time_series.to_compact_string(time_series.from_string(text))
+    self.assertTrue(len(compact) < len(text) * 2 / 3)
+
+    for bad in ('1:2:3', '-1:2', 'v1:!!!', s[:-4], 'v1:gA=='):
+      self.assertRaises(ValueError, time_series.from_string, bad)
+
+  @unittest.skipUnless(settings.HAVE_NUMPY, 'NumPy is not installed.')
+  def testNumpy(self):
+    from pykeg.core import time_series_numpy
+    pairs = [(0, 12), (45, 6789), (45, -3), (20, 0), (2 ** 40, 1)]
+    for s in (time_series.to_string(pairs),
+        time_series.to_compact_string(pairs)):
+      times, amounts = time_series_numpy.from_string(s)
+      self.assertEqual(pairs, zip(times.tolist(), amounts.tolist()))
+    for s in ('', ' ', time_series.to_compact_string([])):
+      times, amounts = time_series_numpy.from_string(s)
+      self.assertEqual((0, 0), (len(times), len(amounts)))
+    s = time_series.to_compact_string(pairs)
+    for bad in ('1:2:3', '1:22:3', '-1:2', '1:2 3', s[:-4], 'v1:gA==',
+        time_series.to_compact_string([(2 ** 62, 0)])):
+      self.assertRaises(ValueError, time_series_numpy.from_string, bad)
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,103 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of authentication token lookups.
+
+Tokens are looked up on every RFID or OneWire swipe, and each lookup costs a
+query for the token, and more to serialize its user and mugshot.  GetToken()
+caches the serialized token in Django's cache, and also caches misses, so
+that an unknown token does not cost a query on every swipe either.
+
+Entries live under a version key which is replaced whenever an
+AuthenticationToken, User or UserProfile is saved or deleted, so edits and
+newly created tokens are seen at once.  An entry never outlives its token's
+`expire_time`.
+"""
+
+import hashlib
+import uuid
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from pykeg.core import backend
+from pykeg.core import kb_common
+from pykeg.proto import protolib
+
+VERSION_KEY = 'kegbot:token_cache:version'
+
+# Lifetime of entries for known and unknown tokens.
+TIMEOUT_SECS = 300
+MISS_TIMEOUT_SECS = 60
+
+# Cached in place of an unknown token.
+_MISSING = 'missing'
+
+
+def _GetVersion():
+  version = cache.get(VERSION_KEY)
+  if version is None:
+    version = uuid.uuid4().hex
+    if not cache.add(VERSION_KEY, version):
+      version = cache.get(VERSION_KEY) or version
+  return version
+
+
+def _Key(site, auth_device, token_value):
+  if token_value and auth_device in kb_common.AUTH_MODULE_NAMES_HEX_VALUES:
+    token_value = token_value.lower()
+  digest = hashlib.md5('%s:%s' % (auth_device, token_value)).hexdigest()
+  return 'kegbot:token_cache:%s:%s:%s' % (_GetVersion(), site.id, digest)
+
+
+def _Timeout(token):
+  if token.expire_time:
+    remaining = (token.expire_time - timezone.now()).total_seconds()
+    if 0 < remaining < TIMEOUT_SECS:
+      return max(int(remaining), 1)
+  return TIMEOUT_SECS
+
+
+def GetToken(b, auth_device, token_value):
+  """Returns the token, as serialized for the API, for KegbotBackend `b`.
+
+  Raises backend.NoTokenError if there is no such token.
+  """
+  key = _Key(b._site, auth_device, token_value)
+  ret = cache.get(key)
+  if ret == _MISSING:
+    raise backend.NoTokenError
+  if ret is not None:
+    return ret
+  try:
+    token = b.GetAuthToken(auth_device, token_value)
+  except backend.NoTokenError:
+    cache.set(key, _MISSING, MISS_TIMEOUT_SECS)
+    raise
+  ret = protolib.ToDict(token, full=True)
+  cache.set(key, ret, _Timeout(token))
+  return ret
+
+
+def Invalidate(**kwargs):
+  """Discards all entries.
+
+  Accepts and ignores signal arguments, so it may be connected to model
+  signals directly.
+  """
+  cache.set(VERSION_KEY, uuid.uuid4().hex)
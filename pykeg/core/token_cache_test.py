@@ -0,0 +1,65 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+
+from django.test import TransactionTestCase
+from django.utils import timezone
+
+from . import backend
+from . import models
+from . import token_cache
+
+class TokenCacheTestCase(TransactionTestCase):
+  def setUp(self):
+    self.site = models.KegbotSite.objects.create(name='default')
+    self.backend = backend.KegbotBackend(site=self.site)
+
+  def testGetToken(self):
+    with self.assertNumQueries(1):
+      self.assertRaises(backend.NoTokenError, token_cache.GetToken,
+          self.backend, 'core.rfid', 'DEADBEEF')
+    with self.assertNumQueries(0):
+      self.assertRaises(backend.NoTokenError, token_cache.GetToken,
+          self.backend, 'core.rfid', 'deadbeef')
+
+    token = self.backend.CreateAuthToken('core.rfid', 'deadbeef')
+    with self.assertNumQueries(1):
+      ret = token_cache.GetToken(self.backend, 'core.rfid', 'deadbeef')
+    self.assertEquals('deadbeef', ret['token_value'])
+    self.assertTrue(ret['enabled'])
+    with self.assertNumQueries(0):
+      ret = token_cache.GetToken(self.backend, 'core.rfid', 'DeadBeef')
+
+    token.enabled = False
+    token.save()
+    ret = token_cache.GetToken(self.backend, 'core.rfid', 'deadbeef')
+    self.assertFalse(ret['enabled'])
+
+    token.delete()
+    self.assertRaises(backend.NoTokenError, token_cache.GetToken,
+        self.backend, 'core.rfid', 'deadbeef')
+
+  def testTimeout(self):
+    token = models.AuthenticationToken(auth_device='core.rfid',
+        token_value='deadbeef')
+    self.assertEquals(token_cache.TIMEOUT_SECS, token_cache._Timeout(token))
+    token.expire_time = timezone.now() + datetime.timedelta(seconds=30)
+    self.assertTrue(0 < token_cache._Timeout(token) <= 30)
+    token.expire_time = timezone.now() - datetime.timedelta(seconds=30)
+    self.assertEquals(token_cache.TIMEOUT_SECS, token_cache._Timeout(token))
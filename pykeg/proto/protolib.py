@@ -29,6 +29,7 @@ from kegbot.util import util
 
 from pykeg.contrib.soundserver import models as soundserver_models
 from pykeg.core import models
+from pykeg.core import time_series
 
 _CONVERSION_MAP = {}
 
@@ -181,7 +182,8 @@ def DrinkToProto(drink, full=False):
   ret.url = drink.get_absolute_url()
   ret.ticks = drink.ticks
   ret.volume_ml = drink.volume_ml
-  ret.session_id = drink.session.id
+  # Zero until a deferred drink has been post-processed.
+  ret.session_id = drink.session_id or 0
   ret.time = datestr(drink.time)
   ret.duration = drink.duration
   ret.status = drink.status
@@ -192,7 +194,11 @@ def DrinkToProto(drink, full=False):
   if drink.shout:
     ret.shout = drink.shout
   if drink.tick_time_series:
-    ret.tick_time_series = drink.tick_time_series
+    try:
+      ret.tick_time_series = time_series.to_string(drink.TickTimeSeries())
+    except ValueError:
+      # Series stored before they were validated are returned as they are.
+      ret.tick_time_series = drink.tick_time_series
 
   if full:
     if drink.user:
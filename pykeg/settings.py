@@ -314,6 +314,21 @@ FOURSQUARE_REQUEST_PERMISSIONS = ''
 UNTAPPD_CLIENT_ID = ''
 UNTAPPD_CLIENT_SECRET = ''
 
+### Kegbot
+
+# If True, drinks posted to the API are acknowledged as soon as they are
+# stored; sessions, stats and events are updated by a background worker.
+KEGBOT_DEFER_POSTPROCESS = False
+
+# If set, pours and sensor readings which cannot be stored because the database
+# is unavailable are appended to this local file, and replayed later.
+KEGBOT_JOURNAL_PATH = ''
+
+# If True, drinks, sensor readings and other writes made through the backend
+# are performed by a single writer thread, which commits them in batches.
+# This avoids lock contention on SQLite.
+KEGBOT_INGEST_WRITER = False
+
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 NOSE_ARGS = ['--exe']
 SKIP_SOUTH_TESTS = True
@@ -30,6 +30,18 @@ class DrinkPostForm(forms.Form):
   duration = forms.IntegerField(required=False)
   shout = forms.CharField(required=False)
   tick_time_series = forms.CharField(required=False)
+  pour_key = forms.CharField(required=False, max_length=64)
+
+class DrinkBatchItemForm(DrinkPostForm):
+  """Form to handle each pour posted to /drinks/batch/"""
+  tap = forms.CharField()
+
+class FlowUpdateForm(forms.Form):
+  """Form to handle posts to /taps/<tap_id>/flow/"""
+  ticks = forms.IntegerField(min_value=0, required=False)
+  username = forms.RegexField(required=False, max_length=30, regex=r"^[\w-]+$")
+  auth_device = forms.CharField(required=False)
+  done = forms.BooleanField(required=False)
 
 class CancelDrinkForm(forms.Form):
   """Form to handled posts to /cancel-drink/"""
@@ -42,6 +54,10 @@ class ThermoPostForm(forms.Form):
   when = forms.IntegerField(required=False)
   now = forms.IntegerField(required=False)
 
+class ThermoBatchItemForm(ThermoPostForm):
+  """Form to handle each reading posted to /thermo-logs/batch/"""
+  sensor = forms.CharField(max_length=256)
+
 class CreateKegTapForm(forms.ModelForm):
   class Meta:
     model = models.KegTap
@@ -0,0 +1,298 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Long-lived socket server for tap controllers.
+
+Controllers connect over TCP and exchange newline-delimited JSON objects,
+rather than making one HTTP request per pour or reading.  Each message names
+its `type`, and may carry an `id`, which is echoed in the reply.  The first
+message on a connection must authenticate it:
+
+  {"type": "auth", "api_key": "..."}
+
+after which these are accepted:
+
+  {"type": "pour", "tap": "kegboard.flow0", "ticks": 1100, ...}
+    Fields as for a tap POST.  Replies with the drink.
+  {"type": "thermo", "sensor": "kegboard.thermo-0", "temp_c": 4.5}
+    Replies with the sensor log.
+  {"type": "meter_update", "meter": "kegboard.flow0", "ticks": 12, ...}
+    New meter ticks for the tap's flow (see flows), optionally with
+    `username` and `auth_device`.  Replies with the flow.
+  {"type": "flow_end", "meter": "kegboard.flow0"}
+    Finishes the tap's flow, recording it as a drink.
+  {"type": "auth_token", "auth_device": "core.rfid", "token_value": "..."}
+    Replies with the token.
+
+A reply is either {"id": ..., "result": ...} or {"id": ..., "error": {...}},
+the error being as for the HTTP API.  A connection whose authentication fails
+is closed after the reply.
+
+A single asyncore loop does all of the network I/O.  Messages are handled
+one at a time, in the order received, each in its own transaction, by the
+ingest writer thread (see pykeg.core.ingest), so that a slow commit never
+stalls the loop; each reply is sent once its message has been handled.
+Messages go straight to KegbotBackend without the middleware of an HTTP
+request.
+"""
+
+import asynchat
+import asyncore
+import collections
+import logging
+import Queue
+import socket
+import sys
+
+from django.db import transaction
+from kegbot.api import kbapi
+from kegbot.util import kbjson
+
+from pykeg.core import backend
+from pykeg.core import flows
+from pykeg.core import ingest
+from pykeg.core import journal
+from pykeg.core import models
+from pykeg.core import token_cache
+from pykeg.web.api import forms
+from pykeg.web.api import util
+
+logger = logging.getLogger(__name__)
+
+# Longest message accepted; a connection sending more is closed.
+MAX_MESSAGE_BYTES = 64 * 1024
+
+
+class Session(object):
+  """State of one connection."""
+  def __init__(self):
+    self.authenticated = False
+    self.auth_failed = False
+
+
+class IngestHandler(object):
+  """Handles messages for a site, independently of any connection."""
+  def __init__(self, site, flow_table=None):
+    self.site = site
+    self.backend = backend.KegbotBackend(site=site)
+    self.flows = flow_table or flows.GetFlowTable(site)
+    self._handlers = {
+      'auth': self.HandleAuth,
+      'pour': self.HandlePour,
+      'thermo': self.HandleThermo,
+      'meter_update': self.HandleMeterUpdate,
+      'flow_end': self.HandleFlowEnd,
+      'auth_token': self.HandleAuthToken,
+    }
+
+  def HandleLine(self, session, line):
+    """Handles one line of input, returning the reply."""
+    message_id = None
+    try:
+      try:
+        message = kbjson.loads(line)
+      except ValueError:
+        raise kbapi.BadRequestError('Message is not valid JSON.')
+      if not isinstance(message, dict):
+        raise kbapi.BadRequestError('Message must be a JSON object.')
+      message_id = message.get('id')
+      handler = self._handlers.get(message.get('type'))
+      if not handler:
+        raise kbapi.BadRequestError('Unknown message type: %s' %
+            message.get('type'))
+      if session.auth_failed:
+        raise kbapi.NoAuthTokenError('Authentication failed.')
+      if handler != self.HandleAuth and not session.authenticated:
+        raise kbapi.NoAuthTokenError('Connection is not authenticated.')
+      with transaction.commit_on_success():
+        result = handler(session, message)
+      return {'id': message_id, 'result': result}
+    except Exception, e:
+      exc_info = sys.exc_info()
+      if not isinstance(e, kbapi.Error):
+        logger.error('Error handling message: %s' % e, exc_info=exc_info)
+      error, http_code = util.to_json_error(e, exc_info)
+      error['id'] = message_id
+      return error
+
+  def HandleAuth(self, session, message):
+    try:
+      util.check_api_key_value(message.get('api_key'))
+    except kbapi.Error:
+      session.auth_failed = True
+      raise
+    session.authenticated = True
+    return {'site': self.site.name}
+
+  def HandlePour(self, session, message):
+    form = forms.DrinkBatchItemForm(message)
+    if not form.is_valid():
+      raise kbapi.BadRequestError(util.form_errors(form))
+    kwargs = util.drink_kwargs(form.cleaned_data['tap'], form.cleaned_data)
+    try:
+      drink = journal.RecordDrink(self.backend, **kwargs)
+    except backend.BackendError, e:
+      raise kbapi.BadRequestError(str(e))
+    if drink is None:
+      return {'journaled': True}
+    return util.to_dict(drink)
+
+  def HandleThermo(self, session, message):
+    sensor_name = message.get('sensor')
+    if not sensor_name:
+      raise kbapi.BadRequestError('Sensor name is required.')
+    form = forms.ThermoPostForm(message)
+    if not form.is_valid():
+      raise kbapi.BadRequestError(util.form_errors(form))
+    record = journal.LogSensorReading(self.backend, sensor_name,
+        form.cleaned_data['temp_c'], util.reading_time(form.cleaned_data))
+    if record is None:
+      return {'journaled': True}
+    return util.to_dict(record)
+
+  def HandleMeterUpdate(self, session, message):
+    meter_name = message.get('meter')
+    try:
+      ticks = int(message.get('ticks'))
+    except (TypeError, ValueError):
+      raise kbapi.BadRequestError('Ticks must be an integer.')
+    if not meter_name:
+      raise kbapi.BadRequestError('Meter name is required.')
+    return self.flows.Update(meter_name, ticks,
+        username=message.get('username'),
+        auth_device=message.get('auth_device'))
+
+  def HandleFlowEnd(self, session, message):
+    flow = self.flows.Finish(message.get('meter'))
+    if not flow:
+      raise kbapi.NotFoundError('No active flow.')
+    return flow
+
+  def HandleAuthToken(self, session, message):
+    return token_cache.GetToken(self.backend, message.get('auth_device'),
+        message.get('token_value'))
+
+
+class Waker(asyncore.dispatcher):
+  """Wakes the asyncore loop to send replies handled by another thread."""
+  def __init__(self):
+    self._reader, self._writer = socket.socketpair()
+    self._writer.setblocking(False)
+    asyncore.dispatcher.__init__(self, self._reader)
+    self._ready = Queue.Queue()
+
+  def Ready(self, channel):
+    """Has the loop send the channel's completed replies; any thread."""
+    self._ready.put(channel)
+    try:
+      self._writer.send('x')
+    except socket.error:
+      # Full, so the loop is due to wake anyway.
+      pass
+
+  def writable(self):
+    return False
+
+  def handle_read(self):
+    self.recv(4096)
+    while True:
+      try:
+        channel = self._ready.get_nowait()
+      except Queue.Empty:
+        break
+      channel.SendReplies()
+
+
+class IngestChannel(asynchat.async_chat):
+  """One controller's connection."""
+  def __init__(self, handler, sock, waker):
+    asynchat.async_chat.__init__(self, sock)
+    self.set_terminator('\n')
+    self.handler = handler
+    self.waker = waker
+    self.session = Session()
+    self._buffer = []
+    self._buffered = 0
+    self._replies = collections.deque()
+
+  def collect_incoming_data(self, data):
+    if not self.connected:
+      return
+    self._buffer.append(data)
+    self._buffered += len(data)
+    if self._buffered > MAX_MESSAGE_BYTES:
+      logger.warning('Message too long, closing connection.')
+      self.close()
+
+  def found_terminator(self):
+    line = ''.join(self._buffer).strip()
+    self._buffer = []
+    self._buffered = 0
+    # Input buffered when the connection was closed, eg for a message too
+    # long, is dropped, as is any after a failed authentication.
+    if not line or not self.connected or self.session.auth_failed:
+      return
+    future = ingest.GetWriter().Submit(self._Handle, {'line': line})
+    self._replies.append(future)
+    future.AddDoneCallback(lambda f: self.waker.Ready(self))
+
+  def _Handle(self, line):
+    """Handles a line on the writer thread; returns (reply, close)."""
+    reply = self.handler.HandleLine(self.session, line)
+    return reply, self.session.auth_failed
+
+  def SendReplies(self):
+    """Sends the replies completed so far, in order."""
+    while self._replies and self._replies[0].Done():
+      try:
+        reply, close = self._replies.popleft().Result()
+      except Exception, e:
+        logger.exception('Error handling message: %s' % e)
+        self.close()
+        return
+      if not self.connected:
+        return
+      self.push(kbjson.dumps(reply, indent=None) + '\n')
+      if close:
+        self.close_when_done()
+        return
+
+
+class IngestServer(asyncore.dispatcher):
+  """Accepts controller connections."""
+  def __init__(self, host, port, site=None):
+    asyncore.dispatcher.__init__(self)
+    if not site:
+      site = models.KegbotSite.objects.get(name='default')
+    self.handler = IngestHandler(site)
+    self.waker = Waker()
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind((host, port))
+    self.listen(16)
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair is None:
+      return
+    sock, addr = pair
+    logger.info('Connection from %s:%s' % addr)
+    IngestChannel(self.handler, sock, self.waker)
+
+  def serve_forever(self):
+    asyncore.loop(timeout=1.0, use_poll=True)
@@ -0,0 +1,166 @@
+# Copyright 2013 Mike Wakerly <opensource@hoho.com>
+#
+# This file is part of the Pykeg package of the Kegbot project.
+# For more information on Pykeg or Kegbot, see http://kegbot.org/
+#
+# Pykeg is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# Pykeg is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
+
+'''Tests for ingest_server.py.'''
+
+import asyncore
+import socket
+import time
+import unittest
+
+from django.test import TransactionTestCase
+from kegbot.util import kbjson
+
+from pykeg.core import backend
+from pykeg.core import flows
+from pykeg.core import models
+
+from . import ingest_server
+
+class IngestServerTestCase(TransactionTestCase):
+  def setUp(self):
+    self.site = models.KegbotSite.objects.create(name='default')
+    self.backend = backend.KegbotBackend(site=self.site)
+    self.backend.CreateTap('tap1', 'kegboard.flow0', ml_per_tick=1/2200.0)
+    user = models.User.objects.create(username='admin', is_staff=True)
+    self.api_key = models.ApiKey.objects.create(user=user,
+        key=models.ApiKey.generate_key())
+    self.handler = ingest_server.IngestHandler(self.site,
+        flows.NewFlowTable(self.site))
+    self.session = ingest_server.Session()
+
+  def _send(self, message):
+    return self.handler.HandleLine(self.session, kbjson.dumps(message))
+
+  def testAuthentication(self):
+    reply = self._send({'type': 'pour', 'id': 1, 'tap': 'kegboard.flow0',
+        'ticks': 1100})
+    self.assertEquals(1, reply['id'])
+    self.assertEquals('NoAuthTokenError', reply['error']['code'])
+
+    reply = self._send({'type': 'auth', 'id': 2, 'api_key': 'bogus'})
+    self.assertEquals('BadApiKeyError', reply['error']['code'])
+    self.assertFalse(self.session.authenticated)
+    self.assertTrue(self.session.auth_failed)
+
+    # No second guess is checked.
+    reply = self._send({'type': 'auth', 'id': 3, 'api_key': self.api_key.key})
+    self.assertEquals('NoAuthTokenError', reply['error']['code'])
+    self.assertFalse(self.session.authenticated)
+
+    self.session = ingest_server.Session()
+    reply = self._send({'type': 'auth', 'id': 3, 'api_key': self.api_key.key})
+    self.assertEquals({'id': 3, 'result': {'site': 'default'}}, reply)
+    self.assertTrue(self.session.authenticated)
+
+  def testMessages(self):
+    self._send({'type': 'auth', 'api_key': self.api_key.key})
+
+    reply = self._send({'type': 'pour', 'id': 'p1', 'tap': 'kegboard.flow0',
+        'ticks': 1100, 'volume_ml': 250, 'pour_key': 'board-1'})
+    self.assertEquals('p1', reply['id'])
+    drink = models.Drink.objects.get()
+    self.assertEquals(250, drink.volume_ml)
+    self.assertEquals('board-1', drink.pour_key)
+
+    reply = self._send({'type': 'pour', 'tap': 'kegboard.unknown',
+        'ticks': 1100})
+    self.assertEquals('BadRequestError', reply['error']['code'])
+    reply = self._send({'type': 'pour', 'tap': 'kegboard.flow0'})
+    self.assertEquals('BadRequestError', reply['error']['code'])
+
+    reply = self._send({'type': 'thermo', 'sensor': 'thermo-0',
+        'temp_c': 4.5})
+    self.assertEquals(4.5, reply['result']['temperature_c'])
+
+    reply = self._send({'type': 'meter_update', 'meter': 'kegboard.flow0',
+        'ticks': 1234})
+    self.assertEquals(1234, reply['result']['ticks'])
+    reply = self._send({'type': 'flow_end', 'meter': 'kegboard.flow0'})
+    self.assertEquals('completed', reply['result']['state'])
+    self.assertEquals(1234, models.Drink.objects.get(
+        pour_key__startswith='flow-').ticks)
+    reply = self._send({'type': 'meter_update', 'meter': 'kegboard.flow9',
+        'ticks': 1234})
+    self.assertEquals('BadRequestError', reply['error']['code'])
+
+    reply = self._send({'type': 'auth_token', 'auth_device': 'core.rfid',
+        'token_value': 'deadbeef'})
+    self.assertEquals('NotFoundError', reply['error']['code'])
+    self.backend.CreateAuthToken('core.rfid', 'deadbeef')
+    reply = self._send({'type': 'auth_token', 'auth_device': 'core.rfid',
+        'token_value': 'deadbeef'})
+    self.assertEquals('deadbeef', reply['result']['token_value'])
+
+    reply = self.handler.HandleLine(self.session, 'not json')
+    self.assertEquals('BadRequestError', reply['error']['code'])
+    reply = self._send({'type': 'bogus'})
+    self.assertEquals('BadRequestError', reply['error']['code'])
+
+
+class FakeHandler(object):
+  def __init__(self):
+    self.lines = []
+
+  def HandleLine(self, session, line):
+    self.lines.append(line)
+    if line == 'bad auth':
+      session.auth_failed = True
+    return {'result': line}
+
+
+class IngestChannelTestCase(unittest.TestCase):
+  def setUp(self):
+    self.handler = FakeHandler()
+    self.waker = ingest_server.Waker()
+    sock, self.client = socket.socketpair()
+    self.client.setblocking(False)
+    self.channel = ingest_server.IngestChannel(self.handler, sock, self.waker)
+
+  def tearDown(self):
+    self.channel.close()
+    self.waker.close()
+    self.client.close()
+
+  def _exchange(self, data):
+    """Sends data, then returns the replies received until the channel closes."""
+    self.client.sendall(data)
+    received = ''
+    deadline = time.time() + 5
+    while time.time() < deadline:
+      asyncore.loop(timeout=0.01, count=1)
+      try:
+        chunk = self.client.recv(4096)
+      except socket.error:
+        continue
+      if not chunk:
+        break
+      received += chunk
+    else:
+      self.fail('Connection was not closed.')
+    return [kbjson.loads(line) for line in received.splitlines()]
+
+  def testAuthFailure(self):
+    replies = self._exchange('one\nbad auth\ntwo\n')
+    self.assertEquals([{'result': 'one'}, {'result': 'bad auth'}], replies)
+
+  def testMessageTooLong(self):
+    replies = self._exchange('x' * (ingest_server.MAX_MESSAGE_BYTES + 1) +
+        '\none\n')
+    self.assertEquals([], replies)
+    self.assertEquals([], self.handler.lines)
@@ -17,7 +17,7 @@
 # along with Pykeg.  If not, see <http://www.gnu.org/licenses/>.
 
 from django.conf import settings
-from django.http import HttpResponse
+from django.http.response import HttpResponseBase
 
 from . import util
 
@@ -90,7 +90,7 @@ class ApiResponseMiddleware:
     if not util.is_api_request(request):
       return response
 
-    if not isinstance(response, HttpResponse):
+    if not isinstance(response, HttpResponseBase):
       data = util.prepare_data(response)
       data['meta'] = {
         'result': 'ok'
@@ -28,12 +28,18 @@ urlpatterns = patterns('pykeg.web.api.views',
     url(r'^cancel-drink/?$', 'cancel_drink'),
     url(r'^debug/log/?$', 'debug_log'),
     url(r'^drinks/?$', 'all_drinks'),
+    url(r'^drinks/batch/?$', 'record_drinks'),
     url(r'^drinks/(?P<drink_id>\d+)/?$', 'get_drink'),
     url(r'^drinks/(?P<drink_id>\d+)/add-photo/?$', 'add_drink_photo'),
+    url(r'^drinks/(?P<drink_id>\d+)/flow-stats/?$', 'get_drink_flow_stats'),
+    url(r'^flows/?$', 'all_flows'),
+    url(r'^flows/stream/?$', 'stream_flows'),
     url(r'^sessions/?$', 'all_sessions'),
     url(r'^sessions/current/?$', 'current_session'),
     url(r'^sessions/(?P<session_id>\d+)/?$', 'get_session'),
     url(r'^sessions/(?P<session_id>\d+)/stats/?$', 'get_session_stats'),
+    url(r'^sessions/(?P<session_id>\d+)/stats/distributions/?$',
+        'get_session_stats_distributions'),
     url(r'^events/?$', 'all_events'),
     url(r'^sound-events/?$', 'all_sound_events'),
     url(r'^kegs/?$', 'all_kegs'),
@@ -41,16 +47,22 @@ urlpatterns = patterns('pykeg.web.api.views',
     url(r'^kegs/(?P<keg_id>\d+)/end/?$', 'end_keg'),
     url(r'^kegs/(?P<keg_id>\d+)/drinks/?$', 'get_keg_drinks'),
     url(r'^kegs/(?P<keg_id>\d+)/events/?$', 'get_keg_events'),
+    url(r'^kegs/(?P<keg_id>\d+)/flow-stats/?$', 'get_keg_flow_stats'),
     url(r'^kegs/(?P<keg_id>\d+)/sessions/?$', 'get_keg_sessions'),
     url(r'^kegs/(?P<keg_id>\d+)/stats/?$', 'get_keg_stats'),
+    url(r'^kegs/(?P<keg_id>\d+)/stats/distributions/?$',
+        'get_keg_stats_distributions'),
     url(r'^keg-sizes/?$', 'get_keg_sizes'),
+    url(r'^leaderboard/?$', 'get_leaderboard'),
     url(r'^login/?$', 'login'),
     url(r'^logout/?$', 'logout'),
     url(r'^taps/?$', 'all_taps'),
     url(r'^taps/(?P<tap_id>[\w\.]+)/activate/?$', 'tap_activate'),
     url(r'^taps/(?P<tap_id>[\w\.]+)/spill/?$', 'tap_spill'),
     url(r'^taps/(?P<tap_id>[\w\.]+)/calibrate/?$', 'tap_calibrate'),
+    url(r'^taps/(?P<tap_id>[\w\.]+)/flow/?$', 'tap_flow'),
     url(r'^taps/(?P<tap_id>[\w\.]+)/?$', 'tap_detail'),
+    url(r'^thermo-logs/batch/?$', 'record_thermo_logs'),
     url(r'^thermo-sensors/?$', 'all_thermo_sensors'),
     url(r'^thermo-sensors/(?P<sensor_name>[^/]+)/?$', 'get_thermo_sensor'),
     url(r'^thermo-sensors/(?P<sensor_name>[^/]+)/logs/?$', 'get_thermo_sensor_logs'),
@@ -59,8 +71,11 @@ urlpatterns = patterns('pykeg.web.api.views',
     url(r'^users/(?P<username>[\w@.+-_]+)/drinks/?$', 'get_user_drinks'),
     url(r'^users/(?P<username>[\w@.+-_]+)/events/?$', 'get_user_events'),
     url(r'^users/(?P<username>[\w@.+-_]+)/stats/?$', 'get_user_stats'),
+    url(r'^users/(?P<username>[\w@.+-_]+)/stats/distributions/?$',
+        'get_user_stats_distributions'),
     url(r'^users/(?P<username>[\w@.+-_]+)/?$', 'get_user'),
     url(r'^stats/?$', 'get_system_stats'),
+    url(r'^stats/distributions/?$', 'get_system_stats_distributions'),
 
     url(r'^get-api-key/?$', 'get_api_key'),
 
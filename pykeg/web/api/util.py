@@ -20,6 +20,7 @@
 
 from django.conf import settings
 from django.http import Http404
+from django.utils import timezone
 from django.http import HttpResponse
 from django.db.models.query import QuerySet
 from pykeg.proto import protolib
@@ -33,6 +34,7 @@ from pykeg.core import backend
 
 from . import validate_jsonp
 
+import datetime
 import logging
 import sys
 import traceback
@@ -50,7 +52,10 @@ def check_api_key(request):
     keystr = request.REQUEST.get('api_key')
   if not keystr:
     raise kbapi.NoAuthTokenError('The parameter "api_key" is required')
+  check_api_key_value(keystr)
 
+def check_api_key_value(keystr):
+  """Checks that an API key is valid, raising a kbapi.Error if not."""
   try:
     api_key = models.ApiKey.objects.get(key=keystr)
   except models.ApiKey.DoesNotExist:
@@ -66,6 +71,50 @@ def check_api_key(request):
   if not api_key.user.is_staff and not api_key.user.is_superuser:
     raise kbapi.PermissionDeniedError('User is not staff/superuser')
 
+def form_errors(form):
+  """Returns a form's errors, by field name."""
+  ret = {}
+  for field in form:
+    if field.errors:
+      name = field.html_name
+      ret[name] = []
+      for error in field.errors:
+        ret[name].append(error)
+  return ret
+
+def drink_kwargs(tap_name, cd):
+  """Returns RecordDrink() arguments for a validated DrinkPostForm."""
+  if cd.get('pour_time') and cd.get('now'):
+    pour_time = datetime.datetime.fromtimestamp(cd.get('pour_time'))
+    pour_now = datetime.datetime.fromtimestamp(cd.get('now'))
+    pour_time_ago = pour_now - pour_time
+    pour_time = timezone.now() - pour_time_ago
+  else:
+    pour_time = None
+  duration = cd.get('duration')
+  if duration is None:
+    duration = 0
+  return {
+    'tap_name': tap_name,
+    'ticks': cd['ticks'],
+    'volume_ml': cd.get('volume_ml'),
+    'username': cd.get('username'),
+    'pour_time': pour_time,
+    'duration': duration,
+    'shout': cd.get('shout'),
+    'tick_time_series': cd.get('tick_time_series'),
+    'pour_key': cd.get('pour_key') or None,
+  }
+
+def reading_time(cd):
+  """Returns the time of a validated ThermoPostForm's reading, or None.
+
+  Like a pour's time, `when` is taken relative to the client's clock, `now`.
+  """
+  if cd.get('when') and cd.get('now'):
+    return timezone.now() - datetime.timedelta(seconds=cd['now'] - cd['when'])
+  return None
+
 def to_json_error(e, exc_info):
   """Converts an exception to an API error response."""
   # Wrap some common exception types into kbapi types
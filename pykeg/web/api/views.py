@@ -18,10 +18,10 @@
 
 """Kegweb RESTful API views."""
 
-import datetime
 from functools import wraps
 import logging
 import sys
+import time
 import traceback
 import types
 
@@ -30,9 +30,11 @@ from django.contrib.auth import login as auth_login
 from django.contrib.auth import logout as auth_logout
 from django.contrib.auth.forms import AuthenticationForm
 from django.db.utils import IntegrityError
+from django.utils import dateparse
 from django.utils import timezone
 
 from django.http import Http404
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.cache import never_cache
@@ -45,7 +47,13 @@ from kegbot.util import kbjson
 
 from pykeg.contrib.soundserver import models as soundserver_models
 from pykeg.core import backend
+from pykeg.core import flow_stats
+from pykeg.core import flows
+from pykeg.core import journal
+from pykeg.core import kb_common
 from pykeg.core import models
+from pykeg.core import tap_cache
+from pykeg.core import token_cache
 from pykeg.proto import protolib
 from pykeg.web.api import forms
 from pykeg.web.api import util
@@ -59,6 +67,12 @@ if settings.HAVE_RAVEN:
 
 _LOGGER = logging.getLogger(__name__)
 
+# Longest time a flow stream is held open; clients reconnect after it ends.
+FLOW_STREAM_MAX_SECS = 300
+
+# Longest time between lines of a flow stream.
+FLOW_STREAM_KEEPALIVE_SECS = 15
+
 ### Decorators
 
 def auth_required(viewfunc):
@@ -71,15 +85,19 @@ def auth_required(viewfunc):
 
 ### Helpers
 
-def _form_errors(form):
-  ret = {}
-  for field in form:
-    if field.errors:
-      name = field.html_name
-      ret[name] = []
-      for error in field.errors:
-        ret[name].append(error)
-  return ret
+def _parse_time_param(request, name):
+  value = request.GET.get(name)
+  if not value:
+    return None
+  try:
+    when = dateparse.parse_datetime(value)
+  except ValueError:
+    when = None
+  if when is None:
+    raise kbapi.BadRequestError('Invalid %s.' % name)
+  if timezone.is_naive(when):
+    when = timezone.make_aware(when, timezone.get_current_timezone())
+  return when
 
 ### Endpoints
 
@@ -103,6 +121,10 @@ def get_drink(request, drink_id):
   drink = get_object_or_404(models.Drink, id=drink_id, site=request.kbsite)
   return protolib.ToProto(drink, full=True)
 
+def get_drink_flow_stats(request, drink_id):
+  drink = get_object_or_404(models.Drink, id=drink_id, site=request.kbsite)
+  return flow_stats.ToDict(flow_stats.GetDrinkStats(drink))
+
 @csrf_exempt
 @auth_required
 def add_drink_photo(request, drink_id):
@@ -128,12 +150,29 @@ def get_session(request, session_id):
 def get_session_stats(request, session_id):
   session = get_object_or_404(models.DrinkingSession, id=session_id,
       site=request.kbsite)
-  return session.GetStats()
+  record = apply_stats_as_of(request, session.GetStatsRecord())
+  if not record:
+    return {}
+  return record
+
+def get_session_stats_distributions(request, session_id):
+  session = get_object_or_404(models.DrinkingSession, id=session_id,
+      site=request.kbsite)
+  return get_stats_distributions(request, session.GetStatsRecord())
 
 def get_keg(request, keg_id):
   keg = get_object_or_404(models.Keg, id=keg_id, site=request.kbsite)
   return protolib.ToProto(keg, full=True)
 
+def get_keg_flow_stats(request, keg_id):
+  """Returns flow analytics for the keg, and for each of its drinks."""
+  keg = get_object_or_404(models.Keg, id=keg_id, site=request.kbsite)
+  records = flow_stats.GetDrinksStats(keg.drinks.valid())
+  return {
+    'keg': flow_stats.GetKegSummary(keg, records),
+    'drinks': [flow_stats.ToDict(records[k]) for k in sorted(records)],
+  }
+
 def get_keg_drinks(request, keg_id):
   keg = get_object_or_404(models.Keg, id=keg_id, site=request.kbsite)
   return keg.drinks.valid()
@@ -159,12 +198,10 @@ def all_sessions(request):
   return request.kbsite.sessions.all()
 
 def current_session(request):
-  try:
-    latest = request.kbsite.sessions.latest()
-    if latest.IsActiveNow():
-      return latest
-  except models.DrinkingSession.DoesNotExist:
+  session = models.DrinkingSession.GetCurrent(request.kbsite)
+  if not session:
     raise Http404
+  return session
 
 def all_events(request):
   events = request.kbsite.events.all().order_by('-id')
@@ -183,6 +220,57 @@ def apply_since(request, query):
       pass
   return query
 
+def apply_stats_as_of(request, record):
+  """Rewinds the stats record to `as_of_drink` and/or `as_of`, if given.
+
+  `as_of_drink` is a drink id; `as_of` is an ISO 8601 date and time.
+  """
+  drink_id = None
+  drink_str = request.GET.get('as_of_drink')
+  if drink_str:
+    try:
+      drink_id = int(drink_str)
+    except ValueError:
+      raise kbapi.BadRequestError('Invalid as_of_drink.')
+  when = _parse_time_param(request, 'as_of')
+
+  if not record or (drink_id is None and when is None):
+    return record
+  record = record.StatsAsOf(drink_id=drink_id, time=when)
+  if not record:
+    return {}
+  return record
+
+def get_stats_distributions(request, record):
+  """Returns pour volume and duration percentiles and histograms.
+
+  The stats record may be rewound with `as_of_drink` and/or `as_of`.
+  """
+  record = apply_stats_as_of(request, record)
+  if not record:
+    return {}
+  return record.PourDistributions()
+
+def get_stats_window(request, **scope):
+  """Returns windowed stats if `window`, `since` or `until` is given.
+
+  `window` names a window ending now (see VolumeRollup.WINDOWS); `since` and
+  `until` are ISO 8601 times.  Returns None if none of these is given.
+  """
+  window = request.GET.get('window')
+  if window:
+    try:
+      since, until = models.VolumeRollup.Window(window)
+    except ValueError, e:
+      raise kbapi.BadRequestError(str(e))
+  else:
+    since = _parse_time_param(request, 'since')
+    until = _parse_time_param(request, 'until')
+    if since is None and until is None:
+      return None
+  return models.VolumeRollup.WindowStats(request.kbsite, since=since,
+      until=until, **scope)
+
 @auth_required
 def all_sound_events(request):
   return soundserver_models.SoundEvent.objects.all()
@@ -194,13 +282,80 @@ def get_keg_sessions(request, keg_id):
 
 def get_keg_stats(request, keg_id):
   keg = get_object_or_404(models.Keg, id=keg_id, site=request.kbsite)
-  return keg.GetStatsRecord()
+  window_stats = get_stats_window(request, keg=keg)
+  if window_stats is not None:
+    return window_stats
+  return apply_stats_as_of(request, keg.GetStatsRecord())
+
+def get_keg_stats_distributions(request, keg_id):
+  keg = get_object_or_404(models.Keg, id=keg_id, site=request.kbsite)
+  return get_stats_distributions(request, keg.GetStatsRecord())
 
 def get_system_stats(request):
-  return request.kbsite.GetStatsRecord()
+  window_stats = get_stats_window(request)
+  if window_stats is not None:
+    return window_stats
+  return apply_stats_as_of(request, request.kbsite.GetStatsRecord())
+
+def get_system_stats_distributions(request):
+  return get_stats_distributions(request, request.kbsite.GetStatsRecord())
+
+def _leaderboard_entry(entry, rank):
+  return {
+    'rank': rank,
+    'username': entry.user.username,
+    'volume_ml': entry.volume_ml,
+    'pours': entry.pours,
+  }
+
+def get_leaderboard(request):
+  """Returns the top drinkers of a scope, and optionally one user's rank.
+
+  Parameters are `scope` (one of LeaderboardEntry.SCOPES), `keg` or `session`
+  ids for those scopes, `when` (an ISO 8601 time) for the month and year
+  scopes, `limit`, and `username`.
+  """
+  scope = request.GET.get('scope', 'system')
+  if scope not in models.LeaderboardEntry.SCOPES:
+    raise kbapi.BadRequestError('Invalid scope.')
+  kwargs = {
+    'scope': scope,
+    'when': _parse_time_param(request, 'when'),
+  }
+  if scope == 'keg':
+    kwargs['keg'] = get_object_or_404(models.Keg, site=request.kbsite,
+        id=request.GET.get('keg'))
+  elif scope == 'session':
+    kwargs['session'] = get_object_or_404(models.DrinkingSession,
+        site=request.kbsite, id=request.GET.get('session'))
+  try:
+    limit = int(request.GET.get('limit', 10))
+  except ValueError:
+    raise kbapi.BadRequestError('Invalid limit value')
+  limit = max(1, min(limit, 100))
+
+  leaders = []
+  rank = 0
+  last_volume_ml = None
+  entries = models.LeaderboardEntry.Leaders(request.kbsite, limit=limit,
+      **kwargs)
+  for pos, entry in enumerate(entries):
+    if entry.volume_ml != last_volume_ml:
+      rank = pos + 1
+      last_volume_ml = entry.volume_ml
+    leaders.append(_leaderboard_entry(entry, rank))
+  result = {'leaders': leaders}
+
+  username = request.GET.get('username')
+  if username:
+    user = get_object_or_404(models.User, username=username)
+    entry = models.LeaderboardEntry.GetEntry(request.kbsite, user, **kwargs)
+    if entry:
+      result['user'] = _leaderboard_entry(entry, entry.Rank())
+  return result
 
 def all_taps(request):
-  return request.kbsite.taps.all().order_by('name')
+  return tap_cache.GetTaps(request.kbsite)
 
 @auth_required
 def user_list(request):
@@ -220,13 +375,19 @@ def get_user_events(request, username):
 
 def get_user_stats(request, username):
   user = get_object_or_404(models.User, username=username)
-  return user.get_profile().GetStatsRecord()
+  window_stats = get_stats_window(request, user=user)
+  if window_stats is not None:
+    return window_stats
+  return apply_stats_as_of(request, user.get_profile().GetStatsRecord())
+
+def get_user_stats_distributions(request, username):
+  user = get_object_or_404(models.User, username=username)
+  return get_stats_distributions(request, user.get_profile().GetStatsRecord())
 
 @auth_required
 def get_auth_token(request, auth_device, token_value):
   b = backend.KegbotBackend(site=request.kbsite)
-  tok = b.GetAuthToken(auth_device, token_value)
-  return tok
+  return token_cache.GetToken(b, auth_device, token_value)
 
 @csrf_exempt
 @auth_required
@@ -236,7 +397,7 @@ def assign_auth_token(request, auth_device, token_value):
 
   form = forms.AssignTokenForm(request.POST)
   if not form.is_valid():
-    errors = _form_errors(form)
+    errors = util.form_errors(form)
     raise kbapi.BadRequestError(errors)
 
   b = backend.KegbotBackend(site=request.kbsite)
@@ -297,13 +458,55 @@ def _thermo_sensor_get(request, sensor_name):
 def _thermo_sensor_post(request, sensor_name):
   form = forms.ThermoPostForm(request.POST)
   if not form.is_valid():
-    raise kbapi.BadRequestError, _form_errors(form)
+    raise kbapi.BadRequestError, util.form_errors(form)
   cd = form.cleaned_data
   b = backend.KegbotBackend(site=request.kbsite)
-  sensor, created = models.ThermoSensor.objects.get_or_create(site=request.kbsite,
-      raw_name=sensor_name)
-  # TODO(mikey): use form fields to compute `when`
-  return b.LogSensorReading(sensor.raw_name, cd['temp_c'])
+  res = journal.LogSensorReading(b, sensor_name, cd['temp_c'],
+      util.reading_time(cd))
+  if res is None:
+    return {'journaled': True}
+  return res
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@auth_required
+def record_thermo_logs(request):
+  """Records a batch of temperature readings, from any number of sensors.
+
+  The readings are given as for record_drinks(), in the `readings` field.
+  Each takes the fields of a sensor POST, plus `sensor`, the sensor's name.
+  Returns one result per reading, holding either the `log` or the reading's
+  `errors`.
+  """
+  readings = _get_json_list(request, 'readings')
+  min_temp, max_temp = kb_common.THERMO_SENSOR_RANGE
+  results = []
+  valid = []
+  for index, reading in enumerate(readings):
+    result = {'index': index}
+    results.append(result)
+    if not isinstance(reading, dict):
+      result['errors'] = {'__all__': ['Reading must be a JSON object.']}
+      continue
+    form = forms.ThermoBatchItemForm(reading)
+    if not form.is_valid():
+      result['errors'] = util.form_errors(form)
+    elif not min_temp <= form.cleaned_data['temp_c'] <= max_temp:
+      result['errors'] = {'temp_c': ['Temperature out of bounds.']}
+    else:
+      cd = form.cleaned_data
+      valid.append((result, {'sensor_name': cd['sensor'],
+          'temperature': cd['temp_c'], 'when': util.reading_time(cd)}))
+
+  b = backend.KegbotBackend(site=request.kbsite)
+  logs = journal.LogSensorReadings(b, [kwargs for result, kwargs in valid])
+  if logs is None:
+    for result, kwargs in valid:
+      result['journaled'] = True
+  else:
+    for (result, kwargs), log in zip(valid, logs):
+      result['log'] = util.to_dict(log)
+  return results
 
 def get_thermo_sensor_logs(request, sensor_name):
   sensor = _get_sensor_or_404(request, sensor_name)
@@ -341,7 +544,7 @@ def tap_calibrate(request, tap_id):
     tap.ml_per_tick = form.cleaned_data['ml_per_tick']
     tap.save()
   else:
-    raise kbapi.BadRequestError, _form_errors(form)
+    raise kbapi.BadRequestError, util.form_errors(form)
   return protolib.ToProto(tap, full=True)
 
 @csrf_exempt
@@ -355,7 +558,7 @@ def tap_spill(request, tap_id):
     tap.current_keg.spilled_ml += form.cleaned_data['volume_ml']
     tap.current_keg.save()
   else:
-    raise kbapi.BadRequestError, _form_errors(form)
+    raise kbapi.BadRequestError, util.form_errors(form)
   return protolib.ToProto(tap, full=True)
 
 @csrf_exempt
@@ -366,39 +569,140 @@ def tap_activate(request, tap_id):
   if form.is_valid():
     form.save(tap)
   else:
-    raise kbapi.BadRequestError, _form_errors(form)
+    raise kbapi.BadRequestError, util.form_errors(form)
   return protolib.ToProto(tap, full=True)
 
+@csrf_exempt
+@require_http_methods(["POST"])
+@auth_required
+def tap_flow(request, tap_id):
+  """Adds new meter ticks to the tap's flow, starting one if needed.
+
+  If `done` is set, the flow is then finished and recorded as a drink.  The
+  flow is kept only in memory until then.
+  """
+  form = forms.FlowUpdateForm(request.POST)
+  if not form.is_valid():
+    raise kbapi.BadRequestError, util.form_errors(form)
+  cd = form.cleaned_data
+  table = flows.GetFlowTable(request.kbsite)
+  try:
+    flow = table.Update(tap_id, cd.get('ticks') or 0,
+        username=cd.get('username') or None,
+        auth_device=cd.get('auth_device') or None)
+  except ValueError, e:
+    raise kbapi.BadRequestError(str(e))
+  if cd.get('done'):
+    flow = table.Finish(tap_id) or flow
+  return flow
+
+def all_flows(request):
+  version, active = flows.GetFlowTable(request.kbsite).Flows()
+  return {'version': version, 'flows': active}
+
+def stream_flows(request):
+  """Streams flow changes, one JSON object per line.
+
+  Each line holds the table `version`, the active `flows`, and the flows
+  `completed` since the previous line.  Pass the last version seen as `since`
+  to resume.
+  """
+  table = flows.GetFlowTable(request.kbsite)
+  try:
+    since = int(request.GET.get('since', -1))
+  except ValueError:
+    raise kbapi.BadRequestError('Invalid since value')
+
+  def lines(version):
+    deadline = time.time() + FLOW_STREAM_MAX_SECS
+    while time.time() < deadline:
+      new_version, active, completed = table.Wait(version,
+          FLOW_STREAM_KEEPALIVE_SECS)
+      if new_version == version:
+        yield '\n'
+        continue
+      version = new_version
+      yield kbjson.dumps({'version': version, 'flows': active,
+          'completed': completed}, indent=None) + '\n'
+
+  response = StreamingHttpResponse(lines(since),
+      content_type='application/json')
+  response['X-Accel-Buffering'] = 'no'
+  return response
+
 @auth_required
 def _tap_detail_post(request, tap):
   form = forms.DrinkPostForm(request.POST)
   if not form.is_valid():
-    raise kbapi.BadRequestError, _form_errors(form)
-  cd = form.cleaned_data
-  if cd.get('pour_time') and cd.get('now'):
-    pour_time = datetime.datetime.fromtimestamp(cd.get('pour_time'))
-    pour_now = datetime.datetime.fromtimestamp(cd.get('now'))
-    pour_time_ago = pour_now - pour_time
-    pour_time = timezone.now() - pour_time_ago
-  else:
-    pour_time = None
-  duration = cd.get('duration')
-  if duration is None:
-    duration = 0
+    raise kbapi.BadRequestError, util.form_errors(form)
   b = backend.KegbotBackend(site=request.kbsite)
   try:
-    res = b.RecordDrink(tap_name=tap.meter_name,
-      ticks=cd['ticks'],
-      volume_ml=cd.get('volume_ml'),
-      username=cd.get('username'),
-      pour_time=pour_time,
-      duration=duration,
-      shout=cd.get('shout'),
-      tick_time_series=cd.get('tick_time_series'))
+    res = journal.RecordDrink(b, **util.drink_kwargs(tap.meter_name,
+        form.cleaned_data))
+    if res is None:
+      # Accepted, but to be recorded once the database is available.
+      return {'journaled': True}
     return protolib.ToProto(res, full=True)
   except backend.BackendError, e:
     raise kbapi.ServerError(str(e))
 
+def _get_json_list(request, field):
+  """Returns the JSON list given as the request body, or in `field`."""
+  if request.META.get('CONTENT_TYPE', '').startswith('application/json'):
+    body = request.body
+  else:
+    body = request.POST.get(field)
+  try:
+    items = kbjson.loads(body or '')
+  except ValueError:
+    raise kbapi.BadRequestError('%s must be a JSON list.' % field.capitalize())
+  if isinstance(items, dict):
+    items = items.get(field)
+  if not isinstance(items, list):
+    raise kbapi.BadRequestError('%s must be a JSON list.' % field.capitalize())
+  return items
+
+@csrf_exempt
+@require_http_methods(["POST"])
+@auth_required
+def record_drinks(request):
+  """Records a batch of pours, such as those buffered by an offline client.
+
+  The pours are given, in order, as a JSON list: either the request body
+  (with a JSON content type) or its `pours` field.  Each pour takes the
+  fields of a tap POST, plus `tap`, the tap's meter name.  Every pour is
+  validated first; the valid ones are then recorded together.  Returns one
+  result per pour, holding either the new `drink` or the pour's `errors`.
+  """
+  pours = _get_json_list(request, 'pours')
+  taps = set(models.KegTap.objects.filter(site=request.kbsite).values_list(
+      'meter_name', flat=True))
+  results = []
+  valid = []
+  for index, pour in enumerate(pours):
+    result = {'index': index}
+    results.append(result)
+    if not isinstance(pour, dict):
+      result['errors'] = {'__all__': ['Pour must be a JSON object.']}
+      continue
+    form = forms.DrinkBatchItemForm(pour)
+    if not form.is_valid():
+      result['errors'] = util.form_errors(form)
+    elif form.cleaned_data['tap'] not in taps:
+      result['errors'] = {'tap': ['Tap unknown.']}
+    else:
+      valid.append((result, util.drink_kwargs(form.cleaned_data['tap'],
+          form.cleaned_data)))
+
+  b = backend.KegbotBackend(site=request.kbsite)
+  try:
+    drinks = b.RecordDrinks([kwargs for result, kwargs in valid])
+  except backend.BackendError, e:
+    raise kbapi.ServerError(str(e))
+  for (result, kwargs), drink in zip(valid, drinks):
+    result['drink'] = util.to_dict(drink)
+  return results
+
 @csrf_exempt
 @auth_required
 def cancel_drink(request):
@@ -407,7 +711,7 @@ def cancel_drink(request):
   #form = forms.DrinkCancelForm(request.POST)
   form = forms.CancelDrinkForm(request.GET)
   if not form.is_valid():
-    raise kbapi.BadRequestError, _form_errors(form)
+    raise kbapi.BadRequestError, util.form_errors(form)
   cd = form.cleaned_data
   b = backend.KegbotBackend(site=request.kbsite)
   try:
@@ -441,7 +745,7 @@ def register(request):
   form = forms.RegisterForm(request.POST)
   errors = {}
   if not form.is_valid():
-    errors = _form_errors(form)
+    errors = util.form_errors(form)
   else:
     username = form.cleaned_data['username']
     try:
@@ -482,7 +786,7 @@ def debug_log(request):
 
   form = forms.DebugLogForm(request.POST)
   if not form.is_valid():
-    raise kbapi.BadRequestError(_form_errors(form))
+    raise kbapi.BadRequestError(util.form_errors(form))
   client = LocalRavenClient([])
   message = form.cleaned_data['message']
   ident = client.get_ident(client.create_from_text(message))
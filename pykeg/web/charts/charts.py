@@ -22,6 +22,7 @@ from django.utils import timezone
 from kegbot.util import units
 
 from pykeg.core import models
+from pykeg.core import stats as stats_lib
 
 def to_pints(volume):
   return float(units.Quantity(volume).InPints())
@@ -239,6 +240,68 @@ def UsersByVolume(stats):
   }
   return res
 
+def PourVolumes(stats):
+  """Shows a histogram of pour volumes.
+
+  Syntax:
+    {% chart pour_volumes <stats> width height %}
+  Args:
+    stats - a stats object with pour distributions
+  """
+  acc = _StatsAccumulator(stats)
+  return _HistogramChart(acc.pour_volumes, 'mL')
+
+def PourDurations(stats):
+  """Shows a histogram of pour durations.
+
+  Syntax:
+    {% chart pour_durations <stats> width height %}
+  Args:
+    stats - a stats object with pour distributions
+  """
+  acc = _StatsAccumulator(stats)
+  return _HistogramChart(acc.pour_durations, 's')
+
+def _StatsAccumulator(stats):
+  try:
+    acc = stats_lib.StatsAccumulator.FromDict(stats)
+  except ValueError:
+    raise ChartError('Stats unavailable')
+  if acc.pour_volumes is None or not acc.total_pours:
+    raise ChartError('Pour distribution unavailable')
+  return acc
+
+def _HistogramChart(distribution, unit):
+  labels = []
+  counts = []
+  for low, high, count in distribution.histogram.Buckets():
+    if low is None:
+      labels.append('<%s%s' % (high, unit))
+    elif high is None:
+      labels.append('%s%s+' % (low, unit))
+    else:
+      labels.append('%s-%s%s' % (low, high, unit))
+    counts.append(count)
+
+  res = {
+    'xAxis': {
+      'categories': labels,
+    },
+    'yAxis': {
+      'min': 0,
+    },
+    'series': [
+      {'data': counts},
+    ],
+    'tooltip': {
+      'enabled': False,
+    },
+    'chart': {
+      'defaultSeriesType': 'column',
+    }
+  }
+  return res
+
 def UserSessionChunks(user_chunk):
   if not isinstance(user_chunk, models.UserSessionChunk):
     raise ChartUnavailableError, "Must give user chunk as argument"
@@ -333,6 +333,22 @@ class ChartNode(Node):
     """
     return charts.UsersByVolume(obj)
 
+  def chart_pour_volumes(self, obj):
+    """Histogram of pour volumes.
+
+    Args:
+      obj - the stats instance to chart
+    """
+    return charts.PourVolumes(obj)
+
+  def chart_pour_durations(self, obj):
+    """Histogram of pour durations.
+
+    Args:
+      obj - the stats instance to chart
+    """
+    return charts.PourDurations(obj)
+
   def chart_user_session_chunks(self, obj):
     """Show's a single user's activity within a session.
 
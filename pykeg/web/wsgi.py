@@ -27,6 +27,10 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "pykeg.settings")
 from django.core.wsgi import get_wsgi_application
 application = get_wsgi_application()
 
+# Post-process any drinks left pending by a restart.
+from pykeg.core import deferred
+deferred.StartWorkers()
+
 # Apply WSGI middleware here.
 # from helloworld.wsgi import HelloWorldApplication
 # application = HelloWorldApplication(application)